@@ -13,6 +13,7 @@ import pathlib
 import re
 import secrets
 import smtplib
+import time
 import traceback
 import unicodedata as ud
 import urllib
@@ -34,6 +35,7 @@ import flask_monitoringdashboard as dashboard
 import geojson
 import git
 import gpxpy
+import numpy as np
 
 # Third-Party Imports
 import polyline
@@ -55,6 +57,7 @@ from flask import (
     send_file,
     send_from_directory,
     session,
+    stream_with_context,
     url_for,
     g
 )
@@ -68,7 +71,6 @@ from requests.adapters import HTTPAdapter, Retry
 from scgraph.geographs.marnet import marnet_geograph
 from sqlalchemy import and_, case, func, or_
 from sqlalchemy_utils import database_exists
-from timezonefinder import TimezoneFinder
 from werkzeug.exceptions import HTTPException
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
@@ -85,8 +87,7 @@ logger = logging.getLogger(__name__)
 
 
 # Local Application/Library Specific Imports
-from py import geopip_country
-from py.currency import get_available_currencies, get_exchange_rate
+from py.currency import convert_many, get_available_currencies
 from py.db_init import init_data, init_main
 from py.g_search import get_vessel_picture
 from py.image_generator import generate_image
@@ -110,13 +111,16 @@ from py.sql import (
     getTags,
     getTicket,
     getTickets,
+    getTicketsByIds,
     getTrainStations,
     getTrip,
+    getTripsByIds,
     getTripsCountry,
     getUniqueUserTrips,
     getUserLines,
     getUserTrips,
     initPath,
+    initSimplifiedPaths,
     leaderboardStats,
     statsOperatorKm,
     statsOperatorTrips,
@@ -162,11 +166,11 @@ from py.utils import (
     getCountryFromCoordinates,
     getDistance,
     getDistanceFromPath,
+    getDistanceFromPathArray,
     getIp,
     getIpDetails,
     getRequestData,
     hex_to_rgb,
-    interpolate_great_circle,
     interpolate_points_if_gaps,
     load_config,
     remove_diacritics,
@@ -191,20 +195,27 @@ from src.suspicious_activity import (
     log_suspicious_activity,
 )
 from src.utils import (
+    SQLITE_MAX_VARIABLES,
+    authConn,
+    batched_ids,
     getNameFromPath,
     processDates,
     getUser,
     isCurrentTrip,
     lang,
     mainConn,
+    mainReadConn,
     managed_cursor,
     owner,
     owner_required,
     pathConn,
+    pathReadConn,
     readLang,
+    refConn,
     sendOwnerEmail,
     sendEmail,    
     getLocalDatetime,
+    getTimezones,
     login_required,
     admin_required,
     public_required,
@@ -223,7 +234,22 @@ from src.trips import (
     attach_ticket_to_trips,
     delete_ticket_from_db
 )
+from src.path_arrays import load_path_arrays
+from src.map_versions import bump_map_version, get_map_version
+from src.reference_data import bump_reference_version, commit_reference_write
+from src.pg_outbox import ensure_pg_outbox_worker
+from src.path_codec import (
+    PATH_FORMAT_JSON,
+    PATH_FORMATS,
+    decode_path,
+    format_path,
+    path_json,
+)
+from src.path_lod import delete_simplified_paths, load_simplified_paths, lod_tolerance
 from src.paths import Path
+from src.trip_bounds import delete_trip_bounds, get_trips_bounds
+from src.trip_regions import delete_region, delete_trip_regions, get_traveled_region_ids
+from src.visited_squares import delete_user_squares, get_visited_squares
 from src.carbon import *
 from src.graphhopper import convert_graphhopper_to_osrm
 from src.users import User, Friendship, authDb
@@ -263,12 +289,25 @@ if matomo_config:
         )
 
 
+def getLoggedUser():
+    """
+    Return the User of the logged user (None when browsing publicly), looked up
+    once per request
+    """
+    if "logged_user" not in g:
+        user = getUser()
+        g.logged_user = (
+            None if user == "public" else User.query.filter_by(username=user).first()
+        )
+    return g.logged_user
+
+
 def getLoggedUserCurrency():
-    user = getUser()
-    if user == "public":
+    user = getLoggedUser()
+    if user is None:
         return "EUR"
     else:
-        return User.query.filter_by(username=user).first().user_currency
+        return user.user_currency
 
 
 def generate_distinct_color(existing_hex_colors):
@@ -335,63 +374,76 @@ def fetch_and_filter_flights(flight_filter_key, flight_filter_value, target_date
         return {"error": "Failed to fetch data from FR24 API", "details": str(e)}, 502
     flights = response.json().get("data", [])
     filtered = []
-    with managed_cursor(mainConn) as cursor:
-        for f in flights:
-            orig_icao = f.get("orig_icao")
-            dest_icao = f.get("dest_icao")
-            takeoff_str = f.get("datetime_takeoff")
-            first_seen_str = f.get("first_seen")
-            landing_str = f.get("datetime_landed")
-            last_seen_str = f.get("last_seen")
-            
-            if orig_icao and (takeoff_str or first_seen_str):
-                cursor.execute(
-                    "SELECT latitude, longitude FROM airports WHERE ident = :icao",
-                    {"icao": orig_icao},
-                )
-                orig_coords = cursor.fetchone()
-                if orig_coords:
-                    try:
-                        # Use takeoff time if available, otherwise fall back to first_seen
-                        departure_str = takeoff_str if takeoff_str else first_seen_str
-                        utc_departure = datetime.fromisoformat(
-                            departure_str.replace("Z", "+00:00")
-                        )
-                        local_departure = getLocalDatetime(
-                            orig_coords[0], orig_coords[1], utc_departure
-                        )
-                        if local_departure.date() == target_date:
-                            # Set the appropriate field based on what we used
-                            if takeoff_str:
-                                f["datetime_takeoff_local"] = local_departure.isoformat()
-                            else:
-                                f["datetime_takeoff_local"] = local_departure.isoformat()
-                                f["_used_first_seen_for_takeoff"] = True  # Optional flag for debugging
-                            
-                            if dest_icao and (landing_str or last_seen_str):
-                                cursor.execute(
-                                    "SELECT latitude, longitude FROM airports WHERE ident = :icao",
-                                    {"icao": dest_icao},
+
+    # Fetch all the airports at once and resolve their timezones in one batch
+    icaos = list(
+        {
+            f.get(key)
+            for f in flights
+            for key in ("orig_icao", "dest_icao")
+            if f.get(key)
+        }
+    )
+    airports = {}
+    with managed_cursor(refConn) as cursor:
+        for batch, placeholders in batched_ids(icaos):
+            cursor.execute(
+                "SELECT ident, latitude, longitude FROM airports "
+                f"WHERE ident IN ({placeholders})",
+                batch,
+            )
+            for row in cursor.fetchall():
+                airports[row["ident"]] = (row["latitude"], row["longitude"])
+    getTimezones(list(airports.values()))
+
+    for f in flights:
+        orig_icao = f.get("orig_icao")
+        dest_icao = f.get("dest_icao")
+        takeoff_str = f.get("datetime_takeoff")
+        first_seen_str = f.get("first_seen")
+        landing_str = f.get("datetime_landed")
+        last_seen_str = f.get("last_seen")
+        
+        if orig_icao and (takeoff_str or first_seen_str):
+            orig_coords = airports.get(orig_icao)
+            if orig_coords:
+                try:
+                    # Use takeoff time if available, otherwise fall back to first_seen
+                    departure_str = takeoff_str if takeoff_str else first_seen_str
+                    utc_departure = datetime.fromisoformat(
+                        departure_str.replace("Z", "+00:00")
+                    )
+                    local_departure = getLocalDatetime(
+                        orig_coords[0], orig_coords[1], utc_departure
+                    )
+                    if local_departure.date() == target_date:
+                        # Set the appropriate field based on what we used
+                        if takeoff_str:
+                            f["datetime_takeoff_local"] = local_departure.isoformat()
+                        else:
+                            f["datetime_takeoff_local"] = local_departure.isoformat()
+                            f["_used_first_seen_for_takeoff"] = True  # Optional flag for debugging
+                        
+                        if dest_icao and (landing_str or last_seen_str):
+                            dest_coords = airports.get(dest_icao)
+                            if dest_coords:
+                                # Use landing time if available, otherwise fall back to last_seen
+                                arrival_str = landing_str if landing_str else last_seen_str
+                                utc_landing = datetime.fromisoformat(
+                                    arrival_str.replace("Z", "+00:00")
+                                )
+                                local_landing = getLocalDatetime(
+                                    dest_coords[0], dest_coords[1], utc_landing
                                 )
-                                dest_coords = cursor.fetchone()
-                                if dest_coords:
-                                    # Use landing time if available, otherwise fall back to last_seen
-                                    arrival_str = landing_str if landing_str else last_seen_str
-                                    utc_landing = datetime.fromisoformat(
-                                        arrival_str.replace("Z", "+00:00")
-                                    )
-                                    local_landing = getLocalDatetime(
-                                        dest_coords[0], dest_coords[1], utc_landing
-                                    )
-                                    f["datetime_landed_local"] = (
-                                        local_landing.isoformat()
-                                    )
-                                    # Optional flag for debugging
-                                    if not landing_str:
-                                        f["_used_last_seen_for_landing"] = True
-                            filtered.append(f)
-                    except Exception:
-                        pass
+                                f["datetime_landed_local"] = (
+                                    local_landing.isoformat()
+                                )
+                                # Optional flag for debugging
+                                if not landing_str:
+                                    f["_used_last_seen_for_landing"] = True
+                        filtered.append(f)
+                except Exception:
+                    pass
     return {"data": filtered}, 200
 
 
@@ -755,7 +807,63 @@ def hasUncommonTrips(username):
         return cursor.fetchone()[0] == 1
 
 
-def formatTrip(trip, public=False):
+def get_request_tickets():
+    """
+    Ticket rows loaded during the current request, as a dict str(ticket_id) -> row
+    """
+    if "tickets" not in g:
+        g.tickets = {}
+    return g.tickets
+
+
+def load_tickets(ticket_ids):
+    """
+    Load the ticket rows of the given ids that were not loaded yet during the
+    current request, in as few queries as possible
+    """
+    tickets = get_request_tickets()
+    ticket_ids = [
+        ticket_id
+        for ticket_id in ticket_ids
+        if ticket_id not in (None, "") and str(ticket_id) not in tickets
+    ]
+    if not ticket_ids:
+        return
+    for ticket in load_rows_by_ids(mainConn, getTicketsByIds, ticket_ids, "ticket_ids"):
+        tickets[str(ticket["uid"])] = ticket
+
+
+def get_ticket(ticket_id):
+    """
+    Return a ticket row, from the ones already loaded during the request if possible
+    """
+    tickets = get_request_tickets()
+    if str(ticket_id) not in tickets:
+        with managed_cursor(mainConn) as cursor:
+            cursor.execute(getTicket, (ticket_id,))
+            tickets[str(ticket_id)] = cursor.fetchall()[0]
+    return tickets[str(ticket_id)]
+
+
+def prefetch_trip_formatting(trips):
+    """
+    Load everything formatTrip needs for the given trips (logged user, tickets)
+    so that formatting them does not cost a query per trip
+    """
+    getLoggedUser()
+    load_tickets(trip["ticket_id"] for trip in trips)
+
+
+def formatTrip(trip, public=False, conversions=None):
+    """
+    Format a trip row for display
+
+    Prices are converted to the user currency, unless a `conversions` list is
+    given: the conversions are then appended to it, for the caller to run them
+    all at once with convert_all_to_user_currency. Call prefetch_trip_formatting
+    first when formatting several trips.
+    """
+    pending_conversions = [] if conversions is None else conversions
     if trip["start_datetime"] not in (1, -1) and trip["end_datetime"] not in (
         1,
         -1,
@@ -809,27 +917,34 @@ def formatTrip(trip, public=False):
             trip_duration = ["", ""]
     trip["user_currency"] = getLoggedUserCurrency()
     if trip.get("price") not in (None, ""):
-        trip["price_in_user_currency"] = get_exchange_rate(
-            base_currency=trip["currency"],
-            target_currency=trip["user_currency"],
-            date=trip["purchasing_date"],
-            price=trip["price"],
+        pending_conversions.append(
+            (
+                trip,
+                "price_in_user_currency",
+                trip["price"],
+                trip["currency"],
+                trip["purchasing_date"],
+            )
         )
 
     if trip["ticket_id"] not in (None, ""):
-        with managed_cursor(mainConn) as cursor:
-            cursor.execute(getTicket, (trip["ticket_id"],))
-            ticket = cursor.fetchall()[0]
+        ticket = get_ticket(trip["ticket_id"])
         trip["ticket"] = ticket["name"]
         trip["ticket_price"] = ticket["price"] / ticket["trip_count"]
         trip["ticket_currency"] = ticket["currency"]
-        trip["ticket_price_in_user_currency"] = get_exchange_rate(
-            price=trip["ticket_price"],
-            base_currency=trip["ticket_currency"],
-            target_currency=trip["user_currency"],
-            date=ticket["purchasing_date"],
+        pending_conversions.append(
+            (
+                trip,
+                "ticket_price_in_user_currency",
+                trip["ticket_price"],
+                trip["ticket_currency"],
+                ticket["purchasing_date"],
+            )
         )
 
+    if conversions is None:
+        convert_all_to_user_currency(pending_conversions, trip["user_currency"])
+
     if trip["operator"] is None or trip["operator"] == "":
         trip["operator"] = ""
 
@@ -865,7 +980,8 @@ def saveManualStation(creator, name, lat, lng, station_type):
 
         with managed_cursor(mainConn) as cursor:
             cursor.execute(saveManQuery, (creator, name, lat, lng, station_type))
-        mainConn.commit()
+            bump_reference_version("manual_stations", cursor)
+        commit_reference_write()
 
 
 def airlineLogoProcess(newTrip):
@@ -912,6 +1028,9 @@ def create_authDb():
 
 @app.before_request
 def before_request():
+    # started on the first request rather than at import, to run in the forked
+    # workers; it also applies the pg writes left in the queue by a previous run
+    ensure_pg_outbox_worker()
     allowed_hosts = [
         "127.0.0.1:5000",
         "localhost:5000",
@@ -997,6 +1116,14 @@ def before_request():
     changeLang(language, session)
 
 
+@app.teardown_request
+def teardown_request(exception):
+    # each thread keeps its connections across requests, a write left uncommitted
+    # by a failed request must not hold the databases locked
+    for connection in (mainConn, pathConn, authConn):
+        connection.rollback_pending()
+
+
 @app.context_processor
 def inject_distinct_types():
     # 1) If we’re rendering an error page, don’t touch the DB
@@ -1031,7 +1158,7 @@ def inject_distinct_types():
 
     # 5) Query, but fail soft if DB is locked (or anything else goes wrong)
     try:
-        with managed_cursor(mainConn) as cursor:
+        with managed_cursor(mainReadConn) as cursor:
             cursor.execute(
                 """
                 SELECT DISTINCT type
@@ -1973,15 +2100,28 @@ def edit_ticket(username):
     return jsonify(success=True)
 
 
-def convert_to_user_currency(amount, base_currency, target_currency, date):
-    if amount is None or amount == "":
-        return ""
-    return get_exchange_rate(
-        price=amount,
-        base_currency=base_currency,
+def convert_all_to_user_currency(conversions, target_currency):
+    """
+    Convert many amounts at once. `conversions` is a list of
+    (row, key, amount, base_currency, date), each converted amount is stored in
+    row[key] ("" when there is no amount, None when there is no rate).
+    """
+    pending = []
+    for conversion in conversions:
+        row, key, amount = conversion[:3]
+        if amount is None or amount == "":
+            row[key] = ""
+        else:
+            pending.append(conversion)
+
+    converted = convert_many(
+        prices=[amount for _, _, amount, _, _ in pending],
+        base_currencies=[base_currency for _, _, _, base_currency, _ in pending],
         target_currency=target_currency,
-        date=date,
+        dates=[date for _, _, _, _, date in pending],
     )
+    for (row, key, _, _, _), value in zip(pending, converted):
+        row[key] = value
 
 
 @app.route("/u/<username>/ticket_list")
@@ -1993,6 +2133,7 @@ def ticket_list(username):
 
     result = []
     user_currency = getLoggedUserCurrency()
+    conversions = []
 
     for ticket in tickets:
         end_ticket = dict(ticket)
@@ -2008,11 +2149,14 @@ def ticket_list(username):
         end_ticket["user_currency"] = user_currency
 
         # Convert basic price
-        end_ticket["price_in_user_currency"] = convert_to_user_currency(
-            ticket["price"],
-            ticket["currency"],
-            user_currency,
-            ticket["purchasing_date"],
+        conversions.append(
+            (
+                end_ticket,
+                "price_in_user_currency",
+                ticket["price"],
+                ticket["currency"],
+                ticket["purchasing_date"],
+            )
         )
 
         if ticket["trip_count"] > 0:
@@ -2059,11 +2203,12 @@ def ticket_list(username):
                     end_ticket["price_per_trip"] = ticket["price"] / len(
                         trips_in_active_countries
                     )
-                    end_ticket["price_per_trip_in_user_currency"] = (
-                        convert_to_user_currency(
+                    conversions.append(
+                        (
+                            end_ticket,
+                            "price_per_trip_in_user_currency",
                             end_ticket["price_per_trip"],
                             ticket["currency"],
-                            user_currency,
                             ticket["purchasing_date"],
                         )
                     )
@@ -2075,11 +2220,12 @@ def ticket_list(username):
                     end_ticket["price_per_km"] = ticket["price"] / (
                         total_distance / 1000
                     )
-                    end_ticket["price_per_km_in_user_currency"] = (
-                        convert_to_user_currency(
+                    conversions.append(
+                        (
+                            end_ticket,
+                            "price_per_km_in_user_currency",
                             end_ticket["price_per_km"],
                             ticket["currency"],
-                            user_currency,
                             ticket["purchasing_date"],
                         )
                     )
@@ -2087,20 +2233,24 @@ def ticket_list(username):
                     end_ticket["price_per_km"] = ""
                     end_ticket["price_per_km_in_user_currency"] = ""
             else:
-                end_ticket["price_per_trip_in_user_currency"] = (
-                    convert_to_user_currency(
+                conversions.append(
+                    (
+                        end_ticket,
+                        "price_per_trip_in_user_currency",
                         ticket["price_per_trip"],
                         ticket["currency"],
-                        user_currency,
                         ticket["purchasing_date"],
                     )
                 )
                 # Use SQL-calculated price_per_km when no countries specified
-                end_ticket["price_per_km_in_user_currency"] = convert_to_user_currency(
-                    ticket["price_per_km"],
-                    ticket["currency"],
-                    user_currency,
-                    ticket["purchasing_date"],
+                conversions.append(
+                    (
+                        end_ticket,
+                        "price_per_km_in_user_currency",
+                        ticket["price_per_km"],
+                        ticket["currency"],
+                        ticket["purchasing_date"],
+                    )
                 )
         else:
             end_ticket["price_per_trip_in_user_currency"] = ""
@@ -2108,6 +2258,9 @@ def ticket_list(username):
 
         result.append(end_ticket)
 
+    # Convert the prices of all the tickets at once
+    convert_all_to_user_currency(conversions, user_currency)
+
     return render_template(
         "ticket_list.html",
         title=lang[session["userinfo"]["lang"]]["ticket_list"],
@@ -2799,12 +2952,6 @@ def countries(username, cc):
 @app.route("/u/<username>/countryGeoJSON/<cc>")
 @public_required
 def getCountryGeoJSON(username, cc):
-    def midpoint(point1, point2):
-        return ((point1[0] + point2[0]) / 2, (point1[1] + point2[1]) / 2)
-
-    def getPolygonFromCoordinates(cc, lat, lng):
-        return geopip_country.search(cc=cc, lat=lat, lng=lng)
-
     start_time = datetime.now()
     # Prepare the parameters
     if "-" in cc:
@@ -2817,32 +2964,8 @@ def getCountryGeoJSON(username, cc):
             row["uid"] for row in cursor.execute(getTripsCountry, params).fetchall()
         ]
 
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(idList))
-    )
-    with managed_cursor(pathConn) as cursor:
-        pathResult = cursor.execute(formattedGetUserLines, tuple(idList)).fetchall()
-
-    # Extract unique nodes
-    unique_nodes = set()
-    for path in pathResult:
-        nodes = json.loads(path[1])
-        for i in range(len(nodes) - 1):
-            start = (nodes[i][0], nodes[i][1])
-            end = (nodes[i + 1][0], nodes[i + 1][1])
-            mid = midpoint(start, end)
-            unique_nodes.add(mid)
-        unique_nodes.update((node[0], node[1]) for node in nodes)
-
-    exclude_ids = list(
-        dict.fromkeys(
-            [
-                coord["id"]
-                for lat, lng in unique_nodes
-                if (coord := getPolygonFromCoordinates(cc, lat, lng)) is not None
-            ]
-        )
-    )
+    # Polygons traversed by each trip are cached in trip_regions
+    exclude_ids = get_traveled_region_ids(cc, idList)
 
     directory_path = "country_percent/countries/processed/"
 
@@ -3078,6 +3201,8 @@ def process_queue(cc):
         # Write the updated data back to the file
         with open(file_path, "w") as file:
             json.dump(geojson_data, file)
+        # Polygon ids changed, the cached per-trip regions are stale
+        delete_region(cc)
         
         print(f"Successfully processed {len(operations)} operations")
         return jsonify({
@@ -3452,7 +3577,7 @@ def listOperatorsLogos(tripType=None):
 
     print(selected_types)
 
-    with managed_cursor(mainConn) as cursor:
+    with managed_cursor(refConn) as cursor:
         for logo_type in selected_types:
             # Fetch logos based on operator_type field
             cursor.execute(
@@ -3631,7 +3756,7 @@ def convert_path_to_format(path, output_format):
     Convert the path data to the specified format (GPX or GeoJSON).
     """
     # Load path data from JSON
-    coordinates = json.loads(path)
+    coordinates = decode_path(path)
 
     if output_format == "gpx":
         # Create the GPX root element
@@ -4152,7 +4277,7 @@ def get_trip(trip_id):
     formattedGetUserLines = getUserLines.format(trip_ids=trip_id)
     with managed_cursor(pathConn) as cursor:
         pathResult = cursor.execute(formattedGetUserLines).fetchone()
-    path = json.loads(pathResult["path"])
+    path = decode_path(pathResult["path"])
 
     return Trip(
         trip_id=trip_id,
@@ -4203,7 +4328,7 @@ def update_trip_values_from_form_data(trip_id, formData, update_created_ts=False
     if "path" in formData.keys():
         path = [[coord["lat"], coord["lng"]] for coord in json.loads(formData["path"])]
     else:
-        path = json.loads(pathResult["path"])
+        path = decode_path(pathResult["path"])
 
     limits = [
         {
@@ -4685,7 +4810,7 @@ def router_status_photon():
 
 @app.route("/api/airportAutocomplete/<searchPattern>")
 def airportAutocomplete(searchPattern):
-    with managed_cursor(mainConn) as cursor:
+    with managed_cursor(refConn) as cursor:
         airports = [
             dict(airport)
             for airport in cursor.execute(
@@ -4702,7 +4827,7 @@ def trainStationAutocomplete():
         "searchPatternStart": searchPattern + "%",
         "searchPatternAnywhere": "%" + searchPattern + "%",
     }
-    with managed_cursor(mainConn) as cursor:
+    with managed_cursor(refConn) as cursor:
         trainStations = [
             dict(trainStation)
             for trainStation in cursor.execute(getTrainStations, params).fetchall()
@@ -4866,7 +4991,7 @@ def stationAutocomplete():
 def getManAndOps(username, station_type):
     manualStations = {}
     visitedStations = {}
-    with managed_cursor(mainConn) as cursor:
+    with managed_cursor(refConn) as cursor:
         for station in cursor.execute(
             getManualStationsQuery, (station_type,)
         ).fetchall():
@@ -5205,8 +5330,13 @@ def delete_user(uid):
         )
         with managed_cursor(pathConn) as cursor:
             cursor.execute(formattedDeleteUserPath, tuple(idList)).fetchall()
+            delete_simplified_paths(idList, cursor)
         with managed_cursor(mainConn) as cursor:
             cursor.execute(deleteUserTrips, {"username": user.username})
+            delete_trip_regions(idList, cursor)
+            delete_trip_bounds(idList, cursor)
+            delete_user_squares(user.username, cursor)
+            bump_map_version(user.username, cursor)
         authDb.session.delete(user)
 
         authDb.session.commit()
@@ -5218,10 +5348,89 @@ def delete_user(uid):
     return ""
 
 
-def fetchTripsPaths(username, lastLocal, public):
-    tripList = []
-    now = datetime.now()
-    with managed_cursor(mainConn) as cursor:
+def get_path_format():
+    """
+    Wire format of the paths requested with the `path_format` query parameter
+    (see src/path_codec.py), json by default
+    """
+    path_format = request.args.get("path_format", PATH_FORMAT_JSON)
+    if path_format not in PATH_FORMATS:
+        abort(400)
+    return path_format
+
+
+def get_path_tolerance():
+    """
+    Simplification tolerance of the paths (in degrees) requested with the
+    `tolerance` query parameter, snapped to a stored level of detail (see
+    src/path_lod.py). None for the full paths.
+    """
+    tolerance = request.args.get("tolerance")
+    if tolerance is None:
+        return None
+    try:
+        return lod_tolerance(float(tolerance))
+    except ValueError:
+        abort(400)
+
+
+def parse_last_local(lastLocal):
+    try:
+        return datetime.strptime(lastLocal, "%Y-%m-%dT%H:%M:%S.%f")
+    except ValueError:
+        return None
+
+
+def fetchTripsPaths(
+    username, lastLocal, public, path_format=PATH_FORMAT_JSON, tolerance=None
+):
+    """
+    Return the JSON map payload (trips with their path in `path_format`, ids of
+    all the user's trips) of the trips modified since `lastLocal`, or of all of
+    them with "all", as an iterable of text chunks. Paths are simplified at
+    `tolerance` if given.
+
+    The full payload is cached per user until one of their trips is written (see
+    src/map_versions.py) or starts or ends, which changes how the trips are
+    grouped. Refreshes from clients that are already up to date are answered
+    from the cached id list. Otherwise the payload is streamed as it is built.
+    """
+    version, updated_at = get_map_version(username)
+    cache_key = f"trips_paths_{username}_{public}_{path_format}_{tolerance}"
+    cached = cache.get(cache_key)
+    if cached is not None and cached["version"] == version:
+        if lastLocal == "all" and time.time() < cached["valid_until"]:
+            return [cached["payload"]]
+        client_last_local = parse_last_local(lastLocal)
+        if client_last_local is not None and client_last_local >= updated_at:
+            return [
+                app.json.dumps(
+                    {
+                        "trips": [],
+                        "lastLocal": datetime.strftime(
+                            datetime.now(), "%Y-%m-%dT%H:%M:%S.%f"
+                        ),
+                        "idList": cached["idList"],
+                    }
+                )
+            ]
+
+    return generateTripsPaths(
+        username, lastLocal, public, path_format, tolerance, version, cache_key
+    )
+
+
+def generateTripsPaths(
+    username, lastLocal, public, path_format, tolerance, version, cache_key
+):
+    """
+    Build the map payload of fetchTripsPaths, yielding chunks of about 64kB
+
+    Paths are written as stored (see path_json) and fetched in batches, so the
+    decoded paths of all the trips are never held in memory at once.
+    """
+    newLastLocal = datetime.strftime(datetime.now(), "%Y-%m-%dT%H:%M:%S.%f")
+    with managed_cursor(mainReadConn) as cursor:
         idList = [
             row["uid"]
             for row in cursor.execute(
@@ -5234,59 +5443,128 @@ def fetchTripsPaths(username, lastLocal, public):
             {"username": username, "lastLocal": lastLocal, "public": public},
         ).fetchall()
 
-    trips.reverse()
-    tripIds = [trip["uid"] for trip in trips]
-    print(public, len(tripIds))
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(tripIds))
-    )
-
-    tripIds = []
-    for trip in trips:
-        tripIds.append(trip["uid"])
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(tripIds))
-    )
-
-    tripIds = []
-    for trip in trips:
-        tripIds.append(trip["uid"])
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(tripIds))
-    )
-    with managed_cursor(pathConn) as cursor:
-        pathResult = cursor.execute(formattedGetUserLines, tuple(tripIds)).fetchall()
-
-    paths = {path["trip_id"]: path["path"] for path in pathResult}
-
-    for trip in trips:
-        trip = dict(trip)
-        trip.pop("past")
-        trip.pop("plannedFuture")
-        trip.pop("current")
-        trip.pop("future")
+        # Next time a trip starts or ends (julian day, UTC)
+        next_change = cursor.execute(
+            """
+            SELECT MIN(change) FROM (
+                SELECT julianday(COALESCE(utc_start_datetime, start_datetime)) AS change
+                FROM trip WHERE username = :username
+                UNION ALL
+                SELECT julianday(COALESCE(utc_end_datetime, end_datetime))
+                FROM trip WHERE username = :username
+            )
+            WHERE change > julianday('now')
+            """,
+            {"username": username},
+        ).fetchone()[0]
 
-        tripList.append(
-            {"trip": trip, "path": json.loads(paths.get(trip["uid"], "{}"))}
+    trips.reverse()
+    chunks = []
+    buffer = [
+        '{"idList": ',
+        app.json.dumps(idList),
+        ', "lastLocal": ',
+        app.json.dumps(newLastLocal),
+        ', "trips": [',
+    ]
+    buffer_size = 0
+    separator = ""
+    for i in range(0, len(trips), SQLITE_MAX_VARIABLES):
+        batch = trips[i : i + SQLITE_MAX_VARIABLES]
+        batch_ids = [trip["uid"] for trip in batch]
+        if tolerance is not None:
+            paths = load_simplified_paths(batch_ids, tolerance)
+        else:
+            paths = {
+                path["trip_id"]: path["path"]
+                for path in load_rows_by_ids(
+                    pathReadConn, getUserLines, batch_ids, "trip_ids"
+                )
+            }
+        for trip in batch:
+            trip = dict(trip)
+            trip.pop("past")
+            trip.pop("plannedFuture")
+            trip.pop("current")
+            trip.pop("future")
+
+            item = "".join(
+                (
+                    separator,
+                    '{"path": ',
+                    path_json(
+                        paths.get(trip["uid"]), default="{}", path_format=path_format
+                    ),
+                    ', "trip": ',
+                    app.json.dumps(trip),
+                    "}",
+                )
+            )
+            separator = ", "
+            buffer.append(item)
+            buffer_size += len(item)
+            if buffer_size >= 65536:
+                chunk = "".join(buffer)
+                if lastLocal == "all":
+                    chunks.append(chunk)
+                yield chunk
+                buffer = []
+                buffer_size = 0
+
+    buffer.append("]}")
+    chunk = "".join(buffer)
+    yield chunk
+
+    if lastLocal == "all":
+        chunks.append(chunk)
+        cache.set(
+            cache_key,
+            {
+                "version": version,
+                "valid_until": (
+                    (next_change - 2440587.5) * 86400
+                    if next_change is not None
+                    else float("inf")
+                ),
+                "idList": idList,
+                "payload": "".join(chunks),
+            },
+            timeout=3600,
         )
 
-    print(datetime.now() - now)
-    lastLocal = datetime.strftime(datetime.now(), "%Y-%m-%dT%H:%M:%S.%f")
-    return {"trips": tripList, "lastLocal": lastLocal, "idList": idList}
-
 
 @app.route("/public/<username>/getTripsPaths/<lastLocal>", methods=["GET", "POST"])
 @public_required  # Public access check
 def public_getTripsPaths(username, lastLocal):
-    result = fetchTripsPaths(username, lastLocal, public=1)
-    return jsonify(result)
+    return app.response_class(
+        stream_with_context(
+            fetchTripsPaths(
+                username,
+                lastLocal,
+                public=1,
+                path_format=get_path_format(),
+                tolerance=get_path_tolerance(),
+            )
+        ),
+        mimetype="application/json",
+    )
 
 
 @app.route("/u/<username>/getTripsPaths/<lastLocal>", methods=["GET", "POST"])
 @login_required  # Login access check
 def getTripsPaths(username, lastLocal):
-    result = fetchTripsPaths(username, lastLocal, public=0)
-    return jsonify(result)
+    return app.response_class(
+        stream_with_context(
+            fetchTripsPaths(
+                username,
+                lastLocal,
+                public=0,
+                path_format=get_path_format(),
+                tolerance=get_path_tolerance(),
+            )
+        ),
+        mimetype="application/json",
+    )
 
 
 @app.route("/u/<username>/getCurrentTrip", methods=["GET", "POST"])
@@ -5319,8 +5597,8 @@ def getCurrentTripPath(username):
             {
                 "time": trip["time"],
                 "trip": dict(trip),
-                "path": json.loads(paths[trip["uid"]]),
-                "distances": getDistanceFromPath(json.loads(paths[trip["uid"]])),
+                "path": decode_path(paths[trip["uid"]]),
+                "distances": getDistanceFromPath(decode_path(paths[trip["uid"]])),
             }
         )
     sortedTripList = sorted(tripList, key=lambda d: d["trip"]["uid"], reverse=True)
@@ -5330,142 +5608,144 @@ def getCurrentTripPath(username):
     return jsonify(sortedTripList)
 
 
-def get_logo_url(operator, trip):
-    operator_id = operator["uid"]
+def load_rows_by_ids(conn, query, ids, placeholder):
+    """
+    Run a query with an `IN ({placeholder})` filter over a list of ids, in batches
+    that fit SQLite's variable limit
+    """
+    ids = list(dict.fromkeys(ids))
+    rows = []
+    with managed_cursor(conn) as cursor:
+        for batch, placeholders in batched_ids(ids):
+            formatted_query = query.format(**{placeholder: placeholders})
+            rows.extend(cursor.execute(formatted_query, batch).fetchall())
+    return rows
+
+
+def load_operator_logos(operator_names):
+    """
+    Return the operators of the given short names with all their logos, as a dict
+    short_name -> (operator row, [(effective_date, logo_url), ...])
+    """
+    operators = load_rows_by_ids(
+        refConn,
+        "SELECT * FROM operators WHERE short_name IN ({short_names})",
+        operator_names,
+        "short_names",
+    )
+    logos = defaultdict(list)
+    for logo in load_rows_by_ids(
+        refConn,
+        """
+        SELECT operator_id, effective_date, logo_url
+        FROM operator_logos
+        WHERE operator_id IN ({operator_ids})
+        """,
+        [operator["uid"] for operator in operators],
+        "operator_ids",
+    ):
+        logos[logo["operator_id"]].append((logo["effective_date"], logo["logo_url"]))
+    return {
+        operator["short_name"]: (operator, logos[operator["uid"]])
+        for operator in operators
+    }
+
+
+def pick_logo_url(logos, trip):
+    """
+    Pick the logo of an operator in use at the time of the trip, among the
+    (effective_date, logo_url) pairs returned by load_operator_logos: the oldest
+    one for trips without a date, the latest one for future trips without a date
+    """
     utc_filtered_start_datetime = trip["utc_filtered_start_datetime"]
-    with managed_cursor(mainConn) as cursor:
-        if utc_filtered_start_datetime == -1:
-            # Fetch the oldest logo
-            logo = cursor.execute(
-                """
-                SELECT l.logo_url
-                FROM operator_logos l
-                WHERE l.operator_id = ?
-                ORDER BY l.effective_date ASC
-                LIMIT 1
-            """,
-                (operator_id,),
-            ).fetchone()
-        elif utc_filtered_start_datetime == 1:
-            # Fetch the latest logo
-            logo = cursor.execute(
-                """
-                SELECT l.logo_url
-                FROM operator_logos l
-                WHERE l.operator_id = ?
-                ORDER BY l.effective_date DESC
-                LIMIT 1
-            """,
-                (operator_id,),
-            ).fetchone()
-        else:
-            # Fetch the logo closest to the trip start date
-            logo = cursor.execute(
-                """
-                SELECT l.logo_url
-                FROM operator_logos l
-                WHERE l.operator_id = ?
-                  AND (l.effective_date <= ? OR l.effective_date IS NULL)
-                ORDER BY l.effective_date DESC
-                LIMIT 1
-            """,
-                (operator_id, utc_filtered_start_datetime),
-            ).fetchone()
-    if logo:
-        return logo["logo_url"]
+    dated = sorted(
+        (logo for logo in logos if logo[0] is not None), key=lambda logo: logo[0]
+    )
+    undated = [logo for logo in logos if logo[0] is None]
+    if utc_filtered_start_datetime == -1:
+        candidates = undated + dated
+    elif utc_filtered_start_datetime == 1:
+        candidates = dated[::-1] + undated
     else:
-        return None
+        candidates = [
+            logo for logo in dated[::-1] if logo[0] <= utc_filtered_start_datetime
+        ] + undated
+    return candidates[0][1] if candidates else None
 
 
 def processPublicTrips(tripIds):
     user_currency = getLoggedUserCurrency()
-    for trip in tripIds.split(","):
-        with managed_cursor(mainConn) as cursor:
-            trip = cursor.execute(getTrip, {"trip_id": trip}).fetchone()
-        user = User.query.filter_by(username=trip["username"]).first()
+    tripIds = tripIds.split(",")
+
+    trips = {
+        str(trip["uid"]): dict(trip)
+        for trip in load_rows_by_ids(mainConn, getTripsByIds, tripIds, "trip_ids")
+    }
+    if any(tripId not in trips for tripId in tripIds):
+        abort(404)
+
+    users = {
+        user.username: user
+        for user in User.query.filter(
+            User.username.in_({trip["username"] for trip in trips.values()})
+        ).all()
+    }
+    if any(trip["username"] not in users for trip in trips.values()):
+        abort(404)
+    for user in users.values():
         if (
             not session.get(user.username)
             and not user.is_public_trips()
             and not session.get(owner)
         ):
             abort(401)
-    tripIds = tripIds.split(",")
 
     tripList = []
 
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(tripIds))
+    paths = {
+        path["trip_id"]: path["path"]
+        for path in load_rows_by_ids(pathConn, getUserLines, tripIds, "trip_ids")
+    }
+    prefetch_trip_formatting(trips.values())
+    operator_logos = load_operator_logos(
+        op.strip()
+        for trip in trips.values()
+        if "," in str(trip["operator"])
+        for op in trip["operator"].split(",")
     )
-    with managed_cursor(pathConn) as cursor:
-        pathResult = cursor.execute(formattedGetUserLines, tuple(tripIds)).fetchall()
-    paths = {}
-    for path in pathResult:
-        paths[path["trip_id"]] = path["path"]
 
     total_price = 0
     total_carbon = 0
     total_distance = 0
+    conversions = []
     
-    for tripId in tripIds:
-        with managed_cursor(mainConn) as cursor:
-            trip = formatTrip(
-                dict(cursor.execute(getTrip, {"trip_id": tripId}).fetchone())
-            )
+    for tripId in dict.fromkeys(tripIds):
+        trip = formatTrip(trips[tripId], conversions=conversions)
 
         # Process multi operator logos
         if "," in str(trip["operator"]):
             operator_names = trip["operator"]
             operator_list = [op.strip() for op in operator_names.split(",")]
 
-            operator_logos = []
+            operator_logos_list = []
             for op_name in operator_list:
-                with managed_cursor(mainConn) as cursor:
-                    operator = cursor.execute(
-                        "SELECT * FROM operators WHERE short_name = ?", (op_name,)
-                    ).fetchone()
-                if operator:
-                    operator = dict(operator)
-                    logo_url = get_logo_url(operator, trip)
-                    operator_logos.append(
-                        {"operator_name": operator["short_name"], "logo_url": logo_url}
+                if op_name in operator_logos:
+                    operator, logos = operator_logos[op_name]
+                    operator_logos_list.append(
+                        {
+                            "operator_name": operator["short_name"],
+                            "logo_url": pick_logo_url(logos, trip),
+                        }
                     )
 
-            trip["multi_operators"] = operator_logos
+            trip["multi_operators"] = operator_logos_list
 
             # Remove operator_name and logo_url from trip if they exist
             trip.pop("operator_name", None)
             trip.pop("logo_url", None)
 
-        # Process pricing
-        if trip["ticket_id"] not in (None, ""):
-            with managed_cursor(mainConn) as cursor:
-                cursor.execute(getTicket, (trip["ticket_id"],))
-                ticket = cursor.fetchall()[0]
-            trip["ticket"] = ticket["name"]
-            trip["ticket_price"] = ticket["price"] / ticket["trip_count"]
-            trip["ticket_currency"] = ticket["currency"]
-            trip["ticket_price_in_user_currency"] = get_exchange_rate(
-                price=trip["ticket_price"],
-                base_currency=trip["ticket_currency"],
-                target_currency=user_currency,
-                date=ticket["purchasing_date"],
-            )
-            if trip["ticket_price_in_user_currency"] is not None:
-                total_price += trip["ticket_price_in_user_currency"]
-
-        if trip["price"] not in (None, ""):
-            trip["price_in_user_currency"] = get_exchange_rate(
-                price=trip["price"],
-                base_currency=trip["currency"],
-                target_currency=user_currency,
-                date=trip["purchasing_date"],
-            )
-            trip["user_currency"] = user_currency
-            if trip["price_in_user_currency"] is not None:
-                total_price += trip["price_in_user_currency"]
-
         # Calculate carbon footprint
-        path_data = json.loads(paths[trip["uid"]]) if trip["uid"] in paths else []
+        path_data = decode_path(paths[trip["uid"]]) if trip["uid"] in paths else []
         trip_carbon = calculate_carbon_footprint_for_trip(trip, path_data)
         trip["carbon_footprint"] = round(trip_carbon, 6)
         
@@ -5474,20 +5754,20 @@ def processPublicTrips(tripIds):
         if trip.get('trip_length', 0) > 0:
             total_distance += trip['trip_length'] / 1000  # Convert to km
 
-        user = User.query.filter_by(username=trip["username"]).first()
-        if (
-            not session.get(user.username)
-            and not user.is_public_trips()
-            and not session.get(owner)
-        ):
-            abort(401)
         tripList.append(
             {
                 "time": trip["time"],
-                "trip": dict(trip),
+                "trip": trip,
                 "path": path_data,
             }
         )
+
+    # Convert the prices of all the trips at once (set up by formatTrip)
+    convert_all_to_user_currency(conversions, user_currency)
+    for trip in (item["trip"] for item in tripList):
+        for key in ("ticket_price_in_user_currency", "price_in_user_currency"):
+            if trip.get(key) not in (None, ""):
+                total_price += trip[key]
     
     sortedTripList = sorted(tripList, key=lambda d: d["trip"]["uid"], reverse=True)
     sortedTripList = sorted(
@@ -5510,9 +5790,11 @@ def processPublicTrips(tripIds):
 def getPublicTrips():
     data = request.get_json()
     tripIds = data.get("tripIds")
+    path_format = get_path_format()
     sortedTripList, priceDict = processPublicTrips(tripIds)
     for trip in sortedTripList:
         trip["trip"].pop("username")
+        trip["path"] = format_path(trip["path"], path_format)
     return jsonify([sortedTripList, priceDict])
 
 
@@ -5675,10 +5957,12 @@ def mergeTrips(username, tripIds):
 
 @app.route("/getMultiTrips/<tripIds>", methods=["GET", "POST"])
 def getMultiTrips(tripIds):
+    path_format = get_path_format()
     sortedTripList, priceDict = processPublicTrips(tripIds)
     userList = set()
     anonymous = {}
     for trip in sortedTripList:
+        trip["path"] = format_path(trip["path"], path_format)
         user = User.query.filter_by(username=trip["trip"]["username"]).first()
         if (
             not session.get(user.username)
@@ -5704,6 +5988,7 @@ def getTrips(username, projects):
         trips = list(cursor.execute(getUserTrips, (username,)).fetchall())
     if projects:
         trips.reverse()
+    prefetch_trip_formatting(trips)
     for trip in trips:
         trip = dict(trip)
         trip = formatTrip(trip)
@@ -5900,12 +6185,12 @@ def get_trips_api_internal(username, is_public=False):
     if air_trip_uids:
         with managed_cursor(pathConn) as path_cursor:
             path_cursor.execute(
-                f"SELECT trip_id, json_extract(path, '$') as path_json FROM paths WHERE trip_id IN ({','.join(['?'] * len(air_trip_uids))})",
+                f"SELECT trip_id, path FROM paths WHERE trip_id IN ({','.join(['?'] * len(air_trip_uids))})",
                 air_trip_uids,
             )
             path_data = path_cursor.fetchall()
             for row in path_data:
-                path_nodes = json.loads(row["path_json"]) if row["path_json"] else []
+                path_nodes = decode_path(row["path"]) if row["path"] else []
                 direct_flight_map[row["trip_id"]] = len(path_nodes) == 2
 
     # Add is_geodesic flag to each trip
@@ -5920,8 +6205,11 @@ def get_trips_api_internal(username, is_public=False):
         for trip in trip_dicts:
             trip.pop("price", None)
 
-    # Format trips for display
-    trip_list = [formatTrip(trip) for trip in trip_dicts]
+    # Format trips for display, converting all the prices at once
+    conversions = []
+    prefetch_trip_formatting(trip_dicts)
+    trip_list = [formatTrip(trip, conversions=conversions) for trip in trip_dicts]
+    convert_all_to_user_currency(conversions, getLoggedUserCurrency())
 
     # Return the JSON for DataTables
     return jsonify(
@@ -6130,7 +6418,7 @@ def edit_copy_trip(username, tripId, edit_copy_type):
     with managed_cursor(mainConn) as cursor:
         trip = cursor.execute(getTrip, {"trip_id": tripId}).fetchone()
     with managed_cursor(pathConn) as cursor:
-        path = json.loads(
+        path = decode_path(
             list(cursor.execute(formattedGetUserLines, (tripId,)).fetchone())[1]
         )
     user = User.query.filter_by(username=trip["username"]).first()
@@ -6282,7 +6570,7 @@ def export(username):
             )
             rowP = list(row.values())
 
-            rowP.append(polyline.encode(json.loads(paths[row["uid"]])))
+            rowP.append(polyline.encode(decode_path(paths[row["uid"]])))
             processedRows.append(rowP)
         cw.writerows(processedRows)
         response = make_response(si.getvalue())
@@ -6413,7 +6701,7 @@ def processMFR24(username):
             (origIata, "originStation"),
             (destIata, "destinationStation"),
         ):
-            with managed_cursor(mainConn) as cursor:
+            with managed_cursor(refConn) as cursor:
                 airport = dict(
                     cursor.execute(
                         " SELECT * FROM airports WHERE iata = :searchPattern",
@@ -7105,7 +7393,8 @@ def upload_image(username):
 def deleteManual(id):
     with managed_cursor(mainConn) as cursor:
         cursor.execute("DELETE FROM manual_stations WHERE uid=?", (id,))
-    mainConn.commit()
+        bump_reference_version("manual_stations", cursor)
+    commit_reference_write()
     return redirect(url_for("adminManual"))
 
 
@@ -7119,7 +7408,8 @@ def editStation(id):
             # Delete the station
             with managed_cursor(mainConn) as cursor:
                 cursor.execute("DELETE FROM train_stations WHERE id=?", (id,))
-            mainConn.commit()
+                bump_reference_version("train_stations", cursor)
+            commit_reference_write()
             return redirect(url_for("stations"))
         else:
             # Update the station details
@@ -7142,7 +7432,8 @@ def editStation(id):
                         id,
                     ),
                 )
-            mainConn.commit()
+                bump_reference_version("train_stations", cursor)
+            commit_reference_write()
             return redirect(url_for("stations"))
     else:
         # Fetch the station details
@@ -7275,7 +7566,8 @@ def editManual(id):
             """,
                 new_data,
             )
-            mainConn.commit()
+            bump_reference_version("manual_stations", cursor)
+            commit_reference_write()
             return redirect(url_for("adminManual"))
         else:
             cursor.execute("SELECT * FROM manual_stations WHERE uid=?", (id,))
@@ -8030,7 +8322,7 @@ app.jinja_env.globals.update(getFriendsRequestsNumber=getFriendsRequestsNumber)
 @app.route("/admin/refreshCurrency", methods=["GET"])
 @owner_required
 def refreshCurrency():
-    return run_currency_update()
+    return run_currency_update(full=request.args.get("full") == "1")
 
 
 @app.route("/ship_route", methods=["POST"])
@@ -8204,102 +8496,16 @@ def active_users():
 
 
 def generate_visited_squares_geojson(username):
-    land_squares = set()
-    air_squares = set()
-    visited_squares = {}
-    current_utc_datetime = datetime.now()
-
-    with managed_cursor(mainConn) as cursor:
-        cursor.execute(
-            """
-                SELECT uid, type
-                FROM trip
-                WHERE username = ?
-                AND start_datetime NOT IN (1)
-                AND (
-                    CASE
-                        WHEN utc_start_datetime IS NOT NULL THEN utc_start_datetime
-                        ELSE start_datetime
-                    END
-                ) < ?
-            """,
-            (username, current_utc_datetime),
-        )
-        trips = cursor.fetchall()
-
-        for trip in trips:
-            trip_id = trip["uid"]
-            trip_type = trip["type"]
-
-            with managed_cursor(pathConn) as cursor:
-                cursor.execute("SELECT path FROM paths WHERE trip_id = ?", (trip_id,))
-                paths = cursor.fetchall()
-
-            for path in paths:
-                coordinates = json.loads(path["path"])
-
-                for i in range(len(coordinates)):
-                    lat, lon = coordinates[i]
-                    square = (math.floor(lat), math.floor(lon))
-
-                    if trip_type in ("air", "helicopter"):
-                        if (
-                            visited_squares.get(square) not in ("stopped", "passed")
-                            and square not in land_squares
-                        ):
-                            visited_squares[square] = "air"
-                            air_squares.add(square)
-                    else:
-                        if visited_squares.get(square) != "stopped":
-                            visited_squares[square] = "passed"
-                        land_squares.add(square)
-                        air_squares.discard(square)
-
-                    # Override with "stopped" on first/last point
-                    if i == 0 or i == len(coordinates) - 1:
-                        visited_squares[square] = "stopped"
-                        land_squares.add(square)
-                        air_squares.discard(square)
-
-                    # Interpolate between points (only for air trips)
-                    if (
-                        trip_type in ("air", "helicopter")
-                        and len(coordinates) > 2
-                        and i < len(coordinates) - 1
-                    ):
-                        next_lat, next_lon = coordinates[i + 1]
-                        intermediates = interpolate_great_circle(
-                            (lat, lon), (next_lat, next_lon), max_distance_km=50
-                        )
-
-                        for inter_lat, inter_lon in intermediates:
-                            inter_square = (
-                                math.floor(inter_lat),
-                                math.floor(inter_lon),
-                            )
-
-                            if (
-                                visited_squares.get(inter_square)
-                                not in ("stopped", "passed")
-                                and inter_square not in land_squares
-                            ):
-                                visited_squares[inter_square] = "air"
-                                air_squares.add(inter_square)
+    visited_squares = get_visited_squares(username)
 
+    land_squares = [
+        square for square, status in visited_squares.items() if status != "air"
+    ]
     total_squares = 180 * 360  # entire world grid
     land_percentage = (len(land_squares) / total_squares) * 100
-    air_percentage = (len(air_squares) / total_squares) * 100
-
-    with managed_cursor(mainConn) as cursor:
-        cursor.execute(
-            upsertPercent,
-            {
-                "username": username,
-                "cc": "world_squares",
-                "percent": round(land_percentage, 2),
-            },
-        )
-    mainConn.commit()
+    air_percentage = (
+        (len(visited_squares) - len(land_squares)) / total_squares
+    ) * 100
 
     features = []
     for square, status in visited_squares.items():
@@ -8502,8 +8708,11 @@ def add_operator():
                 """,
                     (operator_id, f"{REL_LOGO_UPLOAD_FOLDER}/{filename}"),
                 )
+                bump_reference_version("operator_logos", cursor)
 
-        mainConn.commit()
+            bump_reference_version("operators", cursor)
+
+        commit_reference_write()
 
         # Log the successful addition to the save log
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -8542,8 +8751,9 @@ def update_operator():
         """,
             (value, uid),
         )
+        bump_reference_version("operators", cursor)
 
-    mainConn.commit()  # Commit the changes before returning the response
+    commit_reference_write()  # Commit the changes before returning the response
 
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with open(log_name, "a", encoding="utf-8") as log:
@@ -8586,8 +8796,9 @@ def upload_logo():
                         effective_date if effective_date else None,
                     ),
                 )
+                bump_reference_version("operator_logos", cursor)
 
-            mainConn.commit()
+            commit_reference_write()
 
             # Log the successful upload to the save log
             current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -8619,6 +8830,8 @@ def delete_operator():
     with managed_cursor(mainConn) as cursor:
         cursor.execute("DELETE FROM operator_logos WHERE operator_id = ?", (uid,))
         cursor.execute("DELETE FROM operators WHERE uid = ?", (uid,))
+        bump_reference_version("operator_logos", cursor)
+        bump_reference_version("operators", cursor)
 
         # Delete all logos related to this operator from the filesystem
         for file in os.listdir(LOGO_UPLOAD_FOLDER):
@@ -8627,7 +8840,7 @@ def delete_operator():
                 if os.path.exists(logo_path):
                     os.remove(logo_path)
 
-    mainConn.commit()
+    commit_reference_write()
     return jsonify(
         {
             "status": "success",
@@ -8672,7 +8885,8 @@ def delete_logo():
             """,
                 (logo_id,),
             )
-        mainConn.commit()
+            bump_reference_version("operator_logos", cursor)
+        commit_reference_write()
         return jsonify({"status": "success", "message": "Logo deleted successfully."})
 
     except Exception as e:
@@ -8735,8 +8949,11 @@ def migrate_logos():
                 (operator_id, logo_url, None),
             )  # Set effective_date to None for now
 
+        bump_reference_version("operators", cursor)
+        bump_reference_version("operator_logos", cursor)
+
     # Commit the changes
-    mainConn.commit()
+    commit_reference_write()
 
     return "Logos and types migrated successfully"
 
@@ -8754,50 +8971,64 @@ def trainloglogger(username):
     )
 
 
-@app.route("/getBounds/u/<username>")
-@login_required
-def get_bounds(username):
-    def get_location(lat, lon):
+def get_location(lat, lon):
+    """
+    Reverse geocode a point with Photon
+
+    Results are cached by coordinates rounded to about 10 meters, so that the
+    extreme points of a user only hit Photon again when they change.
+    """
+    cache_key = f"photon_reverse_{round(lat, 4)}_{round(lon, 4)}"
+    location = cache.get(cache_key)
+    if location is None:
         try:
             response = requests.get(
                 f"https://photon.komoot.io/reverse?lon={lon}&lat={lat}&lang=en"
             )
-            if response.status_code == 200:
-                data = response.json()
-                if data["features"]:
-                    properties = data["features"][0]["properties"]
-
-                    # Extract relevant location details
-                    country = properties.get("country", "Unknown")
-                    city = properties.get("city", None)
-                    county = properties.get("county", None)
-                    state = properties.get("state", None)
-                    country_code = properties.get("countrycode", None)
-
-                    # Add flag to the country
-                    flag_country = (
-                        f"{get_flag_emoji(country_code)} {country}"
-                        if country_code
-                        else country
-                    )
-
-                    # Build preferred location string
-                    if city:
-                        location = f"{city}, {flag_country}"
-                    elif county and state:
-                        location = f"{county}, {state}, {flag_country}"
-                    elif county or state:
-                        location = f"{county or state}, {flag_country}"
-                    else:
-                        location = flag_country
-
-                    # Add OpenStreetMap link
-                    osm_link = f"https://www.openstreetmap.org/?mlat={lat}&mlon={lon}"
-                    return {"location": location, "osm_link": osm_link}
-                return {"location": "Unknown", "osm_link": None}
+            if response.status_code != 200:
+                return None
+            data = response.json()
         except Exception:
             return {"location": "Unknown", "osm_link": None}
 
+        location = ""
+        if data["features"]:
+            properties = data["features"][0]["properties"]
+
+            # Extract relevant location details
+            country = properties.get("country", "Unknown")
+            city = properties.get("city", None)
+            county = properties.get("county", None)
+            state = properties.get("state", None)
+            country_code = properties.get("countrycode", None)
+
+            # Add flag to the country
+            flag_country = (
+                f"{get_flag_emoji(country_code)} {country}" if country_code else country
+            )
+
+            # Build preferred location string
+            if city:
+                location = f"{city}, {flag_country}"
+            elif county and state:
+                location = f"{county}, {state}, {flag_country}"
+            elif county or state:
+                location = f"{county or state}, {flag_country}"
+            else:
+                location = flag_country
+        cache.set(cache_key, location)
+
+    if not location:
+        return {"location": "Unknown", "osm_link": None}
+
+    # Add OpenStreetMap link
+    osm_link = f"https://www.openstreetmap.org/?mlat={lat}&mlon={lon}"
+    return {"location": location, "osm_link": osm_link}
+
+
+@app.route("/getBounds/u/<username>")
+@login_required
+def get_bounds(username):
     # Dictionary to store boundary values
     bounds = {
         "north": {"coordinates": None, "place": None, "trip_id": None},
@@ -8836,47 +9067,23 @@ def get_bounds(username):
     if not trip_ids:
         return jsonify({"error": "No trips found for this user"}), 404
 
-    with managed_cursor(pathConn) as path_cursor:
-        # Fetch all paths associated with the user's trips using IN
-        path_cursor.execute(
-            f"SELECT trip_id, path FROM paths WHERE trip_id IN ({','.join(['?'] * len(trip_ids))})",
-            trip_ids,
-        )
-        paths = path_cursor.fetchall()
+    trips_bounds = get_trips_bounds(trip_ids)
 
-    if not paths:
+    if not trips_bounds:
         return jsonify({"error": "No paths found for this user's trips"}), 404
 
-    # Process each path to update the boundary values
-    for trip_id, path_row in paths:
-        path = json.loads(path_row)  # path is a list of lists with coordinates
-        for coord in path:
-            lat, lon = coord
-            # Update bounds with coordinates, place information, and trip_id
-            if (
-                bounds["north"]["coordinates"] is None
-                or lat > bounds["north"]["coordinates"][0]
-            ):
-                bounds["north"]["coordinates"] = (lat, lon)
-                bounds["north"]["trip_id"] = trip_id
-            if (
-                bounds["west"]["coordinates"] is None
-                or lon < bounds["west"]["coordinates"][1]
-            ):
-                bounds["west"]["coordinates"] = (lat, lon)
-                bounds["west"]["trip_id"] = trip_id
-            if (
-                bounds["south"]["coordinates"] is None
-                or lat < bounds["south"]["coordinates"][0]
-            ):
-                bounds["south"]["coordinates"] = (lat, lon)
-                bounds["south"]["trip_id"] = trip_id
-            if (
-                bounds["east"]["coordinates"] is None
-                or lon > bounds["east"]["coordinates"][1]
-            ):
-                bounds["east"]["coordinates"] = (lat, lon)
-                bounds["east"]["trip_id"] = trip_id
+    # Aggregate the per-trip extreme points, the first trip is kept in case of ties
+    for direction, axis, is_max in (
+        ("north", 0, True),
+        ("west", 1, False),
+        ("south", 0, False),
+        ("east", 1, True),
+    ):
+        trip_id, extremes = (max if is_max else min)(
+            trips_bounds, key=lambda trip: trip[1][direction][axis]
+        )
+        bounds[direction]["coordinates"] = extremes[direction]
+        bounds[direction]["trip_id"] = trip_id
 
     # Fetch place names for each boundary using the stored coordinates
     for direction in bounds:
@@ -8921,12 +9128,13 @@ def router_status():
     )
 
 
-def get_current_trips_data(public_only=True):
+def get_current_trips_data(public_only=True, path_format=PATH_FORMAT_JSON):
     """
     Get current trips data, optionally filtered by public visibility.
     
     Args:
         public_only (bool): If True, only return trips from public users
+        path_format (str): Wire format of the paths, one of PATH_FORMATS
     
     Returns:
         list: List of trip data with paths and distances
@@ -8967,23 +9175,18 @@ def get_current_trips_data(public_only=True):
     trip_ids = [trip["uid"] for trip in filtered_trips]
     
     # 3. Get paths
-    formattedGetUserLines = getUserLines.format(
-        trip_ids=", ".join(("?",) * len(trip_ids))
-    )
-    with managed_cursor(pathConn) as cursor:
-        pathResult = cursor.execute(formattedGetUserLines, tuple(trip_ids)).fetchall()
-    
-    paths = {path["trip_id"]: path["path"] for path in pathResult}
+    path_arrays = load_path_arrays(trip_ids)
+    paths = dict(path_arrays.items())
     
     result = []
     for trip in filtered_trips:
-        path = json.loads(paths.get(trip["uid"], "[]"))
+        path = paths.get(trip["uid"], np.empty((0, 2)))
         result.append(
             {
                 "username": trip["username"],
                 "trip": dict(trip),
-                "path": path,
-                "distances": getDistanceFromPath(path),
+                "path": format_path(path, path_format),
+                "distances": getDistanceFromPathArray(path),
             }
         )
     
@@ -8993,7 +9196,7 @@ def get_current_trips_data(public_only=True):
 @app.route("/public/current_trips")
 def get_public_current_trips():
     """Get all currently active trips from public users."""
-    result = get_current_trips_data(public_only=True)
+    result = get_current_trips_data(public_only=True, path_format=get_path_format())
     return jsonify(result)
 
 
@@ -9001,7 +9204,7 @@ def get_public_current_trips():
 @owner_required
 def get_all_current_trips():
     """Get all currently active trips (admin/owner access required)."""
-    result = get_current_trips_data(public_only=False)
+    result = get_current_trips_data(public_only=False, path_format=get_path_format())
     return jsonify(result)
 
 
@@ -9135,5 +9338,6 @@ with app.app_context():
     authDb.create_all()
 with managed_cursor(pathConn) as cursor:
     cursor.execute(initPath)
+    cursor.execute(initSimplifiedPaths)
 
 setup_db()
@@ -1,4 +1,10 @@
-import sqlite3
+import datetime
+import threading
+import time
+
+import numpy as np
+
+from src.db_connections import connect
 
 
 def get_available_currencies():
@@ -38,57 +44,143 @@ def get_available_currencies():
     return available_currencies
 
 
+class ExchangeRates:
+    """
+    In-memory copy of the ECB exchanges table
+
+    Rates are held in a dates x currencies NumPy matrix of units per euro, loaded
+    once per process and reloaded after a currency update or when older than
+    `ttl` seconds (to pick up updates run by other processes).
+    """
+
+    def __init__(self, db_path="databases/main.db", ttl=3600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._data = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def reload(self):
+        conn = connect(self.db_path, read_only=True)
+        try:
+            cursor = conn.execute("SELECT * FROM exchanges ORDER BY rate_date")
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        currencies = ["EUR"] + [column for column in columns if column != "rate_date"]
+        dates = np.array([str(row[0]) for row in rows])
+        rates = np.ones((len(rows), len(currencies)), dtype=np.float64)
+        if rows:
+            rates[:, 1:] = np.array(
+                [row[1:] for row in rows], dtype=np.float64
+            )  # NULL rates become NaN
+        index = {currency: i for i, currency in enumerate(currencies)}
+
+        # Swap everything at once for concurrent readers
+        self._data = (dates, rates, index)
+        self._loaded_at = time.monotonic()
+
+    def _get_data(self):
+        if self._data is None or time.monotonic() - self._loaded_at > self.ttl:
+            with self._lock:
+                if self._data is None or time.monotonic() - self._loaded_at > self.ttl:
+                    self.reload()
+        return self._data
+
+    @staticmethod
+    def _date_key(date):
+        """
+        Return the value the date is compared to, as SQLite compares it with the
+        text rate_date column: numbers sort before any date, None matches nothing
+        """
+        if date is None:
+            return None
+        if isinstance(date, (int, float)):
+            return ""
+        if isinstance(date, datetime.datetime):
+            return date.isoformat(" ")
+        if isinstance(date, datetime.date):
+            return date.isoformat()
+        return str(date)
+
+    def _date_indices(self, dates, date_keys):
+        """
+        Return the index of the closest rate date for every date: the last one on
+        or before it, or the first one after it. -1 when there is none.
+        """
+        if len(dates) == 0:
+            return np.full(len(date_keys), -1, dtype=np.int64)
+        known = np.array([key is not None for key in date_keys], dtype=bool)
+        keys = np.array([key if key is not None else "" for key in date_keys])
+        indices = np.searchsorted(dates, keys, side="right") - 1
+        indices[indices < 0] = 0
+        indices[~known] = -1
+        return indices
+
+    def rates(self, base_currencies, target_currency, dates):
+        """
+        Return the array of conversion rates from each base currency to the target
+        currency at the matching date, NaN when unknown
+        """
+        rate_dates, rates, index = self._get_data()
+        date_indices = self._date_indices(
+            rate_dates, [self._date_key(date) for date in dates]
+        )
+        base_indices = np.array(
+            [index.get(currency, -1) for currency in base_currencies], dtype=np.int64
+        )
+        target_index = index.get(target_currency, -1)
+
+        result = np.full(len(date_indices), np.nan)
+        valid = (date_indices >= 0) & (base_indices >= 0) & (target_index >= 0)
+        if valid.any():
+            base_rates = rates[date_indices[valid], base_indices[valid]]
+            target_rates = rates[date_indices[valid], target_index]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result[valid] = np.where(
+                    base_rates != 0, (1 / base_rates) * target_rates, np.nan
+                )
+        return result
+
+    def convert(self, price, base_currency, target_currency, date):
+        """
+        Convert a price, returns None when no rate is available
+        """
+        rate = self.rates([base_currency], target_currency, [date])[0]
+        if np.isnan(rate):
+            return None
+        return round(float(price) * rate, 2)
+
+
+exchange_rates = ExchangeRates()
+
+
 def get_exchange_rate(price, base_currency, target_currency, date):
     # Return the unconverted price if the base and target currencies are the same
     if base_currency == target_currency:
         return price
 
-    # Ensure the price is a float
-    price = float(price)
-    db_path = "databases/main.db"
-
-    # Attempt to connect to the SQLite database
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-    except sqlite3.Error as e:
-        print(f"Database connection error: {e}")
-        return None
-
-    # Select the closest date for the rate, either before or after the given date
-    date_query = """
-        SELECT 
-            COALESCE(MAX(rate_date) FILTER (WHERE rate_date <= ?), MIN(rate_date) FILTER (WHERE rate_date >= ?)) AS relevant_date
-        FROM exchanges;
+    return exchange_rates.convert(price, base_currency, target_currency, date)
+
+
+def convert_many(prices, base_currencies, target_currency, dates):
     """
-    cursor.execute(date_query, (date, date))
-    relevant_date = cursor.fetchone()[0]
-
-    if relevant_date:
-        # Fetch the rates for the closest date, using SQL parameters to handle the currency codes properly
-        rate_query = f"""
-            SELECT 
-                ({"1" if base_currency == "EUR" else f'"{base_currency}"'}) AS base_rate,
-                ({"1" if target_currency == "EUR" else f'"{target_currency}"'}) AS target_rate
-            FROM exchanges
-            WHERE rate_date = ?;
-        """
-        cursor.execute(rate_query, (relevant_date,))
-        row = cursor.fetchone()
-
-        if row:
-            base_rate, target_rate = (float(row[0]), float(row[1]))
-
-            if base_currency == "EUR":
-                rate = target_rate
-            elif target_currency == "EUR":
-                rate = 1 / base_rate if base_rate != 0 else None
-            else:
-                rate = (1 / base_rate * target_rate) if base_rate != 0 else None
-
-            if rate is not None:
-                converted_price = round(price * rate, 2)
-                conn.close()
-                return converted_price
-    conn.close()
-    return None
+    Batch version of get_exchange_rate, converting all the prices in one pass over
+    the rate matrix. Returns a list with None where no rate is available.
+    """
+    prices = list(prices)
+    base_currencies = list(base_currencies)
+    rates = exchange_rates.rates(base_currencies, target_currency, dates)
+    amounts = np.array([float(price) for price in prices], dtype=np.float64) * rates
+
+    converted = []
+    for price, base_currency, amount in zip(prices, base_currencies, amounts.tolist()):
+        if base_currency == target_currency:
+            converted.append(price)
+        elif np.isnan(amount):
+            converted.append(None)
+        else:
+            converted.append(round(amount, 2))
+    return converted
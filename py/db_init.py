@@ -182,6 +182,53 @@ def init_main(path):
         ("cc", "TEXT NOT NULL"),
         ("percent", "INTEGER NOT NULL"),
     ]
+    trip_regions_columns = [
+        ("trip_id", "INTEGER NOT NULL"),
+        ("cc", "TEXT NOT NULL"),
+        ("region_ids", "TEXT NOT NULL"),
+    ]
+    trip_bounds_columns = [
+        ("trip_id", "INTEGER NOT NULL"),
+        ("north_lat", "FLOAT NOT NULL"),
+        ("north_lng", "FLOAT NOT NULL"),
+        ("west_lat", "FLOAT NOT NULL"),
+        ("west_lng", "FLOAT NOT NULL"),
+        ("south_lat", "FLOAT NOT NULL"),
+        ("south_lng", "FLOAT NOT NULL"),
+        ("east_lat", "FLOAT NOT NULL"),
+        ("east_lng", "FLOAT NOT NULL"),
+    ]
+    visited_squares_columns = [
+        ("username", "TEXT NOT NULL"),
+        ("lat", "INTEGER NOT NULL"),
+        ("lng", "INTEGER NOT NULL"),
+        ("stopped", "INTEGER NOT NULL DEFAULT 0"),
+        ("passed", "INTEGER NOT NULL DEFAULT 0"),
+        ("air", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+    visited_squares_sync_columns = [
+        ("username", "TEXT NOT NULL"),
+        ("synced_until", "DATETIME NOT NULL"),
+    ]
+    pg_outbox_columns = [
+        ("uid", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+        ("query_name", "TEXT NOT NULL"),
+        ("params", "TEXT NOT NULL"),
+        ("created", "REAL NOT NULL"),
+        ("attempts", "INTEGER NOT NULL"),
+        ("next_attempt_at", "REAL"),
+        ("claimed_until", "REAL"),
+        ("last_error", "TEXT"),
+    ]
+    reference_versions_columns = [
+        ("table_name", "TEXT NOT NULL"),
+        ("version", "INTEGER NOT NULL"),
+    ]
+    map_versions_columns = [
+        ("username", "TEXT NOT NULL"),
+        ("version", "INTEGER NOT NULL"),
+        ("updated_at", "DATETIME NOT NULL"),
+    ]
     currency_columns = [
         ("rate_date", "DATE NOT NULL UNIQUE"),
         ("AUD", "FLOAT"),
@@ -302,6 +349,13 @@ def init_main(path):
         ("trip", "uid", trip_columns),
         ("manual_stations", "uid", manual_stations_columns),
         ("percents", "uid", percents_columns),
+        ("trip_regions", "trip_id, cc", trip_regions_columns),
+        ("trip_bounds", "trip_id", trip_bounds_columns),
+        ("visited_squares", "username, lat, lng", visited_squares_columns),
+        ("visited_squares_sync", "username", visited_squares_sync_columns),
+        ("map_versions", "username", map_versions_columns),
+        ("reference_versions", "table_name", reference_versions_columns),
+        ("pg_outbox", "uid", pg_outbox_columns),
         ("exchanges", "rate_date", currency_columns),
         ("tickets", "uid", tickets_columns),
         ("tags", "tag_id", tags_columns),
@@ -22,38 +22,116 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-from geopip._geopip import GeoPIP
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from shapely.strtree import STRtree
 
 __all__ = [
-    "GeoPIP",
+    "RegionIndex",
     "instance",
     "search",
+    "search_many",
 ]
 
-_INSTANCE = {}
+# Maximum number of countries kept in memory by each process
+MAX_INSTANCES = int(os.environ.get("REGION_INDEX_MAX_INSTANCES", 8))
+
+_INSTANCE = OrderedDict()
+_LOCK = threading.Lock()
+
+
+def region_file(cc):
+    return f"country_percent/countries/processed/{cc}.geojson"
+
+
+class RegionIndex(object):
+    """Point in polygon index over the subdivision polygons of one country
+
+    The polygons are prepared and stored in an STRtree, so that a batch of points
+    can be resolved with a single query.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        features = [
+            feat
+            for feat in data["features"]
+            if feat["geometry"]["type"] in ("Polygon", "MultiPolygon")
+        ]
+        self._source = filename
+        self._mtime = os.path.getmtime(filename)
+        self._properties = [feat["properties"] for feat in features]
+        self._shapes = [shape(feat["geometry"]) for feat in features]
+        for shp in self._shapes:
+            shapely.prepare(shp)
+        self._tree = STRtree(self._shapes)
+
+    def __str__(self):
+        return "RegionIndex from {}: {} polygons".format(
+            self._source, len(self._shapes)
+        )
+
+    def is_stale(self):
+        return os.path.getmtime(self._source) != self._mtime
+
+    def search_many(self, lngs, lats):
+        """Return the `properties` of the first polygon containing each point,
+        `None` for the points outside of every polygon.
+        """
+        points = shapely.points(np.asarray(lngs), np.asarray(lats))
+        point_index, shape_index = self._tree.query(points, predicate="within")
+
+        # keep the first matching polygon of every point
+        first_shape = np.full(len(points), len(self._shapes))
+        np.minimum.at(first_shape, point_index, shape_index)
+
+        return [
+            self._properties[index] if index < len(self._shapes) else None
+            for index in first_shape.tolist()
+        ]
+
+    def search(self, lng, lat):
+        return self.search_many([lng], [lat])[0]
 
 
 def instance(cc):  # noqa: E302
-    """Singleton GeoPIP instance (lazy loading) per cc
+    """RegionIndex instance (lazy loading) per cc
+
+    At most MAX_INSTANCES countries are kept, the least recently used one is evicted
+    first. An instance is reloaded if its geojson file was edited since.
 
-    Is used in the `search` function.
+    Is used in the `search` and `search_many` functions.
     """
-    global _INSTANCE
+    with _LOCK:
+        index = _INSTANCE.get(cc)
+        if index is not None and not index.is_stale():
+            _INSTANCE.move_to_end(cc)
+            return index
 
-    # Check if instance for this cc already exists
-    if cc in _INSTANCE:
-        return _INSTANCE[cc]
+    # build outside of the lock, loading big countries takes a while
+    index = RegionIndex(filename=region_file(cc))
 
-    # If not, create a new instance for this cc
-    _INSTANCE[cc] = GeoPIP(filename=f"country_percent/countries/processed/{cc}.geojson")
+    with _LOCK:
+        _INSTANCE[cc] = index
+        _INSTANCE.move_to_end(cc)
+        while len(_INSTANCE) > MAX_INSTANCES:
+            _INSTANCE.popitem(last=False)
 
-    return _INSTANCE[cc]
+    return index
 
 
 def search(cc, lng, lat):
-    """Reverse geocode lng/lat coordinate within the features from `instance().shapes`.
+    """Reverse geocode lng/lat coordinate within the subdivisions of country `cc`.
 
-    Look within the features from the `instance().shapes` function for a polygon that
+    Look within the polygons of `instance(cc)` for a polygon that
     contains the point (lng, lat). From the first found feature the `porperties`
     will be returned. `None`, if no feature containes the point.
 
@@ -65,3 +143,18 @@ def search(cc, lng, lat):
         Dict[Any, Any]  `Properties` of found feature. `None` if nothing is found.
     """
     return instance(cc).search(lng, lat)
+
+
+def search_many(cc, coords):
+    """Reverse geocode many coordinates within the subdivisions of country `cc`.
+
+    Parameters:
+        cc: str                      Country or region code of the geojson file.
+        coords: ArrayLike[float]     (n, 2) array of [lat, lng] points. (WGS84)
+
+    Returns:
+        List[Dict[Any, Any]]  `Properties` of the found feature for every point,
+                              `None` where nothing is found.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    return instance(cc).search_many(lngs=coords[:, 1], lats=coords[:, 0])
@@ -22,16 +22,21 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
+import numpy as np
+import shapely
 from geopip._geopip import GeoPIP
+from shapely.strtree import STRtree
 
 __all__ = [
     "GeoPIP",
     "instance",
     "search",
     "search_all",
+    "search_many",
 ]
 
 _INSTANCE = None
+_TREE = None
 
 
 def instance():  # noqa: E302
@@ -81,3 +86,57 @@ def search(lng, lat):
         Dict[Any, Any]  `Properties` of found feature. `None` if nothing is found.
     """
     return instance().search(lng, lat)
+
+
+def tree():
+    """Singleton STRtree over the polygons of `instance().shapes` (lazy loading)
+
+    The polygons are reused from the GeoPIP instance, and ordered the way `search`
+    visits them (finest geohash first), so that `search_many` returns the same
+    feature as `search` for every point.
+
+    Is used in the `search_many` function.
+    """
+    global _TREE
+    if _TREE is not None:
+        return _TREE
+
+    # sorted() is stable, shapes sharing a geohash keep their order
+    shapes = sorted(
+        (shp for shps in instance().shapes.values() for shp in shps),
+        key=lambda shp: -len(shp["geohash"]),
+    )
+    _TREE = (
+        STRtree([shp["shape"].context for shp in shapes]),
+        [shp["properties"] for shp in shapes],
+    )
+
+    return _TREE
+
+
+def search_many(lngs, lats):
+    """Reverse geocode many lng/lat coordinates at once.
+
+    Same as calling `search` for every point, but all points are resolved with a
+    single bulk query on an STRtree.
+
+    Parameters:
+        lngs: ArrayLike[float]  Longitudes (-180, 180) of the points. (WGS84)
+        lats: ArrayLike[float]  Latitudes (-90, 90) of the points. (WGS84)
+
+    Returns:
+        List[Dict[Any, Any]]  `Properties` of the found feature for every point,
+                              `None` where nothing is found.
+    """
+    shapes_tree, properties = tree()
+    points = shapely.points(np.asarray(lngs), np.asarray(lats))
+    point_index, shape_index = shapes_tree.query(points, predicate="within")
+
+    # keep the first matching shape of every point
+    first_shape = np.full(len(points), len(properties))
+    np.minimum.at(first_shape, point_index, shape_index)
+
+    return [
+        properties[index] if index < len(properties) else None
+        for index in first_shape.tolist()
+    ]
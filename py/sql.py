@@ -1,8 +1,10 @@
 # Load SQL queries as variables
 
 initPath = open("sql/initPath.sql", "r").read()
+initSimplifiedPaths = open("sql/initSimplifiedPaths.sql", "r").read()
 saveQuery = open("sql/save.sql", "r").read()
 getTrip = open("sql/getTrip.sql", "r").read()
+getTripsByIds = open("sql/getTripsByIds.sql", "r").read()
 getTripsCountry = open("sql/getTripsCountry.sql", "r").read()
 updateTripQuery = open("sql/updateTrip.sql", "r").read()
 updatePath = open("sql/updatePath.sql", "r").read()
@@ -75,6 +77,7 @@ distinctStatYears = open("sql/stats/distinctStatYears.sql", "r").read()
 getTickets = open("sql/getTickets.sql", "r").read()
 getTags = open("sql/getTags.sql", "r").read()
 getTicket = open("sql/getTicket.sql", "r").read()
+getTicketsByIds = open("sql/getTicketsByIds.sql", "r").read()
 getDynamicUserTrips = open("sql/getDynamicUserTrips.sql", "r").read()
 getNumberStations = open("sql/getNumberStations.sql", "r").read()
 countriesLeaderboard = open("sql/stats/countriesLeaderboard.sql", "r").read()
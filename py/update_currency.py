@@ -1,95 +1,76 @@
 import csv
 import io
+import logging
 import sqlite3
 import zipfile
 from datetime import datetime, timedelta
 
 import requests
 
-
-def fill_missing_rates(db_path, table_name):
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Identify columns with NULL values
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = [info[1] for info in cursor.fetchall()]
-
-    for col in columns:
-        # Fill NULL values where a previous value exists
-        update_query_with_previous = f"""
-        UPDATE {table_name}
-        SET {col} = (
-            SELECT {col}
-            FROM (
-                SELECT {col}, ROWID
-                FROM {table_name}
-                WHERE {col} IS NOT NULL
-            ) AS valid_values
-            WHERE valid_values.ROWID < {table_name}.ROWID
-            ORDER BY valid_values.ROWID DESC
-            LIMIT 1
-        )
-        WHERE {col} IS NULL AND EXISTS (
-            SELECT 1
-            FROM {table_name} as prev
-            WHERE prev.{col} IS NOT NULL AND prev.ROWID < {table_name}.ROWID
-        );
-        """
-        cursor.execute(update_query_with_previous)
-
-        # Fill remaining NULL values using the oldest non-null value if no previous values exist
-        update_query_with_oldest = f"""
-        UPDATE {table_name}
-        SET {col} = (
-            SELECT {col} FROM {table_name} WHERE {col} IS NOT NULL ORDER BY ROWID ASC LIMIT 1
-        )
-        WHERE {col} IS NULL;
-        """
-        cursor.execute(update_query_with_oldest)
-
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
-
-
-def get_complete_days(db_path):
+from py.currency import exchange_rates
+from src.pg import pg_session
+
+logger = logging.getLogger(__name__)
+
+# Currencies tracked in the exchanges table, against EUR
+SELECTED_CURRENCIES = [
+    "AUD",
+    "BGN",
+    "BRL",
+    "CAD",
+    "CHF",
+    "CNY",
+    "CZK",
+    "DKK",
+    "GBP",
+    "HKD",
+    "HUF",
+    "IDR",
+    "ILS",
+    "INR",
+    "ISK",
+    "JPY",
+    "KRW",
+    "MXN",
+    "MYR",
+    "NOK",
+    "NZD",
+    "PHP",
+    "PLN",
+    "RON",
+    "SEK",
+    "SGD",
+    "THB",
+    "TRY",
+    "USD",
+    "ZAR",
+]
+
+def get_last_rates(db_path, currencies):
     """
-    Fetches a list of dates from the exchanges table where the
-    number of records for each date equals 342.
+    Fetches the most recent row of the exchanges table.
 
     Parameters:
     - db_path (str): The path to the SQLite database file.
+    - currencies (list): The currency columns to read.
 
     Returns:
-    - complete_days (list of str): A list of dates (as strings) matching the criteria.
+    - (rate_date, rates) with rates in the order of `currencies`, or None if the
+      table is empty.
     """
-    # Connect to the SQLite database
     connection = sqlite3.connect(db_path)
-    cursor = connection.cursor()
-
-    # SQL query to select rate dates having exactly 342 records
-    query = """
-        SELECT DISTINCT(rate_date)
+    row = connection.execute(
+        f"""
+        SELECT rate_date, {", ".join(currencies)}
         FROM exchanges
         ORDER BY rate_date DESC
-    """
-
-    # Execute the query
-    cursor.execute(query)
-
-    # Fetch all results
-    results = cursor.fetchall()
-
-    # Close the connection to the database
+        LIMIT 1
+        """
+    ).fetchone()
     connection.close()
-
-    # Extract dates from the results
-    # Each item in results is a tuple, where the first element is the rate_date
-    complete_days = [result[0] for result in results]
-
-    return complete_days
+    if row is None:
+        return None
+    return row[0], list(row[1:])
 
 
 def download_and_unzip(url):
@@ -128,126 +109,182 @@ def download_and_unzip(url):
         )
 
 
-# Function to generate a complete list of dates between two dates
-def generate_date_series(start_date_str, end_date_str):
-    start_date = datetime.strptime(start_date_str, "%Y-%m-%d").date()
-    end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
-
-    current_date = start_date
-    while current_date <= end_date:
-        yield current_date
-        current_date += timedelta(days=1)
-
-
-def get_rates_from_bottom_in_memory(csv_content, selected_currencies):
+def get_rates_from_bottom_in_memory(csv_content, selected_currencies, since=None):
     """
     Parses CSV content from a string and gets exchange rates for specific currencies
     from bottom to top.
 
+    The ECB file lists the most recent days first, so when `since` is given the
+    parsing stops at the first day on or before it and only the new days are read.
+
     Parameters:
     - csv_content (str): The content of the CSV file as a string.
     - selected_currencies (list): A list of currency codes to retrieve rates for.
+    - since (str): Optional YYYY-MM-DD date, only the days after it are returned.
 
     Returns:
     - all_rates (dict): A dictionary with dates as keys and another dictionary of currencies
       and their rates as values.
-    - all_rates_dates (list): A list of dates for which rates are available.
+    - all_rates_dates (list): A list of dates for which rates are available, oldest first.
     """
     all_rates_dates = []
     all_rates = {}
-    file_like_object = io.StringIO(csv_content)
-    csv_reader = list(csv.DictReader(file_like_object))
-    for row in reversed(csv_reader):
+    csv_reader = csv.DictReader(io.StringIO(csv_content))
+    for row in csv_reader:
+        if since is not None and row["Date"] <= since:
+            break
         rates = {}
         for currency in selected_currencies:
             rates[currency] = float(row[currency]) if row[currency] != "N/A" else None
         all_rates_dates.append(row["Date"])
         all_rates[row["Date"]] = rates
+    all_rates_dates.reverse()
     return all_rates, all_rates_dates
 
 
-def process_currency_combinations_daily(db_path, all_rates, all_rates_dates):
+def build_daily_rates(all_rates, all_rates_dates, currencies, previous=None):
+    """
+    Builds one row of rates per calendar day, up to the last ECB day.
+
+    Days without rates (weekends, bank holidays) and currencies without a rate on
+    a given day take the last known rate. Currencies published after the start of
+    the history take their first known rate before that.
+
+    Parameters:
+    - all_rates, all_rates_dates: As returned by get_rates_from_bottom_in_memory.
+    - currencies (list): The currency columns, in order.
+    - previous: Optional (rate_date, rates) last stored row, the rows then start the
+      day after it and carry its rates forward.
+
+    Returns:
+    - rows (list): [rate_date, rate, ...] lists, in chronological order.
+    """
+    if not all_rates_dates:
+        return []
+
+    if previous is not None:
+        start_date = datetime.strptime(previous[0], "%Y-%m-%d").date() + timedelta(days=1)
+        last_rates = list(previous[1])
+    else:
+        start_date = datetime.strptime(all_rates_dates[0], "%Y-%m-%d").date()
+        last_rates = [None] * len(currencies)
+    end_date = datetime.strptime(all_rates_dates[-1], "%Y-%m-%d").date()
+
+    rows = []
+    current_date = start_date
+    while current_date <= end_date:
+        rate_date = current_date.strftime("%Y-%m-%d")
+        rates = all_rates.get(rate_date)
+        if rates is not None:
+            last_rates = [
+                rates[currency] if rates[currency] is not None else last_rate
+                for currency, last_rate in zip(currencies, last_rates)
+            ]
+        rows.append([rate_date] + last_rates)
+        current_date += timedelta(days=1)
+
+    for col in range(1, len(currencies) + 1):
+        first_rate = next((row[col] for row in rows if row[col] is not None), None)
+        for row in rows:
+            if row[col] is not None:
+                break
+            row[col] = first_rate
+
+    return rows
+
+
+def store_daily_rates(db_path, rows, currencies):
+    """
+    Inserts the daily rows in the exchanges table in a single transaction, days
+    already present are left untouched.
+
+    Returns:
+    - last_registered_date (str): The most recent day of the table.
+    """
     connection = sqlite3.connect(db_path)
-    cursor = connection.cursor()
-
-    time_series = generate_date_series(all_rates_dates[0], all_rates_dates[-1])
-    complete_days = get_complete_days(db_path)
-    filtered_time_series = [
-        date
-        for date in time_series
-        if datetime.strftime(date, "%Y-%m-%d") not in complete_days
-    ]
-
-    for date in filtered_time_series:
-        rate_date = datetime.strftime(date, "%Y-%m-%d")
-
-        # Determine which date to use for rates based on availability
-        if rate_date in all_rates:
-            use_date = rate_date
-        elif datetime.strftime(date + timedelta(days=-1), "%Y-%m-%d") in all_rates:
-            use_date = datetime.strftime(date + timedelta(days=-1), "%Y-%m-%d")
-        elif datetime.strftime(date + timedelta(days=-2), "%Y-%m-%d") in all_rates:
-            use_date = datetime.strftime(date + timedelta(days=-2), "%Y-%m-%d")
-        else:
-            continue  # Skip this date if no rates are available
-
-        rates = all_rates[use_date]
-        columns = ", ".join(rates.keys())  # Get all currency column names from rates
-        placeholders = ", ".join(["?" for _ in rates])  # Create placeholders for values
-        values = [rates[currency] for currency in rates]  # Get all currency values
-        query = f"INSERT OR IGNORE INTO exchanges (rate_date, {columns}) VALUES (?, {placeholders})"
-        cursor.execute(query, [rate_date] + values)
-        connection.commit()
-    fill_missing_rates(db_path, "exchanges")
-
-    last_registered_date = cursor.execute(
+    with connection:
+        connection.executemany(
+            f"""
+            INSERT OR IGNORE INTO exchanges (rate_date, {", ".join(currencies)})
+            VALUES (?, {", ".join(["?"] * len(currencies))})
+            """,
+            rows,
+        )
+    last_registered_date = connection.execute(
         "SELECT rate_date FROM exchanges ORDER BY rate_date DESC LIMIT 1;"
     ).fetchone()[0]
     connection.close()
     return last_registered_date
 
 
-def run_currency_update():
+def sync_exchanges_to_pg(db_path, currencies, full=False):
+    """
+    Copy the rates of main.db to the pg exchanges table with COPY, so that price
+    conversions can be done inside pg queries. Only the days after the last one
+    in pg are copied, unless `full` is set in which case the table is replaced.
+    """
+    with pg_session() as pg:
+        if full:
+            pg.execute("TRUNCATE exchanges")
+            since = None
+        else:
+            since = pg.execute("SELECT MAX(rate_date) FROM exchanges").scalar()
+
+        connection = sqlite3.connect(db_path)
+        rows = connection.execute(
+            f"""
+            SELECT rate_date, {", ".join(currencies)}
+            FROM exchanges
+            WHERE ? IS NULL OR rate_date > ?
+            """,
+            (since and since.isoformat(),) * 2,
+        ).fetchall()
+        connection.close()
+
+        csv_buf = io.StringIO()
+        writer = csv.writer(csv_buf)
+        for rate_date, *rates in rows:
+            for currency, rate in zip(currencies, rates):
+                if rate is not None:
+                    writer.writerow((rate_date, currency, rate))
+        csv_buf.seek(0)
+
+        cursor = pg.connection().connection.cursor()
+        cursor.copy_expert(
+            "COPY exchanges (rate_date, currency, rate) FROM STDIN WITH (FORMAT csv)",
+            csv_buf,
+        )
+    logger.info(f"Copied the exchange rates of {len(rows)} days to pg")
+
+
+def run_currency_update(full=False):
+    """
+    Fetch the ECB reference rates and add the missing days to the exchanges table.
+
+    By default only the days after the last stored one are parsed and written.
+    With `full`, the whole history is parsed again, filling any gap in the table,
+    and the pg copy is rebuilt.
+    """
     # Database path
     db_path = "databases/main.db"
 
-    # List of selected currencies
-    selected_currencies = [
-        "AUD",
-        "BGN",
-        "BRL",
-        "CAD",
-        "CHF",
-        "CNY",
-        "CZK",
-        "DKK",
-        "GBP",
-        "HKD",
-        "HUF",
-        "IDR",
-        "ILS",
-        "INR",
-        "ISK",
-        "JPY",
-        "KRW",
-        "MXN",
-        "MYR",
-        "NOK",
-        "NZD",
-        "PHP",
-        "PLN",
-        "RON",
-        "SEK",
-        "SGD",
-        "THB",
-        "TRY",
-        "USD",
-        "ZAR",
-    ]
+    previous = None if full else get_last_rates(db_path, SELECTED_CURRENCIES)
 
     url = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip"
     unzipped_file = download_and_unzip(url)
     all_rates, all_rates_dates = get_rates_from_bottom_in_memory(
-        unzipped_file, selected_currencies
+        unzipped_file,
+        SELECTED_CURRENCIES,
+        since=previous[0] if previous is not None else None,
     )
-    return process_currency_combinations_daily(db_path, all_rates, all_rates_dates)
+    rows = build_daily_rates(all_rates, all_rates_dates, SELECTED_CURRENCIES, previous)
+    if not rows and previous is not None:
+        return previous[0]
+
+    last_registered_date = store_daily_rates(db_path, rows, SELECTED_CURRENCIES)
+    exchange_rates.reload()
+    try:
+        sync_exchanges_to_pg(db_path, SELECTED_CURRENCIES, full=full)
+    except Exception:
+        logger.exception("Could not copy the exchange rates to pg")
+    return last_registered_date
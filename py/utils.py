@@ -6,9 +6,9 @@ import unicodedata
 from urllib.request import urlopen
 from datetime import datetime, timezone
 
+import numpy as np
 import pycountry
 import yaml
-from geopy.distance import geodesic
 
 from py import geopip_perso
 
@@ -213,23 +213,122 @@ def getDistance(orig, dest):
     return distance
 
 
-def getCountriesFromPath(path, type, routing_details=None, powerType=None):
-    countries = {}
-    country = None
+def segment_distances(coords):
+    """
+    Vectorized version of getDistance over consecutive points.
+
+    Takes an (n, 2) array of [lat, lng] and returns the n - 1 segment lengths in meters.
+    """
+    R = 6373000.0
+    coords = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    lat1, lon1 = coords[:-1, 0], coords[:-1, 1]
+    lat2, lon2 = coords[1:, 0], coords[1:, 1]
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
+def getDistanceFromPathArray(coords):
+    """
+    Vectorized version of getDistanceFromPath for an (n, 2) array of [lat, lng]
+    """
+    if len(coords) == 0:
+        return []
+    distances = np.zeros(len(coords), dtype=np.int64)
+    np.cumsum(segment_distances(coords).astype(np.int64), out=distances[1:])
+    return distances.tolist()
+
+
+def getCountryCodesFromCoordinates(coords):
+    """
+    Bulk version of getCountryFromCoordinates for an (n, 2) array of [lat, lng].
+
+    Returns an object array with the country code of every point, None where the
+    point is in no country.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    found = geopip_perso.search_many(lngs=coords[:, 1], lats=coords[:, 0])
+    return np.array(
+        [country["countryCode"] if country else None for country in found],
+        dtype=object,
+    )
+
+
+# Maximum gap between two sample points of getCountryCodesAlongPath
+COUNTRY_SAMPLE_MAX_POINTS = 64
+COUNTRY_SAMPLE_MAX_DISTANCE = 5000  # meters
+
+
+def getCountryCodesAlongPath(coords, positions):
+    """
+    Same result as getCountryCodesFromCoordinates for consecutive points of a path,
+    with far fewer point-in-polygon lookups.
+
+    Only sample points (at most COUNTRY_SAMPLE_MAX_POINTS points or
+    COUNTRY_SAMPLE_MAX_DISTANCE meters apart) are looked up. Between two samples in
+    the same country, all points are assumed to be in that country; between two
+    samples in different countries, the border crossing is found by bisection.
+
+    `positions` is the distance of every point from the start of the path.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    codes = np.empty(len(coords), dtype=object)
+    known = np.zeros(len(coords), dtype=bool)
+    if len(coords) == 0:
+        return codes
+
+    def lookup(indices):
+        codes[indices] = getCountryCodesFromCoordinates(coords[indices])
+        known[indices] = True
+
+    point_index = np.arange(len(coords))
+    bucket = (np.asarray(positions) // COUNTRY_SAMPLE_MAX_DISTANCE).astype(np.int64)
+    is_sample = point_index % COUNTRY_SAMPLE_MAX_POINTS == 0
+    is_sample[-1] = True
+    is_sample[1:] |= bucket[1:] != bucket[:-1]
+    samples = np.flatnonzero(is_sample)
+    lookup(samples)
+
+    # Bisect all the intervals with a border crossing, one bulk lookup per round
+    low, high = samples[:-1], samples[1:]
+    while True:
+        crossing = (codes[low] != codes[high]) & (high - low > 1)
+        if not crossing.any():
+            break
+        low, high = low[crossing], high[crossing]
+        middle = (low + high) // 2
+        lookup(middle)
+        low, high = np.concatenate([low, middle]), np.concatenate([middle, high])
+
+    # Remaining points are between two samples in the same country
+    last_known = np.maximum.accumulate(np.where(known, point_index, 0))
+    return codes[last_known]
+
+
+def getCountriesFromPath(
+    path, type, routing_details=None, powerType=None, sampled=True
+):
+    """
+    Return the JSON distance breakdown (in meters) of the path per country, split
+    between electrified and non electrified sections for trains when known.
+
+    With `sampled`, countries are looked up with getCountryCodesAlongPath instead
+    of for every point.
+    """
+    coords = np.array([[node["lat"], node["lng"]] for node in path], dtype=np.float64)
+    distances = segment_distances(coords)
+
     if type in ["air", "helicopter"]:
-        total_distance = 0
-        for index in range(1, len(path)):
-            total_distance += getDistance(path[index - 1], path[index])
-        start_country_data = getCountryFromCoordinates(
-            lat=path[0]["lat"], lng=path[0]["lng"]
-        )
-        end_country_data = getCountryFromCoordinates(
-            lat=path[-1]["lat"], lng=path[-1]["lng"]
-        )
-        start_country = (
-            start_country_data["countryCode"] if start_country_data else "UN"
-        )
-        end_country = end_country_data["countryCode"] if end_country_data else "UN"
+        countries = {}
+        total_distance = float(distances.sum())
+        start_country, end_country = getCountryCodesFromCoordinates(
+            coords[[0, -1]]
+        ).tolist()
+        start_country = start_country or "UN"
+        end_country = end_country or "UN"
         countries[start_country] = total_distance / 2
         countries[end_country] = countries.get(end_country, 0) + total_distance / 2
         return json.dumps(countries)
@@ -248,70 +347,74 @@ def getCountriesFromPath(path, type, routing_details=None, powerType=None):
          (routing_details and (power_type != "auto" or "electrified" in routing_details)))
     )
    
-    # Create electrification lookup for train routes (only used when power_type is "auto")
-    electrification_map = {}
-    if use_electrification and power_type == "auto" and routing_details:
-        for elec_segment in routing_details["electrified"]:
-            start_idx, end_idx, elec_type = elec_segment
-            for i in range(start_idx, end_idx):
-                electrification_map[i] = elec_type
-   
-    for index in range(1, len(path)):
-        segment_distance = getDistance(path[index - 1], path[index])
-       
-        # Determine electrification status for this segment
-        is_electrified = False
-        if use_electrification:
-            if power_type == "electric":
-                is_electrified = True
-            elif power_type == "thermic":
-                is_electrified = False
-            elif power_type == "auto" and index - 1 in electrification_map:
-                elec_status = electrification_map[index - 1]
-                is_electrified = elec_status in ["contact_line", "rail", "yes"]
-       
-        if type == "ferry" and segment_distance > 10:
-            num_fake_points = int(segment_distance / 10)
-            interpolated_points = interpolate_points(
-                path[index - 1], path[index], num_fake_points
-            )
-        else:
-            interpolated_points = [path[index]]
-        segment_countries = {}
-        for node in interpolated_points:
-            precountry = getCountryFromCoordinates(lat=node["lat"], lng=node["lng"])
-            if precountry is not None:
-                country = precountry["countryCode"]
-            else:
-                if type == "ferry":
-                    country = "UN"
-                else:
-                    if country is None:
-                        country = "UN"
-            segment_countries[country] = segment_countries.get(country, 0) + 1
-        for country, count in segment_countries.items():
-            if country not in countries:
-                if use_electrification:
-                    countries[country] = {"elec": 0, "nonelec": 0}
-                else:
-                    countries[country] = 0
-           
-            segment_country_distance = (segment_distance * count) / len(interpolated_points)
-           
+    # Electrification status of every segment
+    is_electrified = np.zeros(len(distances), dtype=bool)
+    if use_electrification:
+        if power_type == "electric":
+            is_electrified[:] = True
+        elif power_type == "auto" and routing_details:
+            for start_idx, end_idx, elec_type in routing_details["electrified"]:
+                is_electrified[start_idx:end_idx] = elec_type in [
+                    "contact_line",
+                    "rail",
+                    "yes",
+                ]
+
+    # Points to look up for every segment: its end point, or for long ferry
+    # segments, points interpolated every 10 meters (end points excluded)
+    if type == "ferry":
+        num_fake_points = np.where(distances > 10, (distances / 10).astype(np.int64), 0)
+    else:
+        num_fake_points = np.zeros(len(distances), dtype=np.int64)
+    points_per_segment = np.maximum(num_fake_points, 1)
+    point_segment = np.repeat(np.arange(len(distances)), points_per_segment)
+    point_rank = np.arange(len(point_segment)) - np.repeat(
+        np.cumsum(points_per_segment) - points_per_segment, points_per_segment
+    )
+    fraction = ((point_rank + 1) / (num_fake_points[point_segment] + 1))[:, None]
+    lookup_points = np.where(
+        (num_fake_points[point_segment] > 0)[:, None],
+        coords[point_segment] + fraction * (coords[point_segment + 1] - coords[point_segment]),
+        coords[point_segment + 1],
+    )
+
+    # Each lookup point carries an equal share of its segment
+    point_distances = (distances / points_per_segment)[point_segment]
+
+    if sampled:
+        point_countries = getCountryCodesAlongPath(
+            lookup_points, np.cumsum(point_distances)
+        )
+    else:
+        point_countries = getCountryCodesFromCoordinates(lookup_points)
+    point_countries[point_countries == None] = "UN"  # noqa: E711
+
+    # Sum the distances per country
+    point_electrified = is_electrified[point_segment]
+    countries = {}
+    if len(point_countries):
+        codes, first_index, inverse = np.unique(
+            point_countries.astype(str), return_index=True, return_inverse=True
+        )
+        elec = np.bincount(
+            inverse, weights=point_distances * point_electrified, minlength=len(codes)
+        )
+        nonelec = np.bincount(
+            inverse, weights=point_distances * ~point_electrified, minlength=len(codes)
+        )
+        # Keep the countries in the order they are crossed
+        for code_index in np.argsort(first_index).tolist():
+            country = str(codes[code_index])
             if use_electrification:
-                if is_electrified:
-                    countries[country]["elec"] += segment_country_distance
-                else:
-                    countries[country]["nonelec"] += segment_country_distance
+                countries[country] = {
+                    "elec": float(elec[code_index]),
+                    "nonelec": float(nonelec[code_index]),
+                }
             else:
-                if isinstance(countries[country], dict):
-                    countries[country] = segment_country_distance
-                else:
-                    countries[country] += segment_country_distance
+                countries[country] = float(elec[code_index] + nonelec[code_index])
    
     if countries == {}:
-        country_data = getCountryFromCoordinates(lat=path[0]["lat"], lng=path[0]["lng"])
-        country = country_data["countryCode"] if country_data else "UN"
+        country = getCountryCodesFromCoordinates(coords[:1])[0] or "UN"
         if use_electrification:
             countries = {country: {"elec": 0, "nonelec": 0}}
         else:
@@ -378,55 +481,78 @@ def interpolate_points(point1, point2, num_points):
     return interpolated
 
 
-def to_radians(deg):
-    return deg * math.pi / 180
-
-
-def to_degrees(rad):
-    return rad * 180 / math.pi
-
-
-def interpolate_great_circle(start, end, max_distance_km=50):
-    """Interpolates (lat, lon) points along the great-circle path using spherical interpolation."""
-    distance_km = geodesic(start, end).km
-    num_steps = int(distance_km // max_distance_km)
-
-    if num_steps < 1:
-        return []
+# Mean Earth radius, used to space interpolated great-circle points
+EARTH_RADIUS_KM = 6371.0088
 
-    lat1, lon1 = map(to_radians, start)
-    lat2, lon2 = map(to_radians, end)
 
-    delta_lon = lon2 - lon1
+def interpolate_great_circle_many(starts, ends, max_distance_km=50):
+    """
+    Interpolate points along the great-circle paths of many segments at once, every
+    max_distance_km (end points excluded)
 
-    # Compute angular distance between points
-    d = 2 * math.asin(
-        math.sqrt(
-            math.sin((lat2 - lat1) / 2) ** 2
-            + math.cos(lat1) * math.cos(lat2) * math.sin(delta_lon / 2) ** 2
+    `starts` and `ends` are (n, 2) arrays of [lat, lon]. Returns the interpolated
+    points as a (m, 2) array of [lat, lon] ordered by segment, and the index of the
+    segment each of them belongs to.
+    """
+    starts = np.radians(np.asarray(starts, dtype=np.float64).reshape(-1, 2))
+    ends = np.radians(np.asarray(ends, dtype=np.float64).reshape(-1, 2))
+    lat1, lon1 = starts[:, 0], starts[:, 1]
+    lat2, lon2 = ends[:, 0], ends[:, 1]
+
+    # Angular distance between the segment end points
+    d = 2 * np.arcsin(
+        np.sqrt(
+            np.sin((lat2 - lat1) / 2) ** 2
+            + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
         )
     )
+    num_steps = np.where(
+        d > 0, (d * EARTH_RADIUS_KM // max_distance_km).astype(np.int64), 0
+    )
 
-    if d == 0:
-        return []
+    segment = np.repeat(np.arange(len(d)), num_steps)
+    step = (
+        np.arange(len(segment))
+        - np.repeat(np.cumsum(num_steps) - num_steps, num_steps)
+        + 1
+    )
+    f = step / (num_steps[segment] + 1)
+    d = d[segment]
+    A = np.sin((1 - f) * d) / np.sin(d)
+    B = np.sin(f * d) / np.sin(d)
+    lat1, lon1, lat2, lon2 = lat1[segment], lon1[segment], lat2[segment], lon2[segment]
 
-    points = []
+    x = A * np.cos(lat1) * np.cos(lon1) + B * np.cos(lat2) * np.cos(lon2)
+    y = A * np.cos(lat1) * np.sin(lon1) + B * np.cos(lat2) * np.sin(lon2)
+    z = A * np.sin(lat1) + B * np.sin(lat2)
 
-    for i in range(1, num_steps + 1):
-        f = i / (num_steps + 1)
-        A = math.sin((1 - f) * d) / math.sin(d)
-        B = math.sin(f * d) / math.sin(d)
+    points = np.column_stack([np.arctan2(z, np.sqrt(x**2 + y**2)), np.arctan2(y, x)])
+    return np.degrees(points), segment
 
-        x = A * math.cos(lat1) * math.cos(lon1) + B * math.cos(lat2) * math.cos(lon2)
-        y = A * math.cos(lat1) * math.sin(lon1) + B * math.cos(lat2) * math.sin(lon2)
-        z = A * math.sin(lat1) + B * math.sin(lat2)
 
-        interp_lat = math.atan2(z, math.sqrt(x**2 + y**2))
-        interp_lon = math.atan2(y, x)
+def interpolate_great_circle(start, end, max_distance_km=50):
+    """Interpolates (lat, lon) points along the great-circle path using spherical interpolation."""
+    points, _ = interpolate_great_circle_many([start], [end], max_distance_km)
+    return [tuple(point) for point in points.tolist()]
 
-        points.append((to_degrees(interp_lat), to_degrees(interp_lon)))
 
-    return points
+def densify_path(points, max_distance_km=50):
+    """
+    Return the (n, 2) array of [lat, lon] points with great-circle points
+    interpolated in every gap longer than max_distance_km
+    """
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(coords) < 2:
+        return coords
+
+    interpolated, segment = interpolate_great_circle_many(
+        coords[:-1], coords[1:], max_distance_km
+    )
+    # Interpolated points of a segment go right after its start point
+    group = np.concatenate([np.arange(len(coords)), segment])
+    rank = np.concatenate([np.zeros(len(coords)), np.ones(len(segment))])
+    order = np.lexsort((rank, group))
+    return np.concatenate([coords, interpolated])[order]
 
 
 def interpolate_points_if_gaps(points, max_distance_km=50):
@@ -434,26 +560,7 @@ def interpolate_points_if_gaps(points, max_distance_km=50):
     if not points or len(points) < 2:
         return points
 
-    print(len(points))
-
-    interpolated = [points[0]]
-
-    for i in range(1, len(points)):
-        prev = points[i - 1]
-        curr = points[i]
-        distance = geodesic(prev, curr).km
-
-        if distance > max_distance_km:
-            # Add intermediate points
-            intermediate = interpolate_great_circle(
-                prev, curr, max_distance_km=max_distance_km
-            )
-            interpolated.extend(intermediate)
-
-        interpolated.append(curr)
-    print(len(interpolated))
-
-    return interpolated
+    return densify_path(points, max_distance_km).tolist()
 
 
 def time_ago(dt):
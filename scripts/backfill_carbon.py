@@ -5,8 +5,8 @@ import logging
 from src.pg import pg_session
 from src.utils import mainConn, managed_cursor, pathConn
 from src.carbon import calculate_carbon_footprint_for_trip
+from src.path_codec import decode_path
 from src.paths import Path
-import json
 import traceback
 
 logger = logging.getLogger(__name__)
@@ -53,7 +53,7 @@ def backfill_carbon_for_all_trips():
                 logger.warning(f"Path not found for trip {trip_id}")
                 continue
             
-            path_data = json.loads(path_row['path']) if isinstance(path_row['path'], str) else path_row['path']
+            path_data = decode_path(path_row['path'])
             
             # Convert path data to the format Path expects
             # Path data might be [[lat, lng], [lat, lng]] or [{"lat": x, "lng": y}, ...]
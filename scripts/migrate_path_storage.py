@@ -0,0 +1,83 @@
+"""
+Convert the paths stored in path.db between the text and binary storage formats
+
+Usage:
+    python -m scripts.migrate_path_storage          # text -> blob
+    python -m scripts.migrate_path_storage text     # blob -> text (rollback)
+
+Once migrated to blob, set `paths.storage: blob` in config.yaml so new paths are
+written in the same format. Readers handle both formats, so the migration can run
+while the app is up.
+"""
+import logging
+import sys
+
+from src.path_codec import (
+    PATH_STORAGE_BLOB,
+    PATH_STORAGE_TEXT,
+    decode_path,
+    encode_path,
+)
+from src.utils import managed_cursor, pathConn
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def migrate_path_storage(storage=PATH_STORAGE_BLOB):
+    """
+    Re-encode every path that is not already stored in the requested format
+    """
+    source_type = "text" if storage == PATH_STORAGE_BLOB else "blob"
+
+    with managed_cursor(pathConn) as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM paths WHERE typeof(path) = ?", (source_type,)
+        )
+        total = cursor.fetchone()[0]
+    logger.info(f"Found {total} paths to convert to {storage}")
+
+    converted = 0
+    last_uid = 0
+    while True:
+        with managed_cursor(pathConn) as cursor:
+            cursor.execute(
+                """
+                SELECT uid, path FROM paths
+                WHERE uid > ? AND typeof(path) = ?
+                ORDER BY uid
+                LIMIT ?
+                """,
+                (last_uid, source_type, BATCH_SIZE),
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            cursor.executemany(
+                "UPDATE paths SET path = ? WHERE uid = ?",
+                [
+                    (encode_path(decode_path(row["path"]), storage), row["uid"])
+                    for row in rows
+                ],
+            )
+        pathConn.commit()
+
+        last_uid = rows[-1]["uid"]
+        converted += len(rows)
+        logger.info(f"Progress: {converted}/{total} paths converted")
+
+    logger.info(f"Migration complete: {converted} paths converted to {storage}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    storage = sys.argv[1] if len(sys.argv) > 1 else PATH_STORAGE_BLOB
+    if storage not in (PATH_STORAGE_BLOB, PATH_STORAGE_TEXT):
+        raise ValueError(f"Invalid path storage: {storage}")
+    migrate_path_storage(storage)
+
+
+if __name__ == "__main__":
+    main()
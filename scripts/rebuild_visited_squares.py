@@ -0,0 +1,37 @@
+"""
+Rebuild the visited squares grid of every user, or of the given users
+
+Usage:
+    python -m scripts.rebuild_visited_squares
+    python -m scripts.rebuild_visited_squares username1 username2
+
+Grids are otherwise built lazily the first time a user's visited squares are read,
+and kept up to date as trips are created, edited and deleted.
+"""
+import logging
+import sys
+
+from src.utils import mainConn, managed_cursor
+from src.visited_squares import rebuild_user_squares
+
+logger = logging.getLogger(__name__)
+
+
+def rebuild_visited_squares(usernames=None):
+    if not usernames:
+        with managed_cursor(mainConn) as cursor:
+            cursor.execute("SELECT DISTINCT username FROM trip ORDER BY username")
+            usernames = [row["username"] for row in cursor.fetchall()]
+
+    for index, username in enumerate(usernames, start=1):
+        rebuild_user_squares(username)
+        logger.info(f"Progress: {index}/{len(usernames)} users rebuilt")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    rebuild_visited_squares(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
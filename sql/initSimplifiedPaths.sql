@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS simplified_paths (
+        trip_id INTEGER NOT NULL,
+        tolerance REAL NOT NULL,
+        path TEXT NOT NULL,
+        PRIMARY KEY (trip_id, tolerance)
+    )
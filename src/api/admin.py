@@ -1,8 +1,9 @@
 import logging
 
-from flask import Blueprint, render_template, request, session
+from flask import Blueprint, jsonify, render_template, request, session
 
 from py.utils import get_flag_emoji
+from src.pg_outbox import get_pg_outbox_lag
 from src.suspicious_activity import list_denied_logins, list_suspicious_activity
 from src.utils import getUser, isCurrentTrip, lang, owner_required
 
@@ -61,3 +62,9 @@ def suspicious_activity():
         **lang[session["userinfo"]["lang"]],
         **session["userinfo"],
     )
+
+
+@admin_blueprint.route("/pg_outbox")
+@owner_required
+def pg_outbox_lag():
+    return jsonify(get_pg_outbox_lag())
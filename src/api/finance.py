@@ -3,9 +3,8 @@ import csv
 from datetime import datetime, date
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 
-from src.finance import SimpleFinanceService, get_finances
+from src.finance import SimpleFinanceService, get_finances, to_eur
 from src.utils import owner_required, getUser, lang
-from py.currency import get_exchange_rate
 from dateutil.relativedelta import relativedelta
 
 
@@ -38,12 +37,8 @@ def finances():
         
         # Classify expenses (same logic as before)
         for expense in expenses:
-            amount_eur = expense["amount"]
-            if expense["currency"] != "EUR":
-                conv_date = expense["expense_date"] if not expense["is_recurring"] else expense["start_date"]
-                amount_eur = get_exchange_rate(
-                    float(expense["amount"]), expense["currency"], "EUR", conv_date
-                )
+            conv_date = expense["expense_date"] if not expense["is_recurring"] else expense["start_date"]
+            amount_eur = to_eur(expense, conv_date)
             
             # Determine months impacted
             months = []
@@ -0,0 +1,229 @@
+"""
+SQLite connections shared by the application
+
+Each thread gets its own connection to each database, so that requests served by
+different threads of a worker neither share a transaction nor wait on each other's
+cursor. Connections are opened lazily, reopened after a fork, and tuned for a
+read-heavy web workload (WAL journal, relaxed fsync, memory-mapped reads, larger
+page cache). The reference tables, which only change through the admin pages, are
+served from an in-memory copy instead.
+"""
+
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds to wait for a lock before raising "database is locked"
+SQLITE_BUSY_TIMEOUT = 10
+
+SQLITE_PRAGMAS = (
+    ("synchronous", "NORMAL"),  # safe with WAL, fsync only at checkpoints
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -32 * 1024),  # in KiB when negative
+    ("temp_store", "MEMORY"),
+)
+
+
+def connect(path, read_only=False):
+    """
+    Open a connection to the database at `path` with the application pragmas.
+    Read-only connections cannot write, and do not change the journal mode.
+    """
+    if read_only:
+        connection = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, timeout=SQLITE_BUSY_TIMEOUT
+        )
+    else:
+        connection = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode = WAL")
+    connection.row_factory = sqlite3.Row
+    for pragma, value in SQLITE_PRAGMAS:
+        connection.execute(f"PRAGMA {pragma} = {value}")
+    return connection
+
+
+class ThreadLocalConnection:
+    """
+    Stand-in for a sqlite3.Connection that forwards every call to the
+    connection of the current thread, e.g. `managed_cursor(mainConn)` or
+    `mainConn.commit()`
+    """
+
+    def __init__(self, path, read_only=False):
+        self._path = path
+        self._read_only = read_only
+        self._local = threading.local()
+        self._read_only_connection = None
+
+    def connection(self):
+        """
+        Return the connection of the current thread, opening it if needed
+        """
+        connection = getattr(self._local, "connection", None)
+        # connections must not be shared with a forked worker
+        if connection is None or self._local.pid != os.getpid():
+            connection = connect(self._path, read_only=self._read_only)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def read_only(self):
+        """
+        Return the read-only counterpart of these connections, for code paths
+        that only query the database
+        """
+        if self._read_only:
+            return self
+        if self._read_only_connection is None:
+            self._read_only_connection = ThreadLocalConnection(
+                self._path, read_only=True
+            )
+        return self._read_only_connection
+
+    def rollback_pending(self):
+        """
+        Roll back the transaction left open on the connection of the current
+        thread, if any, e.g. by a request that failed before committing. Without
+        it the connection would keep its lock on the database, and its next commit
+        would save the half-done write.
+        """
+        connection = getattr(self._local, "connection", None)
+        if (
+            connection is not None
+            and self._local.pid == os.getpid()
+            and connection.in_transaction
+        ):
+            connection.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+
+
+# Tables of main.db that are only written by the admin pages
+REFERENCE_TABLES = (
+    "airports",
+    "train_stations",
+    "operators",
+    "operator_logos",
+    "manual_stations",
+)
+
+# Seconds between two checks of the reference_versions table by a worker
+REFERENCE_CHECK_INTERVAL = 30
+
+_reference_snapshots = itertools.count()
+
+
+class ReferenceSnapshot:
+    """
+    In-memory copy of the reference tables, kept alive by `holder`, a connection
+    that also has the source database attached as `source`
+    """
+
+    def __init__(self, uri, holder, version):
+        self.uri = uri
+        self.holder = holder
+        self.version = version
+        self.pid = os.getpid()
+
+
+class ReferenceConnection:
+    """
+    Stand-in for a read-only sqlite3.Connection to the reference tables of the
+    database at `path` (airports, stations, operators, logos)
+
+    The tables are copied, with their indexes, into an in-memory database shared
+    by the threads of the process, so that autocomplete and logo lookups neither
+    read the database file nor wait on trip writes. The copy is reloaded when the
+    sum of the versions in the reference_versions table changes, which is checked
+    at most every REFERENCE_CHECK_INTERVAL seconds, or on the next query after
+    `invalidate()`.
+    """
+
+    def __init__(self, path, tables=REFERENCE_TABLES):
+        self._path = path
+        self._tables = tables
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._snapshot = None
+        self._checked_at = float("-inf")
+
+    @staticmethod
+    def _source_version(holder):
+        try:
+            return holder.execute(
+                "SELECT COALESCE(SUM(version), 0) FROM source.reference_versions"
+            ).fetchone()[0]
+        except sqlite3.OperationalError:  # table not created yet
+            return 0
+
+    def _load(self):
+        uri = (
+            f"file:reference_{os.getpid()}_{next(_reference_snapshots)}"
+            "?mode=memory&cache=shared"
+        )
+        holder = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        holder.isolation_level = None  # transactions are handled below
+        holder.execute("ATTACH DATABASE ? AS source", (f"file:{self._path}?mode=ro",))
+
+        indexes = []
+        holder.execute("BEGIN")
+        version = self._source_version(holder)
+        for table in self._tables:
+            for sql_type, sql in holder.execute(
+                """
+                SELECT type, sql FROM source.sqlite_master
+                WHERE tbl_name = ? AND type IN ('table', 'index') AND sql IS NOT NULL
+                ORDER BY type = 'index'
+                """,
+                (table,),
+            ).fetchall():
+                if sql_type == "index":
+                    indexes.append(sql)
+                    continue
+                holder.execute(sql)
+                holder.execute(f'INSERT INTO main."{table}" SELECT * FROM source."{table}"')
+        # indexes are faster to build once the rows are in
+        for sql in indexes:
+            holder.execute(sql)
+        holder.execute("COMMIT")
+        return ReferenceSnapshot(uri, holder, version)
+
+    def _current_uri(self):
+        with self._lock:
+            now = time.monotonic()
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.pid != os.getpid():
+                self._snapshot = self._load()
+                self._checked_at = now
+            elif now - self._checked_at > REFERENCE_CHECK_INTERVAL:
+                self._checked_at = now
+                if self._source_version(snapshot.holder) != snapshot.version:
+                    self._snapshot = self._load()
+                    # threads still reading the old copy keep it alive
+                    snapshot.holder.close()
+            return self._snapshot.uri
+
+    def invalidate(self):
+        """
+        Check the reference_versions table on the next query
+        """
+        self._checked_at = float("-inf")
+
+    def connection(self):
+        """
+        Return the connection of the current thread to the latest copy
+        """
+        uri = self._current_uri()
+        if getattr(self._local, "uri", None) != uri:
+            connection = sqlite3.connect(uri, uri=True)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA query_only = ON")
+            self._local.connection = connection
+            self._local.uri = uri
+        return self._local.connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
@@ -1,24 +1,35 @@
 import csv
+import datetime
+import hashlib
 import io
 import logging
 import logging.config
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-from src.pg import get_or_create_pg_session, pg_session
-from src.trips import Trip, compare_trip, parse_date
-from src.utils import get_user_id, mainConn, managed_cursor
+from src.pg import get_or_create_pg_session, pg_session, reset_db_engine_after_fork
+from src.trips import (
+    COMPARED_TRIP_FIELDS,
+    ROUNDED_DATETIME_FIELDS,
+    Trip,
+    compare_trip,
+    normalize_sqlite_trip,
+    parse_date,
+)
+from src.utils import authConn, mainConn, managed_cursor, sendOwnerEmail
 
 logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
 
-def sync_db_from_sqlite():
+def sync_db_from_sqlite(full=False):
     """
     Sync the PostgreSQL database with the SQLite database.
     """
 
     logger.info("Syncing SQLite database with PostgreSQL...")
     with pg_session() as pg:
-        sync_trips_from_sqlite(pg)
+        sync_trips_from_sqlite(pg, full=full)
 
 
 def trip_to_csv(trip: Trip):
@@ -54,155 +65,386 @@ def trip_to_csv(trip: Trip):
     return items
 
 
-def sync_trips_from_sqlite(pg_session=None):
-    logger.info("Syncing trips from SQLite to PostgreSQL...")
+# Trips converted and copied to pg per batch, to bound the memory used
+SYNC_BATCH_SIZE = 10000
+
+TRIP_COLUMNS = (
+    "trip_id",
+    "user_id",
+    "origin_station",
+    "destination_station",
+    "start_datetime",
+    "end_datetime",
+    "is_project",
+    "utc_start_datetime",
+    "utc_end_datetime",
+    "estimated_trip_duration",
+    "manual_trip_duration",
+    "trip_length",
+    "operator",
+    "countries",
+    "line_name",
+    "created",
+    "last_modified",
+    "trip_type",
+    "material_type",
+    "seat",
+    "reg",
+    "waypoints",
+    "notes",
+    "price",
+    "currency",
+    "ticket_id",
+    "purchase_date",
+)
+
+
+def load_user_ids():
+    """
+    Return the ids of all the users, by username
+    """
+    with managed_cursor(authConn) as cursor:
+        cursor.execute("SELECT uid, username FROM user")
+        return {row["username"]: row["uid"] for row in cursor.fetchall()}
+
+
+def row_to_trip(row, user_ids):
+    start_datetime = (
+        row["start_datetime"] if row["start_datetime"] not in [-1, 1] else None
+    )
+    parsed_start_datetime = parse_date(start_datetime) if start_datetime else None
+    end_datetime = (
+        row["end_datetime"] if row["end_datetime"] not in [-1, 1] else None
+    )
+    parsed_end_datetime = parse_date(end_datetime) if end_datetime else None
+    parsed_utc_start_datetime = (
+        parse_date(row["utc_start_datetime"]) if row["utc_start_datetime"] else None
+    )
+    parsed_utc_end_datetime = (
+        parse_date(row["utc_end_datetime"]) if row["utc_end_datetime"] else None
+    )
+    return Trip(
+        trip_id=row["uid"],
+        username=row["username"],
+        user_id=user_ids.get(row["username"]),
+        origin_station=row["origin_station"],
+        destination_station=row["destination_station"],
+        start_datetime=parsed_start_datetime,
+        end_datetime=parsed_end_datetime,
+        trip_length=row["trip_length"],
+        estimated_trip_duration=row["estimated_trip_duration"],
+        operator=row["operator"],
+        countries=row["countries"],
+        manual_trip_duration=row["manual_trip_duration"],
+        utc_start_datetime=parsed_utc_start_datetime,
+        utc_end_datetime=parsed_utc_end_datetime,
+        created=row["created"],
+        last_modified=row["last_modified"],
+        line_name=row["line_name"],
+        type=row["type"],
+        material_type=row["material_type"],
+        seat=row["seat"],
+        reg=row["reg"],
+        waypoints=row["waypoints"],
+        notes=row["notes"],
+        price=row["price"] if row["price"] != "" else None,
+        currency=row["currency"],
+        purchasing_date=row["purchasing_date"]
+        if row["purchasing_date"] != ""
+        else None,
+        ticket_id=row["ticket_id"] if row["ticket_id"] != "" else None,
+        is_project=row["start_datetime"] == 1 or row["end_datetime"] == 1,
+        path=None,  # not needed when inserting trips
+    )
 
-    # fetch all trips from sqlite
-    with managed_cursor(mainConn) as cursor:
-        cursor.execute("SELECT count(*) FROM trip")
-        num_trips = cursor.fetchone()[0]
-        logger.info(f"Syncing {num_trips} trips from SQLite to PostgreSQL")
 
-        cursor.execute("SELECT * FROM trip ORDER BY uid")
-        sqlite_trips = cursor.fetchall()
+def get_sync_checkpoint(pg):
+    """
+    Return the (last_modified, last_trip_id) high-water marks of the last sync,
+    or (None, None) if the trips were never synced
+    """
+    row = pg.execute("SELECT last_modified, last_trip_id FROM trips_sync").fetchone()
+    if row is None:
+        return None, None
+    return row["last_modified"], row["last_trip_id"]
+
 
+def copy_trips_batch(pg, rows, user_ids):
+    """
+    Upsert the given sqlite trips in pg, through the trips_sync_staging table
+    """
     csv_buf = io.StringIO()
     csv_writer = csv.writer(csv_buf, delimiter="\t", quoting=csv.QUOTE_MINIMAL)
+    for row in rows:
+        csv_writer.writerow(trip_to_csv(row_to_trip(row, user_ids)))
+    csv_buf.seek(0)
 
-    for i, row in enumerate(sqlite_trips):
-        if i % 20000 == 0:
-            logger.info(f"Converting trip {i}/{num_trips}")
-
-        start_datetime = (
-            row["start_datetime"] if row["start_datetime"] not in [-1, 1] else None
-        )
-        parsed_start_datetime = parse_date(start_datetime) if start_datetime else None
-        end_datetime = (
-            row["end_datetime"] if row["end_datetime"] not in [-1, 1] else None
-        )
-        parsed_end_datetime = parse_date(end_datetime) if end_datetime else None
-        parsed_utc_start_datetime = (
-            parse_date(row["utc_start_datetime"]) if row["utc_start_datetime"] else None
+    columns = ", ".join(TRIP_COLUMNS)
+    cursor = pg.connection().connection.cursor()
+    cursor.copy_expert(
+        f"""
+        COPY trips_sync_staging ({columns}) FROM STDIN WITH (
+            FORMAT csv,
+            DELIMITER E'\\t',
+            QUOTE '"'
         )
-        parsed_utc_end_datetime = (
-            parse_date(row["utc_end_datetime"]) if row["utc_end_datetime"] else None
-        )
-        trip = Trip(
-            trip_id=row["uid"],
-            username=row["username"],
-            user_id=get_user_id(row["username"]),
-            origin_station=row["origin_station"],
-            destination_station=row["destination_station"],
-            start_datetime=parsed_start_datetime,
-            end_datetime=parsed_end_datetime,
-            trip_length=row["trip_length"],
-            estimated_trip_duration=row["estimated_trip_duration"],
-            operator=row["operator"],
-            countries=row["countries"],
-            manual_trip_duration=row["manual_trip_duration"],
-            utc_start_datetime=parsed_utc_start_datetime,
-            utc_end_datetime=parsed_utc_end_datetime,
-            created=row["created"],
-            last_modified=row["last_modified"],
-            line_name=row["line_name"],
-            type=row["type"],
-            material_type=row["material_type"],
-            seat=row["seat"],
-            reg=row["reg"],
-            waypoints=row["waypoints"],
-            notes=row["notes"],
-            price=row["price"] if row["price"] != "" else None,
-            currency=row["currency"],
-            purchasing_date=row["purchasing_date"]
-            if row["purchasing_date"] != ""
-            else None,
-            ticket_id=row["ticket_id"] if row["ticket_id"] != "" else None,
-            is_project=row["start_datetime"] == 1 or row["end_datetime"] == 1,
-            path=None,  # not needed when inserting trips
-        )
-        csv_writer.writerow(trip_to_csv(trip))
+        """,
+        csv_buf,
+    )
+    updates = ", ".join(
+        f"{column} = EXCLUDED.{column}" for column in TRIP_COLUMNS if column != "trip_id"
+    )
+    pg.execute(
+        f"""
+        INSERT INTO trips ({columns})
+        SELECT {columns} FROM trips_sync_staging
+        ON CONFLICT (trip_id) DO UPDATE SET {updates}
+        """
+    )
+    pg.execute("TRUNCATE trips_sync_staging")
 
-    csv_buf.seek(0)
 
-    with get_or_create_pg_session(pg_session) as pg:
-        # remove existing trips from pg
-        logger.info("Deleting existing trips in pg...")
-        query = "DELETE FROM trips;"
-        pg.execute(query)
-
-        query = """
-            COPY trips (
-                trip_id,
-                user_id,
-                origin_station,
-                destination_station,
-                start_datetime,
-                end_datetime,
-                is_project,
-                utc_start_datetime,
-                utc_end_datetime,
-                estimated_trip_duration,
-                manual_trip_duration,
-                trip_length,
-                operator,
-                countries,
-                line_name,
-                created,
-                last_modified,
-                trip_type,
-                material_type,
-                seat,
-                reg,
-                waypoints,
-                notes,
-                price,
-                currency,
-                ticket_id,
-                purchase_date
-            ) FROM STDIN WITH (
-                FORMAT csv,
-                DELIMITER E'\t',
-                QUOTE '"'
+def prune_deleted_trips(pg):
+    """
+    Delete the pg trips that no longer exist in sqlite. Trips created after the
+    sqlite ids were read are left alone.
+    """
+    pg.execute("CREATE TEMP TABLE trips_sync_ids (trip_id INTEGER) ON COMMIT DROP")
+    cursor = pg.connection().connection.cursor()
+    max_trip_id = 0
+    with managed_cursor(mainConn) as sqlite_cursor:
+        sqlite_cursor.execute("SELECT uid FROM trip ORDER BY uid")
+        while rows := sqlite_cursor.fetchmany(SYNC_BATCH_SIZE * 10):
+            cursor.copy_expert(
+                "COPY trips_sync_ids (trip_id) FROM STDIN",
+                io.StringIO("".join(f"{row[0]}\n" for row in rows)),
             )
+            max_trip_id = rows[-1][0]
+    deleted = pg.execute(
         """
+        DELETE FROM trips t
+        WHERE t.trip_id <= :max_trip_id
+        AND NOT EXISTS (SELECT 1 FROM trips_sync_ids i WHERE i.trip_id = t.trip_id)
+        """,
+        {"max_trip_id": max_trip_id},
+    ).rowcount
+    logger.info(f"Deleted {deleted} trips missing from sqlite")
 
-        logger.info("Bulk inserting trips in pg...")
-        cursor = pg.connection().connection.cursor()
-        cursor.copy_expert(query, csv_buf)
-    logger.info("Finished migrating trips from sqlite to pg!")
 
+def sync_trips_from_sqlite(pg_session=None, full=False):
+    """
+    Upsert in pg the sqlite trips created or modified since the last sync (all
+    of them if `full` or on the first sync), then delete the pg trips that no
+    longer exist in sqlite.
+
+    Unlike deleting and copying back the whole table, this only locks the rows
+    being written, so the trips can still be written while a sync is running.
+    Writes that do not bump last_modified (trip type, tickets) are only picked up
+    by a full sync.
+    """
+    logger.info("Syncing trips from SQLite to PostgreSQL...")
+    user_ids = load_user_ids()
+
+    with get_or_create_pg_session(pg_session) as pg:
+        last_modified, last_trip_id = (None, None) if full else get_sync_checkpoint(pg)
+        if last_modified is None and last_trip_id is None:
+            logger.info("Running a full sync")
+            query, params = "SELECT * FROM trip ORDER BY uid", ()
+        else:
+            logger.info(
+                f"Syncing trips modified after {last_modified} or above {last_trip_id}"
+            )
+            query = """
+                SELECT * FROM trip
+                WHERE last_modified > ? OR uid > ?
+                ORDER BY uid
+            """
+            params = (str(last_modified or ""), last_trip_id or 0)
+
+        pg.execute(
+            """
+            CREATE TEMP TABLE trips_sync_staging
+            (LIKE trips INCLUDING DEFAULTS) ON COMMIT DROP
+            """
+        )
+
+        num_trips = 0
+        with managed_cursor(mainConn) as cursor:
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(SYNC_BATCH_SIZE):
+                copy_trips_batch(pg, rows, user_ids)
+                num_trips += len(rows)
+                for row in rows:
+                    last_trip_id = max(last_trip_id or 0, row["uid"])
+                    if not row["last_modified"]:
+                        continue
+                    try:
+                        modified = parse_date(row["last_modified"])
+                    except ValueError:
+                        continue
+                    if last_modified is None or modified > last_modified:
+                        last_modified = modified
+                logger.info(f"Synced {num_trips} trips")
 
-def compare_all_trips():
-    # Fetch trip IDs from SQLite
+        prune_deleted_trips(pg)
+
+        pg.execute(
+            """
+            INSERT INTO trips_sync (id, last_modified, last_trip_id, synced_at)
+            VALUES (TRUE, :last_modified, :last_trip_id, NOW())
+            ON CONFLICT (id) DO UPDATE SET
+                last_modified = EXCLUDED.last_modified,
+                last_trip_id = EXCLUDED.last_trip_id,
+                synced_at = EXCLUDED.synced_at
+            """,
+            {"last_modified": last_modified, "last_trip_id": last_trip_id},
+        )
+    logger.info(f"Finished syncing {num_trips} trips from sqlite to pg!")
+
+
+# Trip ids checked per task of the consistency check
+CHECK_CHUNK_SIZE = 20000
+
+# Set in each process of the consistency check pool
+_check_user_ids = None
+
+
+def _init_check_worker(user_ids):
+    global _check_user_ids
+    _check_user_ids = user_ids
+    reset_db_engine_after_fork()
+
+
+def _hash_value(field, value):
+    # same canonical form for equal sqlite and pg values: numbers as floats, and
+    # the datetimes compare_trip tolerates a second of difference on to the second
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        if field in ROUNDED_DATETIME_FIELDS:
+            value = value.replace(microsecond=0)
+        return value.isoformat()
+    return str(value)
+
+
+def hash_trip(trip):
+    """
+    Return the hash of the compared fields of a trip (sqlite trips normalized)
+    """
+    values = tuple(_hash_value(field, trip[field]) for field in COMPARED_TRIP_FIELDS)
+    return hashlib.blake2b(repr(values).encode(), digest_size=16).digest()
+
+
+def diff_trips_range(first_id, last_id):
+    """
+    Hash the trips of ids between first_id and last_id on both sides, and return
+    the ids only in sqlite, the ids only in pg and the ids whose hashes differ
+    """
+    sqlite_hashes = {}
     with managed_cursor(mainConn) as cursor:
-        cursor.execute("SELECT uid FROM trip ORDER BY uid")
-        sqlite_trips = {row[0] for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT * FROM trip WHERE uid BETWEEN ? AND ?", (first_id, last_id)
+        )
+        for row in cursor.fetchall():
+            trip = dict(row)
+            try:
+                trip = normalize_sqlite_trip(
+                    trip, _check_user_ids.get(trip["username"])
+                )
+                sqlite_hashes[trip["trip_id"]] = hash_trip(trip)
+            except Exception:
+                # unparseable dates, reported by compare_trip
+                sqlite_hashes[trip["uid"]] = None
 
-    # Fetch trip IDs from PostgreSQL
     with pg_session() as pg:
-        pg_trips = {row[0] for row in pg.execute("SELECT trip_id FROM trips ORDER BY trip_id").fetchall()}
+        pg_hashes = {
+            row["trip_id"]: hash_trip(row)
+            for row in pg.execute(
+                "SELECT * FROM trips WHERE trip_id BETWEEN :first_id AND :last_id",
+                {"first_id": first_id, "last_id": last_id},
+            ).fetchall()
+        }
+
+    only_in_sqlite = sqlite_hashes.keys() - pg_hashes.keys()
+    only_in_pg = pg_hashes.keys() - sqlite_hashes.keys()
+    different = {
+        trip_id
+        for trip_id in sqlite_hashes.keys() & pg_hashes.keys()
+        if sqlite_hashes[trip_id] is None
+        or sqlite_hashes[trip_id] != pg_hashes[trip_id]
+    }
+    return only_in_sqlite, only_in_pg, different
+
 
-    # Compare the counts
-    if len(sqlite_trips) != len(pg_trips):
-        only_in_sqlite = sqlite_trips - pg_trips
-        only_in_pg = pg_trips - sqlite_trips
+def trip_id_ranges():
+    """
+    Split the trip ids of both databases in ranges of CHECK_CHUNK_SIZE ids
+    """
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute("SELECT MIN(uid), MAX(uid) FROM trip")
+        sqlite_bounds = cursor.fetchone()
+    with pg_session() as pg:
+        pg_bounds = pg.execute("SELECT MIN(trip_id), MAX(trip_id) FROM trips").fetchone()
+
+    lows = [bounds[0] for bounds in (sqlite_bounds, pg_bounds) if bounds[0] is not None]
+    highs = [bounds[1] for bounds in (sqlite_bounds, pg_bounds) if bounds[1] is not None]
+    if not lows:
+        return []
+    return [
+        (first_id, min(first_id + CHECK_CHUNK_SIZE - 1, max(highs)))
+        for first_id in range(min(lows), max(highs) + 1, CHECK_CHUNK_SIZE)
+    ]
 
+
+def compare_all_trips(processes=None):
+    """
+    Check that sqlite and pg hold the same trips.
+
+    The trips are hashed in bulk on both sides, by ranges of ids spread over a
+    pool of `processes` processes (one per CPU by default). Only the trips whose
+    hashes differ are then compared one by one with compare_trip, and the ones
+    that really differ are reported to the owner in a single email. Return their
+    ids.
+    """
+    ranges = trip_id_ranges()
+    if not ranges:
+        return []
+    logger.info(f"Checking consistency of {len(ranges)} ranges of trips")
+
+    only_in_sqlite, only_in_pg, different = set(), set(), set()
+    # forked, so that the workers share the configuration and the user ids
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_check_worker,
+        initargs=(load_user_ids(),),
+    ) as pool:
+        for i, (range_only_in_sqlite, range_only_in_pg, range_different) in enumerate(
+            pool.map(diff_trips_range, *zip(*ranges))
+        ):
+            only_in_sqlite |= range_only_in_sqlite
+            only_in_pg |= range_only_in_pg
+            different |= range_different
+            if i % 10 == 0:
+                logger.info(f"Checked range {i}/{len(ranges)}")
+
+    if only_in_sqlite or only_in_pg:
         msg = (
-            f"Mismatch in trip counts! "
-            f"SQLite has {len(sqlite_trips)} trips, PG has {len(pg_trips)} trips.\n"
+            f"Mismatch in trips! "
             f"Trips only in SQLite: {sorted(only_in_sqlite)}\n"
             f"Trips only in PG: {sorted(only_in_pg)}"
         )
         logger.error(msg)
         raise Exception(msg)
 
-    # If counts match, do full comparison
-    try:
-        for i, trip_id in enumerate(sorted(sqlite_trips)):
-            if i % 20000 == 0:
-                logger.info(f"Checking consistency of trip {i}/{len(sqlite_trips)}")
-            compare_trip(trip_id)
-    except Exception:
-        logger.error(f"Found exception while processing trip {trip_id}")
-        raise
-
+    logger.info(f"Found {len(different)} trips with different hashes")
+    drifted = sorted(
+        trip_id for trip_id in different if not compare_trip(trip_id, report=False)
+    )
+    if drifted:
+        msg = f"{len(drifted)} trips have drifted between SQLite and PG: {drifted}"
+        logger.error(msg)
+        sendOwnerEmail("Error : trips drifted between SQLite and PG", msg)
+    return drifted
@@ -13,6 +13,18 @@ from py.utils import load_config
 
 logger = logging.getLogger(__name__)
 
+
+def to_eur(row, conv_date):
+    """
+    EUR amount of an expense or revenue row, as converted by pg. Falls back to a
+    conversion here when the exchange rates have not been copied to pg yet.
+    """
+    if row["currency"] == "EUR":
+        return row["amount"]
+    if row.get("amount_eur") is not None:
+        return row["amount_eur"]
+    return get_exchange_rate(float(row["amount"]), row["currency"], "EUR", conv_date)
+
 class SimpleFinanceService:
     
     @staticmethod
@@ -141,11 +153,15 @@ class SimpleFinanceService:
         with pg_session() as pg:
             result = pg.execute("""
                 SELECT id, name, amount, currency, is_recurring, start_date, end_date, 
-                       expense_date, is_active, created_at
+                       expense_date, is_active, created_at,
+                       convert_price(
+                           amount, currency, 'EUR',
+                           CASE WHEN is_recurring THEN start_date ELSE expense_date END
+                       ) AS amount_eur
                 FROM finance.expenses
                 ORDER BY created_at DESC
             """)
-            columns = ['id', 'name', 'amount', 'currency', 'is_recurring', 'start_date', 'end_date', 'expense_date', 'is_active', 'created_at']
+            columns = ['id', 'name', 'amount', 'currency', 'is_recurring', 'start_date', 'end_date', 'expense_date', 'is_active', 'created_at', 'amount_eur']
             return [dict(zip(columns, row)) for row in result.fetchall()]
 
     @staticmethod
@@ -153,11 +169,12 @@ class SimpleFinanceService:
         """Get all revenue"""
         with pg_session() as pg:
             result = pg.execute("""
-                SELECT id, external_id, name, amount, currency, revenue_date, created_at
+                SELECT id, external_id, name, amount, currency, revenue_date, created_at,
+                       convert_price(amount, currency, 'EUR', revenue_date) AS amount_eur
                 FROM finance.revenue
                 ORDER BY revenue_date DESC
             """)
-            columns = ['id', 'external_id', 'name', 'amount', 'currency', 'revenue_date', 'created_at']
+            columns = ['id', 'external_id', 'name', 'amount', 'currency', 'revenue_date', 'created_at', 'amount_eur']
             return [dict(zip(columns, row)) for row in result.fetchall()]
 
     @staticmethod
@@ -206,23 +223,15 @@ class SimpleFinanceService:
         revenues = SimpleFinanceService.get_all_revenue()
         for revenue in revenues:
             month_key = revenue['revenue_date'].strftime("%Y-%m")
-            amount_eur = revenue['amount']
-            if revenue['currency'] != 'EUR':
-                amount_eur = get_exchange_rate(
-                    float(revenue['amount']), revenue['currency'], "EUR", revenue['revenue_date']
-                )
+            amount_eur = to_eur(revenue, revenue['revenue_date'])
             monthly_data[month_key]["revenue"] += float(amount_eur)
         
         # Process expenses
         expenses = SimpleFinanceService.get_all_expenses()
         for expense in expenses:
-            amount_eur = expense['amount']
-            if expense['currency'] != 'EUR':
-                # Use appropriate date for conversion
-                conv_date = expense['expense_date'] if not expense['is_recurring'] else expense['start_date']
-                amount_eur = get_exchange_rate(
-                    float(expense['amount']), expense['currency'], "EUR", conv_date
-                )
+            # Use appropriate date for conversion
+            conv_date = expense['expense_date'] if not expense['is_recurring'] else expense['start_date']
+            amount_eur = to_eur(expense, conv_date)
             
             if expense['is_recurring'] and expense['is_active']:
                 # Calculate for each month the recurring expense applies
@@ -503,12 +512,8 @@ def get_finances() -> Tuple:
 
     # Classify expenses
     for expense in expenses:
-        amount_eur = expense["amount"]
-        if expense["currency"] != "EUR":
-            conv_date = expense["expense_date"] if not expense["is_recurring"] else expense["start_date"]
-            amount_eur = get_exchange_rate(
-                float(expense["amount"]), expense["currency"], "EUR", conv_date
-            )
+        conv_date = expense["expense_date"] if not expense["is_recurring"] else expense["start_date"]
+        amount_eur = to_eur(expense, conv_date)
 
         # Determine months impacted
         months = []
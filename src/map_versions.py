@@ -0,0 +1,71 @@
+"""
+Per-user version of the map data
+
+Every write to the trips of a user bumps their version in the map_versions table of
+main.db, so that the map payloads cached by each worker can be checked for
+staleness with a single primary key lookup, whichever worker did the write.
+"""
+
+from datetime import datetime
+
+from src.utils import batched_ids, cursor_or_new, mainConn, managed_cursor
+
+
+def get_map_version(username):
+    """
+    Return the (version, updated_at) of the user's map data, updated_at being the
+    time of the last trip write
+    """
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            "SELECT version, updated_at FROM map_versions WHERE username = ?",
+            (username,),
+        )
+        row = cursor.fetchone()
+    if row is not None:
+        return row["version"], datetime.fromisoformat(row["updated_at"])
+
+    # First read: older writes are unknown, consider the data changed just now
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            """
+            INSERT OR IGNORE INTO map_versions (username, version, updated_at)
+            VALUES (?, 0, ?)
+            """,
+            (username, datetime.now().isoformat(" ")),
+        )
+    mainConn.commit()
+    return get_map_version(username)
+
+
+def bump_map_version(username, cursor=None):
+    """
+    Mark the user's map data as changed. The caller is responsible for committing.
+    """
+    with cursor_or_new(mainConn, cursor) as cursor:
+        cursor.execute(
+            """
+            INSERT INTO map_versions (username, version, updated_at)
+            VALUES (?, 1, ?)
+            ON CONFLICT (username) DO UPDATE SET
+                version = version + 1,
+                updated_at = excluded.updated_at
+            """,
+            (username, datetime.now().isoformat(" ")),
+        )
+
+
+def bump_trips_map_version(trip_ids, cursor=None):
+    """
+    Mark the map data of the owners of the given trips as changed, to be called
+    before the trips are deleted. The caller is responsible for committing.
+    """
+    trip_ids = list(trip_ids)
+    with cursor_or_new(mainConn, cursor) as cursor:
+        for batch, placeholders in batched_ids(trip_ids):
+            cursor.execute(
+                f"SELECT DISTINCT username FROM trip WHERE uid IN ({placeholders})",
+                batch,
+            )
+            for row in cursor.fetchall():
+                bump_map_version(row["username"], cursor)
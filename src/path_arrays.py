@@ -0,0 +1,115 @@
+"""
+Columnar access to trip paths
+
+Instead of one list of [lat, lng] lists per trip, `load_path_arrays` returns all the
+requested paths as a single (n, 2) float64 coordinate buffer plus an offsets index,
+so that per-user aggregations can be done with vectorized NumPy operations.
+"""
+
+import numpy as np
+
+from src.path_codec import decode_path_array
+from src.utils import batched_ids, managed_cursor, pathReadConn
+
+
+class PathArrays:
+    """
+    Paths of several trips stored in one coordinate buffer
+
+    The path of `trip_ids[i]` is `coords[offsets[i]:offsets[i + 1]]`.
+    """
+
+    def __init__(self, trip_ids, coords, offsets):
+        self.trip_ids = trip_ids
+        self.coords = coords
+        self.offsets = offsets
+
+    @classmethod
+    def from_paths(cls, trip_ids, paths):
+        """
+        Build a PathArrays from a list of trip ids and their (n, 2) coordinate arrays
+        """
+        lengths = np.fromiter((len(path) for path in paths), dtype=np.int64)
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        coords = (
+            np.concatenate(paths) if paths else np.empty((0, 2), dtype=np.float64)
+        )
+        return cls(np.asarray(trip_ids, dtype=np.int64), coords, offsets)
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def path(self, index):
+        """
+        Return the coordinates of the index-th path (a view on the buffer)
+        """
+        return self.coords[self.offsets[index] : self.offsets[index + 1]]
+
+    def items(self):
+        """
+        Iterate over (trip_id, coordinates) pairs
+        """
+        for index, trip_id in enumerate(self.trip_ids.tolist()):
+            yield trip_id, self.path(index)
+
+    def point_path_index(self):
+        """
+        Return, for every point of the buffer, the index of the path it belongs to
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def point_trip_ids(self):
+        """
+        Return, for every point of the buffer, the trip id it belongs to
+        """
+        return np.repeat(self.trip_ids, self.lengths)
+
+    def endpoint_indices(self):
+        """
+        Return the buffer indices of the first and last point of every non-empty path
+        """
+        non_empty = self.lengths > 0
+        starts = self.offsets[:-1][non_empty]
+        ends = self.offsets[1:][non_empty] - 1
+        return np.unique(np.concatenate([starts, ends]))
+
+    def segment_mask(self):
+        """
+        Return a boolean mask over the len(coords) - 1 consecutive point pairs of the
+        buffer, True when both points belong to the same path
+        """
+        mask = np.ones(max(len(self.coords) - 1, 0), dtype=bool)
+        boundaries = self.offsets[1:-1]
+        boundaries = boundaries[(boundaries > 0) & (boundaries < len(self.coords))]
+        mask[boundaries - 1] = False
+        return mask
+
+
+def load_path_arrays(trip_ids):
+    """
+    Load the paths of the given trips as a PathArrays
+
+    Trips without a path are left out; the order of the returned paths follows
+    `trip_ids`.
+    """
+    trip_ids = list(dict.fromkeys(int(trip_id) for trip_id in trip_ids))
+
+    raw_paths = {}
+    with managed_cursor(pathReadConn) as cursor:
+        for batch, placeholders in batched_ids(trip_ids):
+            cursor.execute(
+                f"SELECT trip_id, path FROM paths WHERE trip_id IN ({placeholders})",
+                batch,
+            )
+            for row in cursor.fetchall():
+                raw_paths[row["trip_id"]] = row["path"]
+
+    found_ids = [trip_id for trip_id in trip_ids if trip_id in raw_paths]
+    return PathArrays.from_paths(
+        found_ids, [decode_path_array(raw_paths[trip_id]) for trip_id in found_ids]
+    )
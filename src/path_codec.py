@@ -0,0 +1,134 @@
+"""
+Encoding and decoding of trip paths stored in path.db
+
+Paths used to be stored as the text representation of a list of [lat, lng] pairs.
+They can now also be stored as a compact binary blob:
+
+    4 bytes   magic header (b"TLP1")
+    4 bytes   number of points (little-endian uint32)
+    8*n bytes interleaved lat/lng pairs as little-endian int32 fixed-point values
+              (degrees * PATH_SCALE)
+
+Both formats can coexist in the same column, `decode_path` handles either of them.
+
+Map endpoints can also send paths in a compact wire format, see `format_path`.
+"""
+
+import json
+import struct
+
+import flexpolyline
+import numpy as np
+import polyline
+
+from py.utils import load_config
+
+PATH_BLOB_MAGIC = b"TLP1"
+PATH_BLOB_HEADER = struct.Struct("<4sI")
+# 1e-7 degrees is about 1cm, and 180 * 1e7 still fits in an int32
+PATH_SCALE = 10_000_000
+
+PATH_STORAGE_TEXT = "text"
+PATH_STORAGE_BLOB = "blob"
+
+PATH_STORAGE = load_config().get("paths", {}).get("storage", PATH_STORAGE_TEXT)
+
+# Wire formats of the paths sent to the map
+PATH_FORMAT_JSON = "json"  # list of [lat, lng] lists
+PATH_FORMAT_POLYLINE = "polyline"  # Google encoded polyline, 5 decimals
+PATH_FORMAT_FLEXPOLYLINE = "flexpolyline"  # HERE flexible polyline, 6 decimals
+PATH_FORMATS = (PATH_FORMAT_JSON, PATH_FORMAT_POLYLINE, PATH_FORMAT_FLEXPOLYLINE)
+FLEXPOLYLINE_PRECISION = 6
+
+
+def is_path_blob(value):
+    """
+    Return True if the value stored in the path column is a binary path
+    """
+    return isinstance(value, (bytes, memoryview)) and bytes(
+        value[: len(PATH_BLOB_MAGIC)]
+    ) == PATH_BLOB_MAGIC
+
+
+def encode_path_blob(coords):
+    """
+    Pack a list of [lat, lng] pairs into the binary path format
+    """
+    points = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    fixed = np.rint(points * PATH_SCALE).astype("<i4")
+    return PATH_BLOB_HEADER.pack(PATH_BLOB_MAGIC, len(fixed)) + fixed.tobytes()
+
+
+def decode_path_array(value):
+    """
+    Return the path as a (n, 2) float64 NumPy array of [lat, lng]
+
+    Binary paths are read straight from the buffer, text paths are parsed as JSON.
+    """
+    if value is None:
+        return np.empty((0, 2), dtype=np.float64)
+    if is_path_blob(value):
+        _, count = PATH_BLOB_HEADER.unpack_from(value)
+        fixed = np.frombuffer(
+            value, dtype="<i4", count=count * 2, offset=PATH_BLOB_HEADER.size
+        )
+        return fixed.reshape(-1, 2) / PATH_SCALE
+    return np.asarray(json.loads(value), dtype=np.float64).reshape(-1, 2)
+
+
+def decode_path(value, default="[]"):
+    """
+    Return the path as a list of [lat, lng] lists, whatever its storage format
+
+    This is a drop-in replacement for `json.loads(row["path"])`.
+    """
+    if value is None:
+        value = default
+    if is_path_blob(value):
+        return decode_path_array(value).tolist()
+    return json.loads(value)
+
+
+def format_path(coords, path_format=PATH_FORMAT_JSON):
+    """
+    Convert a path (list of [lat, lng] pairs or NumPy array) to one of the
+    PATH_FORMATS wire formats
+    """
+    if path_format == PATH_FORMAT_JSON:
+        return coords.tolist() if isinstance(coords, np.ndarray) else coords
+    if len(coords) == 0:
+        return ""
+    if path_format == PATH_FORMAT_POLYLINE:
+        return polyline.encode(coords)
+    if path_format == PATH_FORMAT_FLEXPOLYLINE:
+        return flexpolyline.encode(coords, precision=FLEXPOLYLINE_PRECISION)
+    raise ValueError(f"Unknown path format {path_format}")
+
+
+def path_json(value, default="[]", path_format=PATH_FORMAT_JSON):
+    """
+    Return the stored path as JSON text in the given wire format, for responses
+    that embed it as is
+
+    Text paths are already valid JSON and are returned without being parsed.
+    """
+    if path_format != PATH_FORMAT_JSON:
+        if value is None:
+            return '""'
+        return json.dumps(format_path(decode_path_array(value), path_format))
+    if value is None:
+        return default
+    if is_path_blob(value):
+        return json.dumps(decode_path_array(value).tolist())
+    return value
+
+
+def encode_path(coords, storage=None):
+    """
+    Serialize a list of [lat, lng] pairs for the path column, using the storage
+    format configured in `paths.storage` (text by default)
+    """
+    storage = storage or PATH_STORAGE
+    if storage == PATH_STORAGE_BLOB:
+        return encode_path_blob(coords)
+    return str([[lat, lng] for lat, lng in coords])
@@ -0,0 +1,116 @@
+"""
+Simplified versions of the trip paths for the map (level of detail)
+
+Every path is simplified with the Douglas-Peucker algorithm at each tolerance of
+LOD_TOLERANCES and stored in the simplified_paths table of path.db, in the same
+format as the paths table, so that a world-zoom map does not have to download
+every GPS point of every trip. They are computed when the path is saved, and
+filled in on first read for older trips.
+"""
+
+import numpy as np
+import shapely
+
+from src.path_arrays import PathArrays, load_path_arrays
+from src.path_codec import encode_path
+from src.utils import batched_ids, cursor_or_new, managed_cursor, pathConn
+
+# In degrees: about 50m, 500m and 5km
+LOD_TOLERANCES = (0.0005, 0.005, 0.05)
+
+
+def lod_tolerance(requested):
+    """
+    Return the largest stored tolerance not above the requested one, or None if
+    the full paths should be used
+    """
+    stored = [tolerance for tolerance in LOD_TOLERANCES if tolerance <= requested]
+    return max(stored) if stored else None
+
+
+def simplify_paths(paths, tolerance):
+    """
+    Simplify all the paths of a PathArrays at once, returning a new PathArrays.
+    Paths of a single point are kept as they are.
+    """
+    lengths = paths.lengths
+    simplifiable = lengths >= 2
+    point_mask = np.repeat(simplifiable, lengths)
+    simplifiable_index = np.flatnonzero(simplifiable)
+
+    lines = shapely.linestrings(
+        paths.coords[point_mask],
+        indices=np.repeat(np.arange(len(simplifiable_index)), lengths[simplifiable]),
+    )
+    simplified = shapely.simplify(lines, tolerance, preserve_topology=False)
+    coords, line_index = shapely.get_coordinates(simplified, return_index=True)
+    line_offsets = np.searchsorted(line_index, np.arange(len(simplifiable_index) + 1))
+
+    simplified_paths = [paths.path(index) for index in range(len(paths))]
+    for line, index in enumerate(simplifiable_index.tolist()):
+        simplified_paths[index] = coords[line_offsets[line] : line_offsets[line + 1]]
+    return PathArrays.from_paths(paths.trip_ids, simplified_paths)
+
+
+def update_simplified_paths(trip_ids):
+    """
+    (Re)compute and store the simplified paths of the given trips at every
+    tolerance, to be called once their path is saved
+    """
+    paths = load_path_arrays(trip_ids)
+    rows = []
+    for tolerance in LOD_TOLERANCES:
+        for trip_id, coords in simplify_paths(paths, tolerance).items():
+            rows.append((trip_id, tolerance, encode_path(coords.tolist())))
+    with managed_cursor(pathConn) as cursor:
+        delete_simplified_paths(trip_ids, cursor)
+        cursor.executemany(
+            "INSERT INTO simplified_paths (trip_id, tolerance, path) VALUES (?, ?, ?)",
+            rows,
+        )
+    pathConn.commit()
+
+
+def load_simplified_paths(trip_ids, tolerance):
+    """
+    Return the stored paths of the given trips simplified at `tolerance` (one of
+    LOD_TOLERANCES), as a dict trip_id -> value of the path column. Trips without
+    a path are left out.
+    """
+    trip_ids = list(dict.fromkeys(trip_ids))
+
+    def load(trip_ids):
+        paths = {}
+        with managed_cursor(pathConn) as cursor:
+            for batch, placeholders in batched_ids(trip_ids, reserved=1):
+                cursor.execute(
+                    f"""
+                    SELECT trip_id, path FROM simplified_paths
+                    WHERE tolerance = ? AND trip_id IN ({placeholders})
+                    """,
+                    [tolerance] + batch,
+                )
+                for row in cursor.fetchall():
+                    paths[row["trip_id"]] = row["path"]
+        return paths
+
+    paths = load(trip_ids)
+    missing = [trip_id for trip_id in trip_ids if trip_id not in paths]
+    if missing:
+        update_simplified_paths(missing)
+        paths.update(load(missing))
+    return paths
+
+
+def delete_simplified_paths(trip_ids, cursor=None):
+    """
+    Drop the simplified paths of the given trips. The caller is responsible for
+    committing.
+    """
+    trip_ids = list(trip_ids)
+    with cursor_or_new(pathConn, cursor) as cursor:
+        for batch, placeholders in batched_ids(trip_ids):
+            cursor.execute(
+                f"DELETE FROM simplified_paths WHERE trip_id IN ({placeholders})",
+                batch,
+            )
@@ -1,3 +1,6 @@
+from src.path_codec import encode_path
+
+
 class Node:
     def __init__(self, trip_id, node_order, lat, lng):
         self.trip_id = trip_id
@@ -25,7 +28,10 @@ class Path:
         return ("trip_id", "path")
 
     def values(self):
-        return [self.list[0].trip_id, str([[node.lat, node.lng] for node in self.list])]
-    
+        return [
+            self.list[0].trip_id,
+            encode_path([[node.lat, node.lng] for node in self.list]),
+        ]
+
     def __len__(self):
         return len(self.list)
@@ -54,6 +54,20 @@ def init_db_engine():
         logger.info(f"Database engine initialized for process {os.getpid()}")
 
 
+def reset_db_engine_after_fork():
+    """
+    Drop the engine inherited from the parent process, without closing its
+    connections which are still in use by the parent. To be called in processes
+    forked after the engine was initialized.
+    """
+    global pg_session_engine, Session
+
+    if pg_session_engine is not None:
+        pg_session_engine.dispose(close=False)
+    pg_session_engine = None
+    Session = None
+
+
 @contextmanager
 def pg_session():
     # Ensure engine is initialized (handles both preload and non-preload cases)
@@ -0,0 +1,432 @@
+"""
+Write-behind queue of the Postgres trip writes
+
+Trip writes are applied to SQLite within the request, and the matching Postgres
+mutation is queued in the pg_outbox table of main.db in the same SQLite
+transaction, so that a request only pays for one write and a slow or unavailable
+Postgres can neither fail nor half-apply it.
+
+A worker thread in each process applies the queued mutations in batches. Only one
+worker holds a batch at a time (the rows it claimed), and the mutations of a trip
+are applied in the order they were queued: a failed mutation is retried with an
+exponential backoff, the later mutations of the same trip waiting for it, until
+OUTBOX_MAX_ATTEMPTS is reached. The mutation is then given up on, the trip is
+reported by get_pg_outbox_lag, and a re-sync of the whole trip from SQLite is
+queued.
+
+Each applied mutation is recorded in the pg_outbox_applied table of Postgres in
+the same transaction, so that a mutation applied again (worker killed before
+removing it from the queue, claim expired while applying) is skipped.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from src.pg import pg_session
+from src.sql.trips import (
+    attach_ticket_query,
+    delete_trip_query,
+    duplicate_trip_query,
+    insert_trip_query,
+    update_ticket_null_query,
+    update_trip_query,
+    update_trip_type_query,
+)
+from src.utils import cursor_or_new, mainConn, managed_cursor
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 200
+# Queued writes looked at to fill a batch, past the ones held back
+OUTBOX_SCAN_SIZE = 10 * OUTBOX_BATCH_SIZE
+# Seconds between two polls of an empty queue
+OUTBOX_POLL_INTERVAL = 1
+# Seconds to wait after an error of the worker, e.g. Postgres being down
+OUTBOX_ERROR_INTERVAL = 30
+# Seconds after which a batch claimed by a worker that died is claimed again, the
+# claim being extended while the batch is applied
+OUTBOX_CLAIM_TIMEOUT = 120
+OUTBOX_MAX_ATTEMPTS = 10
+# Longest wait between two attempts, in seconds
+OUTBOX_MAX_BACKOFF = 300
+# Days during which applied writes are remembered in pg_outbox_applied
+OUTBOX_APPLIED_RETENTION_DAYS = 7
+
+PG_WRITE_QUERIES = {
+    "insert_trip": insert_trip_query,
+    "duplicate_trip": duplicate_trip_query,
+    "update_trip": update_trip_query,
+    "update_trip_type": update_trip_type_query,
+    "delete_trip": delete_trip_query,
+    "update_ticket_null": update_ticket_null_query,
+    "attach_ticket": attach_ticket_query,
+}
+# Upsert (or delete) of a trip from its current SQLite data, queued for the trips
+# of a write that was given up on
+SYNC_TRIP = "sync_trip"
+
+_worker = None
+_worker_lock = threading.Lock()
+_wake_up = threading.Event()
+_pruned_at = 0
+
+
+def enqueue_pg_write(query_name, params, cursor=None):
+    """
+    Queue the Postgres query `query_name` (see PG_WRITE_QUERIES) with its
+    parameters. The caller is responsible for committing, which should be done
+    in the same transaction as the matching SQLite write.
+    """
+    if query_name not in PG_WRITE_QUERIES and query_name != SYNC_TRIP:
+        raise ValueError(f"Unknown pg write {query_name}")
+    with cursor_or_new(mainConn, cursor) as cursor:
+        cursor.execute(
+            """
+            INSERT INTO pg_outbox (query_name, params, created, attempts)
+            VALUES (?, ?, ?, 0)
+            """,
+            (query_name, json.dumps(params, default=str), time.time()),
+        )
+
+    ensure_pg_outbox_worker()
+    _wake_up.set()
+
+
+def _trip_ids(row):
+    """
+    Return the ids of the trips a queued write applies to
+    """
+    params = json.loads(row["params"])
+    return {int(params[key]) for key in ("trip_id", "new_trip_id") if key in params}
+
+
+def _has_work(now):
+    # checked without locking main.db, which is only locked to claim a batch
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            """
+            SELECT 1 FROM pg_outbox
+            WHERE attempts < ?
+            AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+            AND NOT EXISTS (SELECT 1 FROM pg_outbox WHERE claimed_until > ?)
+            LIMIT 1
+            """,
+            (OUTBOX_MAX_ATTEMPTS, now, now),
+        )
+        return cursor.fetchone() is not None
+
+
+def _claim_batch():
+    """
+    Claim the oldest queued writes, unless another worker holds a batch. Writes
+    waiting for their next attempt are skipped, and so are the later writes of
+    their trips.
+    """
+    now = time.time()
+    if not _has_work(now):
+        return []
+
+    mainConn.execute("BEGIN IMMEDIATE")
+    try:
+        with managed_cursor(mainConn) as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_outbox WHERE claimed_until > ? LIMIT 1", (now,)
+            )
+            if cursor.fetchone() is not None:
+                mainConn.rollback()
+                return []
+
+            cursor.execute(
+                """
+                SELECT * FROM pg_outbox
+                WHERE attempts < ?
+                ORDER BY uid
+                LIMIT ?
+                """,
+                (OUTBOX_MAX_ATTEMPTS, OUTBOX_SCAN_SIZE),
+            )
+            rows = []
+            held_back_trips = set()
+            for row in cursor.fetchall():
+                trip_ids = _trip_ids(row)
+                if trip_ids & held_back_trips or (row["next_attempt_at"] or 0) > now:
+                    held_back_trips |= trip_ids
+                    continue
+                rows.append(row)
+                if len(rows) == OUTBOX_BATCH_SIZE:
+                    break
+            if not rows:
+                mainConn.rollback()
+                return []
+
+            cursor.executemany(
+                "UPDATE pg_outbox SET claimed_until = ? WHERE uid = ?",
+                [(now + OUTBOX_CLAIM_TIMEOUT, row["uid"]) for row in rows],
+            )
+        mainConn.commit()
+        return rows
+    except Exception:
+        mainConn.rollback()
+        raise
+
+
+def _extend_claim(rows):
+    try:
+        with managed_cursor(mainConn) as cursor:
+            cursor.executemany(
+                "UPDATE pg_outbox SET claimed_until = ? WHERE uid = ?",
+                [(time.time() + OUTBOX_CLAIM_TIMEOUT, row["uid"]) for row in rows],
+            )
+        mainConn.commit()
+    except Exception:
+        mainConn.rollback()
+        raise
+
+
+def _sync_trip_write(trip_id):
+    """
+    Return the query and parameters bringing the pg trip to its sqlite data
+    """
+    # imported here as src.trips queues its writes through this module
+    from src.trips import COMPARED_TRIP_FIELDS, normalize_sqlite_trip
+    from src.utils import get_user_id
+
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute("SELECT * FROM trip WHERE uid = ?", (trip_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return delete_trip_query(), {"trip_id": trip_id}
+
+    trip = normalize_sqlite_trip(dict(row), get_user_id(row["username"]))
+    params = {field: trip[field] for field in COMPARED_TRIP_FIELDS}
+    # the carbon needs the path, the one in pg is kept
+    return insert_trip_query(), {**params, "trip_id": trip_id, "carbon": None}
+
+
+def _pg_write(row):
+    params = json.loads(row["params"])
+    if row["query_name"] == SYNC_TRIP:
+        return _sync_trip_write(params["trip_id"])
+    return PG_WRITE_QUERIES[row["query_name"]](), params
+
+
+def _apply_batch(rows):
+    """
+    Apply the claimed writes in order, in a single Postgres transaction. Return
+    the ids of the applied writes, and the failed writes with their error. The
+    writes of the trips of a failed write are left in the queue.
+    """
+    applied = []
+    failures = []
+    failed_trips = set()
+    extended_at = time.time()
+    with pg_session() as pg:
+        for row in rows:
+            trip_ids = _trip_ids(row)
+            if trip_ids & failed_trips:
+                failed_trips |= trip_ids
+                continue
+            if time.time() - extended_at > OUTBOX_CLAIM_TIMEOUT / 2:
+                _extend_claim(rows)
+                extended_at = time.time()
+
+            savepoint = pg.begin_nested()
+            try:
+                first_apply = pg.execute(
+                    """
+                    INSERT INTO pg_outbox_applied (uid) VALUES (:uid)
+                    ON CONFLICT DO NOTHING
+                    RETURNING uid
+                    """,
+                    {"uid": row["uid"]},
+                ).fetchone()
+                if first_apply is not None:
+                    pg.execute(*_pg_write(row))
+                savepoint.commit()
+            except Exception as e:
+                savepoint.rollback()
+                failures.append((row, e))
+                failed_trips |= trip_ids
+                continue
+            applied.append(row["uid"])
+    return applied, failures
+
+
+def _release_batch(rows, applied, failures):
+    now = time.time()
+    try:
+        with managed_cursor(mainConn) as cursor:
+            cursor.executemany(
+                "DELETE FROM pg_outbox WHERE uid = ?", [(uid,) for uid in applied]
+            )
+            for row, error in failures:
+                attempts = row["attempts"] + 1
+                cursor.execute(
+                    """
+                    UPDATE pg_outbox
+                    SET attempts = ?, next_attempt_at = ?, last_error = ?
+                    WHERE uid = ?
+                    """,
+                    (
+                        attempts,
+                        now + min(2**attempts, OUTBOX_MAX_BACKOFF),
+                        str(error),
+                        row["uid"],
+                    ),
+                )
+                if attempts < OUTBOX_MAX_ATTEMPTS:
+                    logger.warning(
+                        f"Pg write {row['uid']} ({row['query_name']}) failed, "
+                        f"attempt {attempts}/{OUTBOX_MAX_ATTEMPTS}: {error}"
+                    )
+                    continue
+
+                logger.error(
+                    f"Giving up on pg write {row['uid']} ({row['query_name']} "
+                    f"{row['params']}) after {attempts} attempts: {error}"
+                )
+                if row["query_name"] != SYNC_TRIP:
+                    for trip_id in _trip_ids(row):
+                        enqueue_pg_write(SYNC_TRIP, {"trip_id": trip_id}, cursor)
+            cursor.executemany(
+                "UPDATE pg_outbox SET claimed_until = NULL WHERE uid = ?",
+                [(row["uid"],) for row in rows],
+            )
+        mainConn.commit()
+    except Exception:
+        mainConn.rollback()
+        raise
+
+
+def _compare_applied_trips(rows, applied):
+    """
+    Check the trips whose writes were applied and that have no write left in the
+    queue, i.e. that should now be identical in SQLite and Postgres
+    """
+    # imported here as src.trips queues its writes through this module
+    from src.trips import compare_trip
+
+    applied = set(applied)
+    trip_ids = set()
+    for row in rows:
+        if row["uid"] in applied:
+            trip_ids |= _trip_ids(row)
+
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            """
+            SELECT json_extract(params, '$.trip_id') FROM pg_outbox
+            UNION SELECT json_extract(params, '$.new_trip_id') FROM pg_outbox
+            """
+        )
+        pending = {int(row[0]) for row in cursor.fetchall() if row[0] is not None}
+
+    for trip_id in trip_ids - pending:
+        compare_trip(trip_id)
+
+
+def _prune_applied():
+    """
+    Forget the applied writes older than OUTBOX_APPLIED_RETENTION_DAYS, at most
+    once an hour
+    """
+    global _pruned_at
+    if time.time() - _pruned_at < 3600:
+        return
+    with pg_session() as pg:
+        pg.execute(
+            """
+            DELETE FROM pg_outbox_applied
+            WHERE applied_at < NOW() - make_interval(days => :days)
+            """,
+            {"days": OUTBOX_APPLIED_RETENTION_DAYS},
+        )
+    _pruned_at = time.time()
+
+
+def process_pg_outbox():
+    """
+    Apply one batch of queued writes. Return the number of applied writes, or
+    None if there was nothing to do.
+    """
+    rows = _claim_batch()
+    if not rows:
+        return None
+    try:
+        applied, failures = _apply_batch(rows)
+    except Exception:
+        # nothing was applied, e.g. Postgres is down: no attempt is counted
+        _release_batch(rows, [], [])
+        raise
+    _release_batch(rows, applied, failures)
+    if applied:
+        _compare_applied_trips(rows, applied)
+    _prune_applied()
+    return len(applied)
+
+
+def get_pg_outbox_lag():
+    """
+    Return the number of queued and given up writes, the age in seconds of the
+    oldest queued write, and the trips of the given up writes (re-synced from
+    SQLite, but to be looked at)
+    """
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            """
+            SELECT
+                SUM(attempts < :max_attempts) AS pending,
+                MIN(CASE WHEN attempts < :max_attempts THEN created END) AS oldest
+            FROM pg_outbox
+            """,
+            {"max_attempts": OUTBOX_MAX_ATTEMPTS},
+        )
+        row = cursor.fetchone()
+        cursor.execute(
+            "SELECT params FROM pg_outbox WHERE attempts >= ?", (OUTBOX_MAX_ATTEMPTS,)
+        )
+        failed = cursor.fetchall()
+
+    failed_trips = set()
+    for failed_row in failed:
+        failed_trips |= _trip_ids(failed_row)
+    return {
+        "pending": row["pending"] or 0,
+        "failed": len(failed),
+        "failed_trip_ids": sorted(failed_trips),
+        "lag_seconds": time.time() - row["oldest"] if row["oldest"] else 0,
+    }
+
+
+def _run_worker():
+    while True:
+        try:
+            processed = process_pg_outbox()
+        except Exception as e:
+            logger.exception(f"Pg outbox worker error: {e}")
+            # a failed statement leaves the transaction open, which would make
+            # the next BEGIN IMMEDIATE fail and keep main.db locked
+            mainConn.rollback()
+            time.sleep(OUTBOX_ERROR_INTERVAL)
+            continue
+        if not processed:
+            # empty queue, batch held by another worker, or backing off
+            _wake_up.wait(OUTBOX_POLL_INTERVAL)
+            _wake_up.clear()
+
+
+def ensure_pg_outbox_worker():
+    """
+    Start the worker thread of the current process, if not started yet (threads do
+    not survive a fork, so each worker process starts its own)
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is not None and _worker[0] == os.getpid() and _worker[1].is_alive():
+            return
+        thread = threading.Thread(target=_run_worker, name="pg-outbox", daemon=True)
+        thread.start()
+        _worker = (os.getpid(), thread)
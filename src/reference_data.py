@@ -0,0 +1,35 @@
+"""
+Version of the reference tables of main.db
+
+The airports, stations, operators and logos are served to the application from an
+in-memory copy (see ReferenceConnection in src/db_connections.py). Every write to
+these tables bumps their version in the reference_versions table, so that each
+worker reloads its copy, whichever worker did the write.
+"""
+
+from src.utils import cursor_or_new, mainConn, refConn
+
+
+def bump_reference_version(table_name, cursor=None):
+    """
+    Mark the reference table as changed. The caller is responsible for committing
+    with commit_reference_write.
+    """
+    with cursor_or_new(mainConn, cursor) as cursor:
+        cursor.execute(
+            """
+            INSERT INTO reference_versions (table_name, version)
+            VALUES (?, 1)
+            ON CONFLICT (table_name) DO UPDATE SET version = version + 1
+            """,
+            (table_name,),
+        )
+
+
+def commit_reference_write():
+    """
+    Commit a write to the reference tables, and have this worker reload its copy on
+    its next query. Checking before the commit would read the previous version.
+    """
+    mainConn.commit()
+    refConn.invalidate()
@@ -0,0 +1,53 @@
+-- Daily EUR reference rates, mirrored from the exchanges table of main.db
+-- (one row per day and currency, `rate` being the amount of `currency` for 1 EUR)
+CREATE TABLE exchanges (
+    rate_date DATE NOT NULL,
+    currency VARCHAR(3) NOT NULL,
+    rate DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (currency, rate_date)
+);
+
+-- Rate of `rate_currency` on the closest day on or before `rate_at`, or on the
+-- first known day when `rate_at` is older than the history
+CREATE OR REPLACE FUNCTION exchange_rate(rate_currency TEXT, rate_at TIMESTAMP)
+RETURNS DOUBLE PRECISION AS $$
+    SELECT CASE
+        WHEN rate_currency = 'EUR' THEN 1
+        ELSE COALESCE(
+            (
+                SELECT e.rate FROM exchanges e
+                WHERE e.currency = rate_currency AND e.rate_date <= rate_at::date
+                ORDER BY e.rate_date DESC
+                LIMIT 1
+            ),
+            (
+                SELECT e.rate FROM exchanges e
+                WHERE e.currency = rate_currency AND e.rate_date > rate_at::date
+                ORDER BY e.rate_date ASC
+                LIMIT 1
+            )
+        )
+    END
+$$ LANGUAGE SQL STABLE;
+
+-- Convert a price between two currencies at the rate of the given day, rounded to
+-- the cent. NULL when one of the currencies is unknown.
+CREATE OR REPLACE FUNCTION convert_price(
+    price DOUBLE PRECISION,
+    base_currency TEXT,
+    target_currency TEXT,
+    price_at TIMESTAMP
+)
+RETURNS DOUBLE PRECISION AS $$
+    SELECT CASE
+        WHEN base_currency = target_currency THEN price
+        ELSE ROUND(
+            (
+                price
+                / NULLIF(exchange_rate(base_currency, price_at), 0)
+                * exchange_rate(target_currency, price_at)
+            )::NUMERIC,
+            2
+        )::DOUBLE PRECISION
+    END
+$$ LANGUAGE SQL STABLE;
@@ -0,0 +1,9 @@
+-- High-water marks of the last SQLite -> PG trips sync (see src/db_sync.py):
+-- trips modified after `last_modified` or with an id above `last_trip_id` are
+-- synced by the next incremental sync
+CREATE TABLE trips_sync (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    last_modified TIMESTAMP,
+    last_trip_id INTEGER,
+    synced_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,9 @@
+-- Writes of the pg outbox (uids of the pg_outbox table of main.db) already
+-- applied, recorded in the same transaction as the write so that a write applied
+-- again (crash before it was removed from the queue, expired claim) is skipped
+CREATE TABLE pg_outbox_applied (
+    uid BIGINT PRIMARY KEY,
+    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX pg_outbox_applied_applied_at ON pg_outbox_applied (applied_at);
@@ -57,4 +57,31 @@ SELECT
     purchase_date
 FROM trips
 WHERE trip_id = :trip_id
+ON CONFLICT (trip_id) DO UPDATE SET
+    user_id = EXCLUDED.user_id,
+    origin_station = EXCLUDED.origin_station,
+    destination_station = EXCLUDED.destination_station,
+    start_datetime = EXCLUDED.start_datetime,
+    end_datetime = EXCLUDED.end_datetime,
+    is_project = EXCLUDED.is_project,
+    utc_start_datetime = EXCLUDED.utc_start_datetime,
+    utc_end_datetime = EXCLUDED.utc_end_datetime,
+    estimated_trip_duration = EXCLUDED.estimated_trip_duration,
+    manual_trip_duration = EXCLUDED.manual_trip_duration,
+    trip_length = EXCLUDED.trip_length,
+    operator = EXCLUDED.operator,
+    countries = EXCLUDED.countries,
+    line_name = EXCLUDED.line_name,
+    created = EXCLUDED.created,
+    last_modified = EXCLUDED.last_modified,
+    trip_type = EXCLUDED.trip_type,
+    material_type = EXCLUDED.material_type,
+    seat = EXCLUDED.seat,
+    reg = EXCLUDED.reg,
+    waypoints = EXCLUDED.waypoints,
+    notes = EXCLUDED.notes,
+    price = EXCLUDED.price,
+    currency = EXCLUDED.currency,
+    ticket_id = EXCLUDED.ticket_id,
+    purchase_date = EXCLUDED.purchase_date
 RETURNING trip_id
@@ -0,0 +1,117 @@
+"""
+Per-trip extreme points
+
+The northernmost, westernmost, southernmost and easternmost points of every trip
+path are stored in the trip_bounds table of main.db when the trip is saved, so
+that the bounds of all the trips of a user can be aggregated without reading
+their paths. Trips saved before the table existed are filled in when first read.
+"""
+
+import numpy as np
+
+from src.path_arrays import load_path_arrays
+from src.utils import batched_ids, cursor_or_new, mainConn, managed_cursor
+
+DIRECTIONS = ("north", "west", "south", "east")
+
+_bounds_columns = ", ".join(
+    f"{direction}_lat, {direction}_lng" for direction in DIRECTIONS
+)
+
+
+def compute_trip_bounds(trip_ids):
+    """
+    Compute the extreme points of the paths of the given trips
+
+    Returns a dict trip_id -> {direction: (lat, lng)}. In case of ties, the first
+    point of the path is kept.
+    """
+    paths = load_path_arrays(trip_ids)
+    bounds = {}
+    for trip_id, coords in paths.items():
+        if len(coords) == 0:
+            continue
+        extremes = {
+            "north": np.argmax(coords[:, 0]),
+            "west": np.argmin(coords[:, 1]),
+            "south": np.argmin(coords[:, 0]),
+            "east": np.argmax(coords[:, 1]),
+        }
+        bounds[trip_id] = {
+            direction: tuple(coords[index].tolist())
+            for direction, index in extremes.items()
+        }
+    return bounds
+
+
+def _store_trip_bounds(cursor, bounds):
+    cursor.executemany(
+        f"""
+        INSERT OR REPLACE INTO trip_bounds (trip_id, {_bounds_columns})
+        VALUES (?, {", ".join(["?"] * 2 * len(DIRECTIONS))})
+        """,
+        [
+            (trip_id,)
+            + tuple(value for direction in DIRECTIONS for value in extremes[direction])
+            for trip_id, extremes in bounds.items()
+        ],
+    )
+
+
+def update_trip_bounds(trip_ids):
+    """
+    (Re)compute and store the extreme points of the given trips, to be called once
+    their path is saved
+    """
+    bounds = compute_trip_bounds(trip_ids)
+    with managed_cursor(mainConn) as cursor:
+        delete_trip_bounds(trip_ids, cursor)
+        _store_trip_bounds(cursor, bounds)
+    mainConn.commit()
+
+
+def get_trips_bounds(trip_ids):
+    """
+    Return the extreme points of the given trips as a list of
+    (trip_id, {direction: (lat, lng)}), following the order of `trip_ids`.
+    Trips without a path are left out.
+    """
+    trip_ids = list(dict.fromkeys(trip_ids))
+    bounds = {}
+    with managed_cursor(mainConn) as cursor:
+        for batch, placeholders in batched_ids(trip_ids):
+            cursor.execute(
+                f"""
+                SELECT trip_id, {_bounds_columns} FROM trip_bounds
+                WHERE trip_id IN ({placeholders})
+                """,
+                batch,
+            )
+            for row in cursor.fetchall():
+                bounds[row["trip_id"]] = {
+                    direction: (row[f"{direction}_lat"], row[f"{direction}_lng"])
+                    for direction in DIRECTIONS
+                }
+
+    missing = [trip_id for trip_id in trip_ids if trip_id not in bounds]
+    if missing:
+        computed = compute_trip_bounds(missing)
+        with managed_cursor(mainConn) as cursor:
+            _store_trip_bounds(cursor, computed)
+        mainConn.commit()
+        bounds.update(computed)
+
+    return [(trip_id, bounds[trip_id]) for trip_id in trip_ids if trip_id in bounds]
+
+
+def delete_trip_bounds(trip_ids, cursor=None):
+    """
+    Drop the extreme points of the given trips. The caller is responsible for
+    committing.
+    """
+    trip_ids = list(trip_ids)
+    with cursor_or_new(mainConn, cursor) as cursor:
+        for batch, placeholders in batched_ids(trip_ids):
+            cursor.execute(
+                f"DELETE FROM trip_bounds WHERE trip_id IN ({placeholders})", batch
+            )
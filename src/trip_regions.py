@@ -0,0 +1,124 @@
+"""
+Per-trip cache of the region polygons traversed by each trip
+
+For each (trip, region file) pair, the ids of the polygons of
+country_percent/countries/processed/<cc>.geojson crossed by the trip path are stored
+in the trip_regions table of main.db. They are computed the first time the region
+page needs them, and dropped when the trip path changes or the region file is
+edited, so the region page only has to union small id sets.
+"""
+
+import json
+
+import numpy as np
+
+from py import geopip_country
+from src.path_arrays import load_path_arrays
+from src.utils import batched_ids, cursor_or_new, mainConn, managed_cursor
+
+
+def _path_nodes(paths):
+    """
+    Return the nodes and segment midpoints of every path, with the index of the path
+    each of them belongs to
+    """
+    coords = paths.coords
+    segment_mask = paths.segment_mask()
+    midpoints = ((coords[:-1] + coords[1:]) / 2)[segment_mask]
+    path_index = paths.point_path_index()
+    nodes = np.concatenate([coords, midpoints])
+    node_path_index = np.concatenate([path_index, path_index[:-1][segment_mask]])
+    return nodes, node_path_index
+
+
+def compute_trip_regions(cc, trip_ids):
+    """
+    Compute the ids of the polygons of `cc` traversed by each trip
+
+    Returns a dict trip_id -> sorted list of polygon ids. All the trips are resolved
+    with a single bulk point in polygon query.
+    """
+    paths = load_path_arrays(trip_ids)
+    regions = {trip_id: set() for trip_id in paths.trip_ids.tolist()}
+    if len(paths.coords) == 0:
+        return {trip_id: [] for trip_id in regions}
+
+    nodes, node_path_index = _path_nodes(paths)
+    # a node shared by several trips is looked up once
+    unique_nodes, inverse = np.unique(nodes, axis=0, return_inverse=True)
+    polygons = geopip_country.search_many(cc, unique_nodes)
+
+    for polygon_index, path_index in set(
+        zip(inverse.reshape(-1).tolist(), node_path_index.tolist())
+    ):
+        polygon = polygons[polygon_index]
+        if polygon is not None:
+            regions[int(paths.trip_ids[path_index])].add(polygon["id"])
+
+    return {trip_id: sorted(ids) for trip_id, ids in regions.items()}
+
+
+def get_traveled_region_ids(cc, trip_ids):
+    """
+    Return the set of polygon ids of `cc` traversed by any of the given trips,
+    computing and storing the missing per-trip entries
+    """
+    trip_ids = list(dict.fromkeys(trip_ids))
+    traveled = set()
+    cached = set()
+
+    with managed_cursor(mainConn) as cursor:
+        for batch, placeholders in batched_ids(trip_ids, reserved=1):
+            cursor.execute(
+                f"""
+                SELECT trip_id, region_ids FROM trip_regions
+                WHERE cc = ? AND trip_id IN ({placeholders})
+                """,
+                [cc] + batch,
+            )
+            for row in cursor.fetchall():
+                cached.add(row["trip_id"])
+                traveled.update(json.loads(row["region_ids"]))
+
+    missing = [trip_id for trip_id in trip_ids if trip_id not in cached]
+    if missing:
+        computed = compute_trip_regions(cc, missing)
+        with managed_cursor(mainConn) as cursor:
+            cursor.executemany(
+                """
+                INSERT OR REPLACE INTO trip_regions (trip_id, cc, region_ids)
+                VALUES (?, ?, ?)
+                """,
+                [
+                    (trip_id, cc, json.dumps(region_ids))
+                    for trip_id, region_ids in computed.items()
+                ],
+            )
+        mainConn.commit()
+        for region_ids in computed.values():
+            traveled.update(region_ids)
+
+    return traveled
+
+
+def delete_trip_regions(trip_ids, cursor=None):
+    """
+    Drop the cached regions of the given trips, to be called when their path changes
+    or when they are deleted. The caller is responsible for committing.
+    """
+    trip_ids = list(trip_ids)
+    with cursor_or_new(mainConn, cursor) as cursor:
+        for batch, placeholders in batched_ids(trip_ids):
+            cursor.execute(
+                f"DELETE FROM trip_regions WHERE trip_id IN ({placeholders})", batch
+            )
+
+
+def delete_region(cc):
+    """
+    Drop the cached regions of every trip for `cc`, to be called when its polygons
+    are edited
+    """
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute("DELETE FROM trip_regions WHERE cc = ?", (cc,))
+    mainConn.commit()
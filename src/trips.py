@@ -3,22 +3,20 @@ import json
 import logging
 import traceback
 
-from flask import abort, request
+from flask import abort, has_request_context, request
 
 from py.sql import deletePathQuery, getUserLines, saveQuery, updatePath, updateTripQuery
 from py.utils import getCountriesFromPath
 from src.consts import TripTypes
+from src.map_versions import bump_map_version, bump_trips_map_version
+from src.path_codec import decode_path, encode_path
+from src.path_lod import delete_simplified_paths, update_simplified_paths
 from src.paths import Path
-from src.pg import get_or_create_pg_session, pg_session
-from src.sql.trips import (
-    attach_ticket_query,
-    delete_trip_query,
-    duplicate_trip_query,
-    insert_trip_query,
-    update_ticket_null_query,
-    update_trip_query,
-    update_trip_type_query,
-)
+from src.pg import pg_session
+from src.pg_outbox import enqueue_pg_write
+from src.trip_bounds import delete_trip_bounds, update_trip_bounds
+from src.trip_regions import delete_trip_regions
+from src.visited_squares import add_trip_squares, remove_trip_squares
 from src.utils import (
     get_user_id,
     getUser,
@@ -105,50 +103,50 @@ class Trip:
         return tuple(vars(self).values())
 
 
-def create_trip(trip: Trip, pg_session=None):
-    with get_or_create_pg_session(pg_session) as pg:
-        if trip.trip_id is None:
-            # need to create the trip in sqlite first
-            trip.trip_id = _create_trip_in_sqlite(trip)
-
-        pg.execute(
-            insert_trip_query(),
-            {
-                "trip_id": trip.trip_id,
-                "user_id": trip.user_id,
-                "origin_station": trip.origin_station,
-                "destination_station": trip.destination_station,
-                "start_datetime": trip.start_datetime,
-                "end_datetime": trip.end_datetime,
-                "is_project": trip.is_project,
-                "utc_start_datetime": trip.utc_start_datetime,
-                "utc_end_datetime": trip.utc_end_datetime,
-                "estimated_trip_duration": trip.estimated_trip_duration,
-                "manual_trip_duration": trip.manual_trip_duration,
-                "trip_length": trip.trip_length,
-                "operator": trip.operator,
-                "countries": trip.countries,
-                "line_name": trip.line_name,
-                "created": trip.created,
-                "last_modified": trip.last_modified,
-                "trip_type": trip.type,
-                "material_type": trip.material_type,
-                "seat": trip.seat,
-                "reg": trip.reg,
-                "waypoints": trip.waypoints,
-                "notes": trip.notes,
-                "price": trip.price,
-                "currency": trip.currency,
-                "ticket_id": trip.ticket_id,
-                "purchase_date": trip.purchasing_date,
-                "carbon": trip.carbon
-            },
-        )
+def create_trip(trip: Trip):
+    if trip.trip_id is None:
+        # the pg insert is queued in the same sqlite transaction as the trip
+        trip.trip_id = _create_trip_in_sqlite(trip)
+    else:
+        enqueue_pg_write("insert_trip", _insert_trip_params(trip, trip.trip_id))
+        mainConn.commit()
 
-    compare_trip(trip.trip_id)
     logger.info(f"Successfully created trip {trip.trip_id}")
 
 
+def _insert_trip_params(trip: Trip, trip_id):
+    return {
+        "trip_id": trip_id,
+        "user_id": trip.user_id,
+        "origin_station": trip.origin_station,
+        "destination_station": trip.destination_station,
+        "start_datetime": trip.start_datetime,
+        "end_datetime": trip.end_datetime,
+        "is_project": trip.is_project,
+        "utc_start_datetime": trip.utc_start_datetime,
+        "utc_end_datetime": trip.utc_end_datetime,
+        "estimated_trip_duration": trip.estimated_trip_duration,
+        "manual_trip_duration": trip.manual_trip_duration,
+        "trip_length": trip.trip_length,
+        "operator": trip.operator,
+        "countries": trip.countries,
+        "line_name": trip.line_name,
+        "created": trip.created,
+        "last_modified": trip.last_modified,
+        "trip_type": trip.type,
+        "material_type": trip.material_type,
+        "seat": trip.seat,
+        "reg": trip.reg,
+        "waypoints": trip.waypoints,
+        "notes": trip.notes,
+        "price": trip.price,
+        "currency": trip.currency,
+        "ticket_id": trip.ticket_id,
+        "purchase_date": trip.purchasing_date,
+        "carbon": trip.carbon
+    }
+
+
 def _create_trip_in_sqlite(trip: Trip):
     """
     Temporary function to write trips in sqlite
@@ -231,6 +229,8 @@ def _create_trip_in_sqlite(trip: Trip):
             )
             # Retrieve the trip_id directly from the INSERT statement
             trip_id = cursor.fetchone()[0]
+            bump_map_version(trip.username, cursor)
+            enqueue_pg_write("insert_trip", _insert_trip_params(trip, trip_id), cursor)
 
         # Prepare the path data with the obtained trip_id
         if isinstance(trip.path, Path):
@@ -253,6 +253,9 @@ def _create_trip_in_sqlite(trip: Trip):
         mainConn.commit()
         pathConn.commit()
 
+        update_trip_bounds([trip_id])
+        update_simplified_paths([trip_id])
+        add_trip_squares(trip_id)
         return trip_id
     except Exception as e:
         # Rollback both transactions in case of error
@@ -263,18 +266,7 @@ def _create_trip_in_sqlite(trip: Trip):
 
 
 def duplicate_trip(trip_id: int):
-    with pg_session() as pg:
-        new_trip_id = _duplicate_trip_in_sqlite(trip_id)
-        pg.execute(
-            duplicate_trip_query(),
-            {
-                "trip_id": trip_id,
-                "new_trip_id": new_trip_id,
-            },
-        )
-
-    compare_trip(trip_id)
-    compare_trip(new_trip_id)
+    new_trip_id = _duplicate_trip_in_sqlite(trip_id)
     logger.info(f"Successfully duplicated trip {trip_id} into {new_trip_id}")
     return new_trip_id
 
@@ -301,6 +293,12 @@ def _duplicate_trip_in_sqlite(trip_id):
             insert_query = f"INSERT INTO trip ({columns_str}) VALUES ({placeholders})"
             cursor.execute(insert_query, row_to_duplicate)
             new_trip_id = cursor.lastrowid
+            bump_trips_map_version([new_trip_id], cursor)
+            enqueue_pg_write(
+                "duplicate_trip",
+                {"trip_id": trip_id, "new_trip_id": new_trip_id},
+                cursor,
+            )
     with managed_cursor(pathConn) as cursor:
         cursor.execute("select path from paths where trip_id = ?", (trip_id,))
         path_to_duplicate = cursor.fetchone()["path"]
@@ -310,55 +308,61 @@ def _duplicate_trip_in_sqlite(trip_id):
         )
     mainConn.commit()
     pathConn.commit()
+    update_trip_bounds([new_trip_id])
+    update_simplified_paths([new_trip_id])
+    add_trip_squares(new_trip_id)
     return new_trip_id
 
 
 def update_trip(trip_id: int, trip: Trip, formData=None, updateCreated=False):
-    with pg_session() as pg:
-        _update_trip_in_sqlite(formData, trip.last_modified, trip_id, updateCreated)
-        print(trip.carbon)
-        pg.execute(
-            update_trip_query(),
-            {
-                "trip_id": trip_id,
-                "origin_station": trip.origin_station,
-                "destination_station": trip.destination_station,
-                "start_datetime": trip.start_datetime,
-                "end_datetime": trip.end_datetime,
-                "is_project": trip.is_project,
-                "utc_start_datetime": trip.utc_start_datetime,
-                "utc_end_datetime": trip.utc_end_datetime,
-                "estimated_trip_duration": trip.estimated_trip_duration,
-                "manual_trip_duration": trip.manual_trip_duration,
-                "trip_length": trip.trip_length,
-                "operator": trip.operator,
-                "countries": trip.countries,
-                "line_name": trip.line_name,
-                "created": trip.created,
-                "last_modified": trip.last_modified,
-                "trip_type": trip.type,
-                "material_type": trip.material_type,
-                "seat": trip.seat,
-                "reg": trip.reg,
-                "waypoints": trip.waypoints,
-                "notes": trip.notes,
-                "price": trip.price if trip.price != "" else None,
-                "currency": trip.currency,
-                "ticket_id": trip.ticket_id if trip.ticket_id != "" else None,
-                "purchase_date": trip.purchasing_date,
-                "carbon": trip.carbon
-            },
-        )
-
-    compare_trip(trip_id)
+    _update_trip_in_sqlite(
+        formData,
+        trip.last_modified,
+        trip_id,
+        updateCreated,
+        pg_params=_update_trip_params(trip, trip_id),
+    )
     logger.info(f"Successfully updated trip {trip_id}")
 
 
+def _update_trip_params(trip: Trip, trip_id):
+    return {
+        "trip_id": trip_id,
+        "origin_station": trip.origin_station,
+        "destination_station": trip.destination_station,
+        "start_datetime": trip.start_datetime,
+        "end_datetime": trip.end_datetime,
+        "is_project": trip.is_project,
+        "utc_start_datetime": trip.utc_start_datetime,
+        "utc_end_datetime": trip.utc_end_datetime,
+        "estimated_trip_duration": trip.estimated_trip_duration,
+        "manual_trip_duration": trip.manual_trip_duration,
+        "trip_length": trip.trip_length,
+        "operator": trip.operator,
+        "countries": trip.countries,
+        "line_name": trip.line_name,
+        "created": trip.created,
+        "last_modified": trip.last_modified,
+        "trip_type": trip.type,
+        "material_type": trip.material_type,
+        "seat": trip.seat,
+        "reg": trip.reg,
+        "waypoints": trip.waypoints,
+        "notes": trip.notes,
+        "price": trip.price if trip.price != "" else None,
+        "currency": trip.currency,
+        "ticket_id": trip.ticket_id if trip.ticket_id != "" else None,
+        "purchase_date": trip.purchasing_date,
+        "carbon": trip.carbon
+    }
+
+
 def _update_trip_in_sqlite(
     formData,
     last_modified,
     tripId=None,
     updateCreated=False,
+    pg_params=None,
 ):
     if tripId is None:
         tripId = formData["trip_id"]
@@ -381,7 +385,7 @@ def _update_trip_in_sqlite(
     if "path" in formData.keys():
         path = [[coord["lat"], coord["lng"]] for coord in json.loads(formData["path"])]
     else:
-        path = json.loads(pathResult["path"])
+        path = decode_path(pathResult["path"])
 
     limits = [
         {
@@ -445,21 +449,32 @@ def _update_trip_in_sqlite(
     ]
     formattedUpdateQuery = updateTripQuery.format(values=", ".join(formatted_values))
 
-    with managed_cursor(mainConn) as cursor:
-        cursor.execute(formattedUpdateQuery, {**updateData})
-    if path:
-        with managed_cursor(pathConn) as cursor:
-            cursor.execute(updatePath, {"trip_id": int(tripId), "path": str(path)})
-        pathConn.commit()
-    mainConn.commit()
+    try:
+        with managed_cursor(mainConn) as cursor:
+            remove_trip_squares(tripId, cursor)
+            cursor.execute(formattedUpdateQuery, {**updateData})
+            delete_trip_regions([tripId], cursor)
+            bump_trips_map_version([tripId], cursor)
+            if pg_params is not None:
+                enqueue_pg_write("update_trip", pg_params, cursor)
+        if path:
+            with managed_cursor(pathConn) as cursor:
+                cursor.execute(
+                    updatePath, {"trip_id": int(tripId), "path": encode_path(path)}
+                )
+            pathConn.commit()
+        mainConn.commit()
+    except Exception:
+        mainConn.rollback()
+        pathConn.rollback()
+        raise
+    update_trip_bounds([tripId])
+    update_simplified_paths([tripId])
+    add_trip_squares(tripId)
 
 
 def delete_trip(trip_id: int, username: str):
-    with pg_session() as pg:
-        _delete_trip_in_sqlite(username, trip_id)
-        pg.execute(delete_trip_query(), {"trip_id": trip_id})
-
-    compare_trip(trip_id)
+    _delete_trip_in_sqlite(username, trip_id)
     logger.info(f"Successfully deleted trip {trip_id}")
 
 
@@ -477,34 +492,52 @@ def _delete_trip_in_sqlite(username, tripId):
         elif row["username"] != username:
             abort(404)  # Trip exists but doesn't belong to the user
 
-        # Delete only if the trip exists and belongs to the user
-        cursor.execute("DELETE FROM trip WHERE uid = :trip_id", {"trip_id": tripId})
-        cursor.execute(
-            "DELETE FROM tags_associations WHERE trip_id = :trip_id",
-            {"trip_id": tripId},
-        )
+    try:
+        with managed_cursor(mainConn) as cursor:
+            # Delete only if the trip exists and belongs to the user
+            remove_trip_squares(tripId, cursor)
+            bump_map_version(username, cursor)
+            cursor.execute(
+                "DELETE FROM trip WHERE uid = :trip_id", {"trip_id": tripId}
+            )
+            cursor.execute(
+                "DELETE FROM tags_associations WHERE trip_id = :trip_id",
+                {"trip_id": tripId},
+            )
+            delete_trip_regions([tripId], cursor)
+            delete_trip_bounds([tripId], cursor)
+            enqueue_pg_write("delete_trip", {"trip_id": tripId}, cursor)
 
-    with managed_cursor(pathConn) as cursor:
-        cursor.execute(deletePathQuery, {"trip_id": tripId})
-    mainConn.commit()
-    pathConn.commit()
+        with managed_cursor(pathConn) as cursor:
+            cursor.execute(deletePathQuery, {"trip_id": tripId})
+            delete_simplified_paths([tripId], cursor)
+        mainConn.commit()
+        pathConn.commit()
+    except Exception:
+        mainConn.rollback()
+        pathConn.rollback()
+        raise
 
 
 def update_trip_type(trip_id, new_type: TripTypes):
-    with pg_session() as pg:
-        update_trip_type_in_sqlite(trip_id, new_type)
-        pg.execute(
-            update_trip_type_query(), {"trip_id": trip_id, "trip_type": new_type.value}
-        )
+    update_trip_type_in_sqlite(trip_id, new_type)
 
 
 def update_trip_type_in_sqlite(trip_id, new_type: TripTypes):
     with managed_cursor(mainConn) as cursor:
+        remove_trip_squares(trip_id, cursor)
         cursor.execute(
             "UPDATE trip SET type = :newType WHERE uid = :tripId",
             {"newType": new_type.value, "tripId": trip_id},
         )
+        bump_trips_map_version([trip_id], cursor)
+        enqueue_pg_write(
+            "update_trip_type",
+            {"trip_id": trip_id, "trip_type": new_type.value},
+            cursor,
+        )
     mainConn.commit()
+    add_trip_squares(trip_id)
 
 
 def delete_ticket_from_db(username, ticket_id):
@@ -531,16 +564,13 @@ def delete_ticket_from_db(username, ticket_id):
                 "UPDATE trip SET ticket_id = NULL WHERE username = ? AND ticket_id = ?",
                 (username, ticket_id),
             )
+            bump_map_version(username, cursor)
             cursor.execute(
                 "DELETE FROM tickets WHERE username = ? AND uid = ?",
                 (username, ticket_id),
             )
-
-        with pg_session() as pg:
             for trip_id in trip_ids:
-                pg.execute(update_ticket_null_query(), {"trip_id": trip_id})
-        for trip_id in trip_ids:
-            compare_trip(trip_id)
+                enqueue_pg_write("update_ticket_null", {"trip_id": trip_id}, cursor)
 
         mainConn.commit()
         return True, None
@@ -581,14 +611,11 @@ def attach_ticket_to_trips(username, ticket_id, trip_ids):
                 """,
                 [ticket_id, username] + trip_ids,
             )
-
-        with pg_session() as pg:
+            bump_map_version(username, cursor)
             for trip_id in trip_ids:
-                pg.execute(
-                    attach_ticket_query(), {"trip_id": trip_id, "ticket_id": ticket_id}
+                enqueue_pg_write(
+                    "attach_ticket", {"trip_id": trip_id, "ticket_id": ticket_id}, cursor
                 )
-        for trip_id in trip_ids:
-            compare_trip(trip_id)
 
         mainConn.commit()
         return True, None
@@ -597,19 +624,23 @@ def attach_ticket_to_trips(username, ticket_id, trip_ids):
         return False, str(e)
 
 
+# Datetimes that may differ by up to a second between sqlite and pg
+ROUNDED_DATETIME_FIELDS = (
+    "start_datetime",
+    "utc_start_datetime",
+    "created",
+    "last_modified",
+    "purchase_date",
+)
+
+
 def ensure_values_equal(sqlite_trip, pg_trip, property_name):
     sqlite_val = sqlite_trip[property_name]
     pg_val = pg_trip[property_name]
 
     if sqlite_val is None and pg_val is None:
         values_are_equal = True
-    elif property_name in [
-        "start_datetime",
-        "utc_start_datetime",
-        "created",
-        "last_modified",
-        "purchase_date",
-    ]:
+    elif property_name in ROUNDED_DATETIME_FIELDS:
         values_are_equal = abs(pg_val - sqlite_val) <= datetime.timedelta(seconds=1)
     else:
         values_are_equal = pg_val == sqlite_val
@@ -647,9 +678,99 @@ def parse_date(date: str):
         raise
 
 
-def compare_trip(trip_id: int):
+# Fields of the pg trips compared with their sqlite counterpart
+COMPARED_TRIP_FIELDS = (
+    "user_id",
+    "origin_station",
+    "destination_station",
+    "start_datetime",
+    "end_datetime",
+    "is_project",
+    "utc_start_datetime",
+    "utc_end_datetime",
+    "estimated_trip_duration",
+    "manual_trip_duration",
+    "trip_length",
+    "operator",
+    "countries",
+    "line_name",
+    "created",
+    "last_modified",
+    "trip_type",
+    "material_type",
+    "seat",
+    "reg",
+    "waypoints",
+    "notes",
+    "price",
+    "currency",
+    "ticket_id",
+    "purchase_date",
+)
+
+
+def normalize_sqlite_trip(sqlite_trip, user_id):
     """
-    Check that the given trip has the same data in sqlite and pg
+    Convert a sqlite trip (as a dict) to the names and values of its pg counterpart
+    """
+    sqlite_trip["trip_id"] = sqlite_trip["uid"]
+    sqlite_trip["user_id"] = user_id
+    sqlite_trip["is_project"] = (
+        sqlite_trip["start_datetime"] == 1 or sqlite_trip["end_datetime"] == 1
+    )
+    if sqlite_trip["start_datetime"] in [-1, 1]:
+        sqlite_trip["start_datetime"] = None
+    else:
+        sqlite_trip["start_datetime"] = parse_date(sqlite_trip["start_datetime"])
+    if sqlite_trip["end_datetime"] in [-1, 1]:
+        sqlite_trip["end_datetime"] = None
+    else:
+        sqlite_trip["end_datetime"] = parse_date(sqlite_trip["end_datetime"])
+    if sqlite_trip["utc_start_datetime"] is not None:
+        sqlite_trip["utc_start_datetime"] = parse_date(
+            sqlite_trip["utc_start_datetime"]
+        )
+    if sqlite_trip["utc_end_datetime"] is not None:
+        sqlite_trip["utc_end_datetime"] = parse_date(
+            sqlite_trip["utc_end_datetime"]
+        )
+    if sqlite_trip["operator"] == "":
+        sqlite_trip["operator"] = None
+    if sqlite_trip["operator"] is not None:
+        sqlite_trip["operator"] = str(sqlite_trip["operator"])
+    if sqlite_trip["line_name"] == "":
+        sqlite_trip["line_name"] = None
+    if sqlite_trip["created"] is not None:
+        sqlite_trip["created"] = parse_date(sqlite_trip["created"])
+    if sqlite_trip["last_modified"] is not None:
+        sqlite_trip["last_modified"] = parse_date(sqlite_trip["last_modified"])
+    sqlite_trip["trip_type"] = sqlite_trip["type"]
+    if sqlite_trip["material_type"] == "":
+        sqlite_trip["material_type"] = None
+    if sqlite_trip["seat"] == "":
+        sqlite_trip["seat"] = None
+    if sqlite_trip["reg"] == "":
+        sqlite_trip["reg"] = None
+    if sqlite_trip["waypoints"] == "":
+        sqlite_trip["waypoints"] = None
+    if sqlite_trip["notes"] == "":
+        sqlite_trip["notes"] = None
+    if sqlite_trip["price"] == "":
+        sqlite_trip["price"] = None
+    if sqlite_trip["ticket_id"] == "":
+        sqlite_trip["ticket_id"] = None
+    sqlite_trip["purchase_date"] = sqlite_trip["purchasing_date"]
+    if sqlite_trip["purchase_date"] == "":
+        sqlite_trip["purchase_date"] = None
+    if sqlite_trip["purchase_date"] is not None:
+        sqlite_trip["purchase_date"] = parse_date(sqlite_trip["purchase_date"])
+    return sqlite_trip
+
+
+def compare_trip(trip_id: int, report=True):
+    """
+    Check that the given trip has the same data in sqlite and pg, and report it to
+    the owner if not (unless `report` is False). Return whether it does.
     """
     try:
         with managed_cursor(mainConn) as cursor:
@@ -665,7 +786,7 @@ def compare_trip(trip_id: int):
             ).fetchone()
 
         if sqlite_trip is None and pg_trip is None:
-            return
+            return True
         if sqlite_trip is None or pg_trip is None:
             msg = (
                 f"Trip {trip_id} exists in one db but not the other: "
@@ -674,91 +795,26 @@ def compare_trip(trip_id: int):
             logger.error(msg)
             raise Exception(msg)
 
-        sqlite_trip["trip_id"] = sqlite_trip["uid"]
-        sqlite_trip["user_id"] = get_user_id(sqlite_trip["username"])
-        sqlite_trip["is_project"] = (
-            sqlite_trip["start_datetime"] == 1 or sqlite_trip["end_datetime"] == 1
+        sqlite_trip = normalize_sqlite_trip(
+            sqlite_trip, get_user_id(sqlite_trip["username"])
         )
-        if sqlite_trip["start_datetime"] in [-1, 1]:
-            sqlite_trip["start_datetime"] = None
-        else:
-            sqlite_trip["start_datetime"] = parse_date(sqlite_trip["start_datetime"])
-        if sqlite_trip["end_datetime"] in [-1, 1]:
-            sqlite_trip["end_datetime"] = None
-        else:
-            sqlite_trip["end_datetime"] = parse_date(sqlite_trip["end_datetime"])
-        if sqlite_trip["utc_start_datetime"] is not None:
-            sqlite_trip["utc_start_datetime"] = parse_date(
-                sqlite_trip["utc_start_datetime"]
-            )
-        if sqlite_trip["utc_end_datetime"] is not None:
-            sqlite_trip["utc_end_datetime"] = parse_date(
-                sqlite_trip["utc_end_datetime"]
-            )
-        if sqlite_trip["operator"] == "":
-            sqlite_trip["operator"] = None
-        if sqlite_trip["operator"] is not None:
-            sqlite_trip["operator"] = str(sqlite_trip["operator"])
-        if sqlite_trip["line_name"] == "":
-            sqlite_trip["line_name"] = None
-        if sqlite_trip["created"] is not None:
-            sqlite_trip["created"] = parse_date(sqlite_trip["created"])
-        if sqlite_trip["last_modified"] is not None:
-            sqlite_trip["last_modified"] = parse_date(sqlite_trip["last_modified"])
-        sqlite_trip["trip_type"] = sqlite_trip["type"]
-        if sqlite_trip["material_type"] == "":
-            sqlite_trip["material_type"] = None
-        if sqlite_trip["seat"] == "":
-            sqlite_trip["seat"] = None
-        if sqlite_trip["reg"] == "":
-            sqlite_trip["reg"] = None
-        if sqlite_trip["waypoints"] == "":
-            sqlite_trip["waypoints"] = None
-        if sqlite_trip["notes"] == "":
-            sqlite_trip["notes"] = None
-        if sqlite_trip["price"] == "":
-            sqlite_trip["price"] = None
-        if sqlite_trip["ticket_id"] == "":
-            sqlite_trip["ticket_id"] = None
-        sqlite_trip["purchase_date"] = sqlite_trip["purchasing_date"]
-        if sqlite_trip["purchase_date"] == "":
-            sqlite_trip["purchase_date"] = None
-        if sqlite_trip["purchase_date"] is not None:
-            sqlite_trip["purchase_date"] = parse_date(sqlite_trip["purchase_date"])
-        ensure_values_equal(sqlite_trip, pg_trip, "user_id")
-        ensure_values_equal(sqlite_trip, pg_trip, "origin_station")
-        ensure_values_equal(sqlite_trip, pg_trip, "destination_station")
-        ensure_values_equal(sqlite_trip, pg_trip, "start_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "end_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "is_project")
-        ensure_values_equal(sqlite_trip, pg_trip, "utc_start_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "utc_end_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "estimated_trip_duration")
-        ensure_values_equal(sqlite_trip, pg_trip, "manual_trip_duration")
-        ensure_values_equal(sqlite_trip, pg_trip, "trip_length")
-        ensure_values_equal(sqlite_trip, pg_trip, "operator")
-        ensure_values_equal(sqlite_trip, pg_trip, "countries")
-        ensure_values_equal(sqlite_trip, pg_trip, "line_name")
-        ensure_values_equal(sqlite_trip, pg_trip, "created")
-        ensure_values_equal(sqlite_trip, pg_trip, "last_modified")
-        ensure_values_equal(sqlite_trip, pg_trip, "trip_type")
-        ensure_values_equal(sqlite_trip, pg_trip, "material_type")
-        ensure_values_equal(sqlite_trip, pg_trip, "seat")
-        ensure_values_equal(sqlite_trip, pg_trip, "reg")
-        ensure_values_equal(sqlite_trip, pg_trip, "waypoints")
-        ensure_values_equal(sqlite_trip, pg_trip, "notes")
-        ensure_values_equal(sqlite_trip, pg_trip, "price")
-        ensure_values_equal(sqlite_trip, pg_trip, "currency")
-        ensure_values_equal(sqlite_trip, pg_trip, "ticket_id")
-        ensure_values_equal(sqlite_trip, pg_trip, "purchase_date")
+        for property_name in COMPARED_TRIP_FIELDS:
+            ensure_values_equal(sqlite_trip, pg_trip, property_name)
+        return True
     except Exception as e:
+        if not report:
+            logger.error(f"Trip {trip_id} has drifted between SQLite and PG: {e}")
+            return False
         logger.exception(e)
         trace = traceback.format_exc().replace("\n", "<br>")
+        # also called outside of any request (pg outbox worker, nightly check)
+        url = request.url if has_request_context() else "background task"
+        user = getUser() if has_request_context() else None
         msg = f"""
             Trip {trip_id} has drifted between SQLite and PG!<br>
-            URL : {request.url} <br>
+            URL : {url} <br>
             <br>
-            Logged in user : {getUser()}<br>
+            Logged in user : {user}<br>
             <br>
             Trace : <br>
             <br>
@@ -766,6 +822,7 @@ def compare_trip(trip_id: int):
         """
         logger.error(msg)
 
-        if "127.0.0.1" not in request.url and "localhost" not in request.url:
+        if "127.0.0.1" not in url and "localhost" not in url:
             msg = ""
             sendOwnerEmail("Error : " + str(e), msg)
+        return False
@@ -1,32 +1,36 @@
 import json
 import re
 import smtplib
-import sqlite3
+import threading
 import requests
 from contextlib import contextmanager
 from datetime import datetime
 from email.mime.text import MIMEText
-from functools import wraps
+from functools import lru_cache, wraps
 from glob import glob
 from inspect import getcallargs
 
 import pytz
-from flask import abort, request, session, redirect, url_for
+from flask import abort, has_request_context, request, session, redirect, url_for
 from timezonefinder import TimezoneFinder
 
 from py.sql import getCurrentTrip
 from py.utils import load_config
 from src.consts import DbNames
+from src.db_connections import ReferenceConnection, ThreadLocalConnection
 from src.users import User, Friendship, authDb
 
-pathConn = sqlite3.connect(DbNames.PATH_DB.value, check_same_thread=False)
-pathConn.row_factory = sqlite3.Row
+# One connection per thread, see src/db_connections.py
+pathConn = ThreadLocalConnection(DbNames.PATH_DB.value)
+mainConn = ThreadLocalConnection(DbNames.MAIN_DB.value)
+authConn = ThreadLocalConnection(DbNames.AUTH_DB.value)
 
-mainConn = sqlite3.connect(DbNames.MAIN_DB.value, check_same_thread=False)
-mainConn.row_factory = sqlite3.Row
+# Read-only connections, for code paths that only query
+pathReadConn = pathConn.read_only()
+mainReadConn = mainConn.read_only()
 
-authConn = sqlite3.connect(DbNames.AUTH_DB.value, check_same_thread=False)
-authConn.row_factory = sqlite3.Row
+# In-memory copy of the reference tables of main.db, see src/reference_data.py
+refConn = ReferenceConnection(DbNames.MAIN_DB.value)
 
 
 owner = load_config()["owner"]["username"]
@@ -56,6 +60,35 @@ def managed_cursor(connection):
         cursor.close()
 
 
+@contextmanager
+def cursor_or_new(connection, cursor=None):
+    """
+    Yield `cursor` when the caller passes one, so that the queries join its
+    transaction, otherwise a new cursor on `connection`
+    """
+    if cursor is not None:
+        yield cursor
+    else:
+        with managed_cursor(connection) as cursor:
+            yield cursor
+
+
+# SQLite limit on the number of variables in a query
+SQLITE_MAX_VARIABLES = 999
+
+
+def batched_ids(ids, reserved=0):
+    """
+    Split `ids` into batches that fit SQLite's variable limit next to `reserved`
+    other parameters of the query, yielding (batch, placeholders) where
+    placeholders is the "?, ?, ..." list to put in the `IN (...)` filter
+    """
+    size = SQLITE_MAX_VARIABLES - reserved
+    for i in range(0, len(ids), size):
+        batch = ids[i : i + size]
+        yield batch, ", ".join(["?"] * len(batch))
+
+
 def owner_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -112,32 +145,76 @@ def processDates(newTrip, newPath):
     )
 
 
-def getUtcDatetime(lat, lng, dateTime):
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=lat, lng=lng)
+# Coordinates are rounded to about 100m before looking up their timezone
+TIMEZONE_CACHE_PRECISION = 3
+
+_timezone_finder = None
+# TimezoneFinder reads its data files with shared file handles
+_timezone_finder_lock = threading.Lock()
+
+
+def get_timezone_finder():
+    """
+    Return the TimezoneFinder shared by the whole process, created on first use
+    as loading its data is slow
+    """
+    global _timezone_finder
+    if _timezone_finder is None:
+        with _timezone_finder_lock:
+            if _timezone_finder is None:
+                _timezone_finder = TimezoneFinder()
+    return _timezone_finder
+
+
+@lru_cache(maxsize=65536)
+def _timezone_at(lat, lng):
+    tf = get_timezone_finder()
+    with _timezone_finder_lock:
+        return tf.timezone_at(lat=lat, lng=lng)
 
+
+def _rounded(lat, lng):
+    return (
+        round(float(lat), TIMEZONE_CACHE_PRECISION),
+        round(float(lng), TIMEZONE_CACHE_PRECISION),
+    )
+
+
+def getTimezone(lat, lng):
+    """
+    Return the name of the timezone at the given coordinates
+    """
+    return _timezone_at(*_rounded(lat, lng))
+
+
+def getTimezones(coords):
+    """
+    Return the names of the timezones of a list of (lat, lng) pairs, looking up
+    each distinct (rounded) point only once
+    """
+    rounded = [_rounded(lat, lng) for lat, lng in coords]
+    timezones = {point: _timezone_at(*point) for point in dict.fromkeys(rounded)}
+    return [timezones[point] for point in rounded]
+
+
+def getPytzTimezone(timezone_str):
     # Handle override for specific zones
     if timezone_str in ["Asia/Urumqi", "Asia/Kashgar"]:
         # Force UTC+8 manually
-        timezone = pytz.FixedOffset(480)  # 480 minutes = 8 hours
-        localized_datetime = timezone.localize(dateTime)
-    else:
-        timezone = pytz.timezone(timezone_str)
-        localized_datetime = timezone.localize(dateTime)
+        return pytz.FixedOffset(480)  # 480 minutes = 8 hours
+    return pytz.timezone(timezone_str)
+
+
+def getUtcDatetime(lat, lng, dateTime):
+    timezone = getPytzTimezone(getTimezone(lat, lng))
+    localized_datetime = timezone.localize(dateTime)
 
     utc_datetime = localized_datetime.astimezone(pytz.utc).replace(tzinfo=None)
     return utc_datetime
 
 
 def getLocalDatetime(lat, lng, dateTime):
-    # Instantiate TimezoneFinder and find timezone for given lat, lng
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=lat, lng=lng)
-
-    if timezone_str in ["Asia/Urumqi", "Asia/Kashgar"]:
-        local_timezone = pytz.FixedOffset(480)  # 480 minutes = 8 hours
-    else:
-        local_timezone = pytz.timezone(timezone_str)
+    local_timezone = getPytzTimezone(getTimezone(lat, lng))
     local_datetime = dateTime.astimezone(local_timezone).replace(tzinfo=None)
     return local_datetime
 
@@ -193,7 +270,10 @@ def sendEmailToUser(user_id, subject, message):
 
 def sendOwnerEmail(subject, message):
     address = load_config()["owner"]["email"]
-    if "127.0.0.1" in request.url or "localhost" in request.url:
+    # background tasks (pg outbox worker, nightly checks) have no request
+    if has_request_context() and (
+        "127.0.0.1" in request.url or "localhost" in request.url
+    ):
         print(f"Email to: {address}\nSubject: {subject}\nMessage: {message}")
     else:
         sendEmail(address, subject, message)
@@ -215,7 +295,7 @@ def listOperatorsLogos(tripType=None):
     selected_types = logo_types.keys() if tripType is None else [tripType]
 
     logoURLs = {}
-    with managed_cursor(mainConn) as cursor:
+    with managed_cursor(refConn) as cursor:
         for logo_type in selected_types:
             # Fetch logos based on operator_type field
             cursor.execute(
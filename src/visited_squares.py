@@ -0,0 +1,302 @@
+"""
+Persistent 1°x1° visited squares grid
+
+Every user has one row per visited square in the visited_squares table of main.db,
+holding the number of trips that stop in it, pass through it on land and fly over
+it. The status of a square is derived from these counters (stopped > passed > air),
+so that a trip can be added or removed without looking at the other trips.
+
+Only trips that started before the user's `synced_until` mark are counted. Trips
+are added or removed as they are created, edited or deleted, and the trips that
+started since the mark are caught up when the grid is read.
+"""
+
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from py.sql import upsertPercent
+from py.utils import interpolate_great_circle_many
+from src.path_arrays import load_path_arrays
+from src.utils import cursor_or_new, mainConn, managed_cursor
+
+AIR_TYPES = ("air", "helicopter")
+TOTAL_SQUARES = 180 * 360  # entire world grid
+
+# Serializes the read-modify-write of the counters between requests
+_lock = threading.Lock()
+
+_started_trips_query = """
+    SELECT uid, type
+    FROM trip
+    WHERE username = :username
+    AND start_datetime NOT IN (1)
+    AND (
+        CASE
+            WHEN utc_start_datetime IS NOT NULL THEN utc_start_datetime
+            ELSE start_datetime
+        END
+    ) < :until
+    AND (
+        :since IS NULL
+        OR (
+            CASE
+                WHEN utc_start_datetime IS NOT NULL THEN utc_start_datetime
+                ELSE start_datetime
+            END
+        ) >= :since
+    )
+"""
+
+
+def _square_counts(trips):
+    """
+    Count, for every square, the trips stopping in it, passing through it on land
+    and flying over it
+
+    `trips` is a list of rows with the uid and type of the trips. Returns a dict
+    (lat, lng) -> [stopped, passed, air].
+    """
+    air_trip_ids = {trip["uid"] for trip in trips if trip["type"] in AIR_TYPES}
+    paths = load_path_arrays([trip["uid"] for trip in trips])
+    if len(paths.coords) == 0:
+        return {}
+
+    is_air_path = np.isin(paths.trip_ids, list(air_trip_ids))
+    is_air_point = np.repeat(is_air_path, paths.lengths)
+    point_path_index = paths.point_path_index()
+    squares = np.floor(paths.coords).astype(np.int64)
+
+    # Interpolate between points (only for air trips with intermediate points)
+    interpolated_segments = paths.segment_mask() & (is_air_path & (paths.lengths > 2))[
+        point_path_index[:-1]
+    ]
+    interpolated, segment = interpolate_great_circle_many(
+        paths.coords[:-1][interpolated_segments],
+        paths.coords[1:][interpolated_segments],
+        max_distance_km=50,
+    )
+    interpolated_squares = np.floor(interpolated).astype(np.int64)
+    interpolated_path_index = point_path_index[:-1][interpolated_segments][segment]
+
+    endpoints = paths.endpoint_indices()
+    by_status = [
+        (squares[endpoints], point_path_index[endpoints]),
+        (squares[~is_air_point], point_path_index[~is_air_point]),
+        (
+            np.concatenate([squares[is_air_point], interpolated_squares]),
+            np.concatenate([point_path_index[is_air_point], interpolated_path_index]),
+        ),
+    ]
+
+    counts = {}
+    for status, (status_squares, path_index) in enumerate(by_status):
+        if len(status_squares) == 0:
+            continue
+        # Each trip counts once per square
+        trip_squares = np.unique(
+            np.column_stack([path_index, status_squares]), axis=0
+        )[:, 1:]
+        unique_squares, square_counts = np.unique(
+            trip_squares, axis=0, return_counts=True
+        )
+        for (lat, lng), count in zip(unique_squares.tolist(), square_counts.tolist()):
+            counts.setdefault((lat, lng), [0, 0, 0])[status] += count
+    return counts
+
+
+def _apply_counts(cursor, username, counts, sign=1):
+    """
+    Add (or subtract with sign=-1) square counts to the user's grid
+    """
+    cursor.executemany(
+        """
+        INSERT INTO visited_squares (username, lat, lng, stopped, passed, air)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (username, lat, lng) DO UPDATE SET
+            stopped = stopped + excluded.stopped,
+            passed = passed + excluded.passed,
+            air = air + excluded.air
+        """,
+        [
+            (username, lat, lng, sign * stopped, sign * passed, sign * air)
+            for (lat, lng), (stopped, passed, air) in counts.items()
+        ],
+    )
+    if sign < 0:
+        cursor.execute(
+            """
+            DELETE FROM visited_squares
+            WHERE username = ? AND stopped <= 0 AND passed <= 0 AND air <= 0
+            """,
+            (username,),
+        )
+
+
+def _update_land_percent(cursor, username):
+    """
+    Keep the world_squares leaderboard entry in sync with the grid
+    """
+    cursor.execute(
+        """
+        SELECT COUNT(*) FROM visited_squares
+        WHERE username = ? AND (stopped > 0 OR passed > 0)
+        """,
+        (username,),
+    )
+    land_squares = cursor.fetchone()[0]
+    cursor.execute(
+        upsertPercent,
+        {
+            "username": username,
+            "cc": "world_squares",
+            "percent": round((land_squares / TOTAL_SQUARES) * 100, 2),
+        },
+    )
+
+
+def _synced_until(cursor, username):
+    cursor.execute(
+        "SELECT synced_until FROM visited_squares_sync WHERE username = ?",
+        (username,),
+    )
+    row = cursor.fetchone()
+    return row["synced_until"] if row is not None else None
+
+
+def _counted_trip(trip_id):
+    """
+    Return the uid, type and username of the trip if it is part of its owner's
+    grid, None otherwise
+    """
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            """
+            SELECT trip.uid, trip.type, trip.username
+            FROM trip
+            JOIN visited_squares_sync sync ON sync.username = trip.username
+            WHERE trip.uid = :trip_id
+            AND trip.start_datetime NOT IN (1)
+            AND (
+                CASE
+                    WHEN trip.utc_start_datetime IS NOT NULL
+                    THEN trip.utc_start_datetime
+                    ELSE trip.start_datetime
+                END
+            ) < sync.synced_until
+            """,
+            {"trip_id": trip_id},
+        )
+        return cursor.fetchone()
+
+
+def _update_trip_squares(cursor, trip_id, sign):
+    trip = _counted_trip(trip_id)
+    if trip is None:
+        # Not in the grid yet, it will be picked up when the grid is read
+        return
+    counts = _square_counts([trip])
+    _apply_counts(cursor, trip["username"], counts, sign)
+    _update_land_percent(cursor, trip["username"])
+
+
+def add_trip_squares(trip_id):
+    """
+    Add a trip to its owner's grid, to be called once the trip and its path are saved
+    """
+    with _lock:
+        with managed_cursor(mainConn) as cursor:
+            _update_trip_squares(cursor, trip_id, 1)
+        mainConn.commit()
+
+
+def remove_trip_squares(trip_id, cursor=None):
+    """
+    Remove a trip from its owner's grid, to be called before the trip or its path
+    are changed or deleted, in the same transaction as that write so that the
+    counters are left untouched if it fails. The caller is responsible for
+    committing.
+    """
+    with _lock:
+        with cursor_or_new(mainConn, cursor) as cursor:
+            _update_trip_squares(cursor, trip_id, -1)
+
+
+def refresh_user_squares(username):
+    """
+    Add to the user's grid the trips that started since it was last read, or all
+    the past trips if the grid was never built
+    """
+    with _lock:
+        now = datetime.now()
+        with managed_cursor(mainConn) as cursor:
+            since = _synced_until(cursor, username)
+            cursor.execute(
+                _started_trips_query,
+                {"username": username, "since": since, "until": now},
+            )
+            trips = cursor.fetchall()
+
+        counts = _square_counts(trips) if trips else {}
+        with managed_cursor(mainConn) as cursor:
+            _apply_counts(cursor, username, counts)
+            cursor.execute(
+                "INSERT OR REPLACE INTO visited_squares_sync (username, synced_until) "
+                "VALUES (?, ?)",
+                (username, now),
+            )
+            _update_land_percent(cursor, username)
+        mainConn.commit()
+
+
+def delete_user_squares(username, cursor=None):
+    """
+    Drop the user's grid, it is rebuilt from scratch the next time it is read.
+    The caller is responsible for committing.
+    """
+    with cursor_or_new(mainConn, cursor) as cursor:
+        cursor.execute("DELETE FROM visited_squares WHERE username = ?", (username,))
+        cursor.execute(
+            "DELETE FROM visited_squares_sync WHERE username = ?", (username,)
+        )
+
+
+def rebuild_user_squares(username):
+    """
+    Rebuild the user's grid from all their past trips
+    """
+    with _lock:
+        delete_user_squares(username)
+        mainConn.commit()
+    refresh_user_squares(username)
+
+
+def get_visited_squares(username):
+    """
+    Return the user's visited squares as a dict (lat, lng) -> status, with status
+    one of "stopped", "passed" or "air"
+    """
+    refresh_user_squares(username)
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            """
+            SELECT lat, lng, stopped, passed, air FROM visited_squares
+            WHERE username = ?
+            """,
+            (username,),
+        )
+        rows = cursor.fetchall()
+
+    visited_squares = {}
+    for row in rows:
+        if row["stopped"] > 0:
+            status = "stopped"
+        elif row["passed"] > 0:
+            status = "passed"
+        elif row["air"] > 0:
+            status = "air"
+        else:
+            continue
+        visited_squares[(row["lat"], row["lng"])] = status
+    return visited_squares